@@ -2,16 +2,9 @@
 
 import argparse
 import codecs
-import errno
 import os
 import subprocess
 import sys
-###########################################
-# File utility for WINDOWS, i.e., (only)
-# this function is platform-dependent!!
-#
-from ctypes import cdll
-from subprocess import call
 
 #
 #	Use:
@@ -21,8 +14,8 @@ from subprocess import call
 #	2 - type: 'doPandoc --help' to get a full overview of its use
 #
 #	NOTE:
-#		This applies a WINDOWS platform DEPENDENT file utility, defined as is_open(filename). This is used
-#		after all processing is done and the resulting file (pdf, tex, whathaveyou) is to be opened.
+#		The targets are written to a temporary file, and moved into place when complete (see publish()). On Windows,
+#		a target that is open in another program cannot be replaced; is_open(filename) warns about that beforehand.
 #
 #
 #	Include:
@@ -34,61 +27,27 @@ from subprocess import call
 #
 #	Result: results\<arg1>.<arg2>
 #
-from typing import List
-
-_sopen = cdll.msvcrt._sopen
-_close = cdll.msvcrt._close
-_SH_DENYRW = 0x10
-
 
 def is_open(filename):
     # Returns:
     #	* None: if file does not exist
     #	* False: if file exists and can be opened
-    #	* True: if file is opened by another process
-
-    f = 'results\\test.tst'
-    if os.path.exists(f):
-        try:
-            os.remove(f)
-        except OSError as e:
-            print("Could not remove temp file " + f + ". Remove it manually before continuing!!")
-    if os.path.exists(filename):
-        try:
-            if os.rename(filename, f):  # Seems to be always False
-                print('Temporarily renamed "' + filename + '", i.e., it was not open. Now renaming it back.')
-                assert os.rename(f,
-                                 filename), "Could not re-rename file " + f + " to its original name " + filename + " . Do it manually before anything else!!"
-                return False  # file doesn't exist
-            else:
-                return False  # file is not used
-        except OSError as e:
-            if "WinError 32" in str(e):  # File is being used by another process
-                # print ('File "' + filename +'" is in use! Close it?')
-                return True  # file is already open
-            elif "WinError 183" in str(
-                    e):  # Cannot create a file that already exists. However, which file? The original or the temporary one?
-                print('Temp file "' + f + '" already exists! Remove it!!')
-                pass  # We need to establish what needs to be done in this case
-            else:
-                print('Access-error on file! Got OSError: ' + str(e))
-                pass  # We need to establish what needs to be done in this case
-            return None  # file doesn't exist
-    return None  # file doesn't exist
-
+    #	* True: if file is opened by another process that locks it (as Word and Acrobat do on Windows)
+    if not os.path.exists(filename):
+        return None  # file doesn't exist
+    if os.name != 'nt':
+        return False  # POSIX systems do not lock files that are open
+    try:
+        with open(filename, 'r+b'):
+            return False  # file is not used
+    except PermissionError:
+        return True  # file is already open
+    except OSError as e:
+        print('Access-error on file! Got OSError: ' + str(e))
+        return None
 
-#    if not os.access(filename, os.F_OK):
-#        return None # file doesn't exist
-#    h = _sopen(filename, 0, _SH_DENYRW, 0)
-#    if h == 3:
-#        _close(h)
-#        return False # file is not opened by anyone else
-#    return True # file is already open
-# END file utility for WINDOWS platform.
-############################################	
 
-
-def InputError(msg, expr):
+class InputError(Exception):
     """Exception raised for errors in the input.
 
     Attributes:
@@ -96,10 +55,10 @@ def InputError(msg, expr):
         msg  -- explanation of the error
     """
 
-    print('ERROR: ' + msg + ': ' + expr + '\n')
-    print('Type \'doPandoc -h\' for help\n')
-    exit(1)
-    return (0)
+    def __init__(self, msg, expr):
+        super().__init__(msg + ': ' + expr)
+        self.msg = msg
+        self.expr = expr
 
 
 class cd:
@@ -116,29 +75,1858 @@ class cd:
         os.chdir(self.savedPath)
 
 
+def openFile(filename):
+    # Open the file in the application that the desktop associates with it, if there is a desktop
+    import shutil
+    if os.name == 'nt':
+        os.startfile(filename, 'open')
+    elif sys.platform == 'darwin':
+        subprocess.Popen(['open', filename])
+    elif shutil.which('xdg-open') and (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+        subprocess.Popen(['xdg-open', filename], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def tempName(filename):
+    # Return: the name of a temporary file next to the given file, private to this process and thread, with the same
+    # extension (from which pandoc infers the output format). Write it in full, then publish() it
+    import threading
+    root, ext = os.path.splitext(filename)
+    return '{}.{}-{}.tmp{}'.format(root, os.getpid(), threading.get_ident(), ext)
+
+
+def publish(tempFile, filename):
+    # Move the complete tempFile into place as filename in one step, so that readers, and concurrent builds, see either
+    # the previous or the new file, never a partial one
+    # Return: 0, or 1 when filename cannot be replaced (on Windows: while another program has it open)
+    try:
+        os.replace(tempFile, filename)
+    except PermissionError as e:
+        print('\n>>>> ERROR: cannot replace {} ({}); close it and build again'.format(filename, e.strerror))
+        os.remove(tempFile)
+        return 1
+    return 0
+
+
+class LockFile:
+    """Context manager that holds a lock file, e.g. to serialise the builds of a project where they change the repository
+
+    The lock file names the process and host that hold it, and the holder refreshes its modification time while it holds
+    it. A lock that is left behind by a process that died (on this host) is broken, as is one that was not refreshed for
+    default['lockStale'] seconds where the holder cannot be looked for (on another host, or on Windows); a live holder
+    on this host keeps its lock however long it takes.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = None
+        self.stop = None
+
+    def holder(self, filename=None):
+        # Return: the process id and host in the lock file (by default this lock), or (None, None) if it cannot be read
+        try:
+            with open(filename or self.filename, encoding='utf-8') as f:
+                pid, host = f.read().split()
+            return int(pid), host
+        except (OSError, ValueError):
+            return None, None
+
+    def isStale(self, filename=None):
+        # Return: True if the holder of the lock in the lock file (by default this lock) has gone
+        import socket
+        import time
+        try:
+            age = time.time() - os.path.getmtime(filename or self.filename)
+        except OSError:
+            return False  # just released
+        pid, host = self.holder(filename)
+        if pid is not None and host == socket.gethostname() and os.name != 'nt':
+            # The holder is on this host: the lock is stale when its process is gone, and only then
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True
+            except OSError:
+                pass  # it exists, but belongs to someone else
+            return False
+        # Elsewhere, or on Windows (where os.kill() would terminate the process), a live holder keeps the lock fresh
+        return age > default['lockStale']
+
+    def breakStale(self):
+        # Break the lock if its holder has gone. The lock file is first moved aside under a name of our own, which only
+        # one of the processes that break it at the same time succeeds in, and then checked again: a lock that was taken
+        # anew in the meantime is put back
+        # Return: True if the lock is to be taken again, False if it is held
+        import uuid
+        if not self.isStale():
+            return False
+        aside = '{}.{}.stale'.format(self.filename, uuid.uuid4().hex)
+        try:
+            os.rename(self.filename, aside)
+        except OSError:
+            return True  # released, or broken by another process in the meantime
+        if not self.isStale(aside):
+            try:
+                os.link(aside, self.filename)
+            except OSError:
+                pass  # taken again by yet another process
+        os.remove(aside)
+        return True
+
+    def refresh(self):
+        # Keep the modification time of the lock file fresh until the lock is released
+        while not self.stop.wait(default['lockStale'] / 3):
+            try:
+                os.utime(self.filename)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        import socket
+        import threading
+        import time
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        waited, announced = 0, False
+        while True:
+            try:
+                self.fd = os.open(self.filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                if self.breakStale():
+                    continue
+                if waited >= default['lockWait']:
+                    pid, host = self.holder()
+                    raise InputError('another build holds the lock (process {} on {})'.format(pid, host), self.filename)
+                if not announced:
+                    print('* waiting for          : ' + self.filename)
+                    announced = True
+                time.sleep(0.2)
+                waited += 0.2
+        os.write(self.fd, '{} {}'.format(os.getpid(), socket.gethostname()).encode('utf-8'))
+        self.stop = threading.Event()
+        threading.Thread(target=self.refresh, daemon=True).start()
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.stop.set()
+        os.close(self.fd)
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass  # moved aside for a moment by a process that checks whether it is stale (see breakStale)
+
+
+class FileCache:
+    """Content-addressed file store under the doPandoc cache directory, bounded in size with LRU eviction"""
+
+    def __init__(self, cacheDir, name, maxSize=None):
+        # cacheDir: the doPandoc cache directory (next to results\)
+        # name: the sub directory holding this particular cache, e.g. 'ast'
+        # maxSize: the maximum size of this cache in bytes, or None for unbounded
+        self.name = name
+        self.dir = os.path.join(cacheDir, name)
+        self.maxSize = maxSize
+
+    @staticmethod
+    def key(*parts):
+        # Return: a hexadecimal digest over the given parts (strings or bytes)
+        import hashlib
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    @staticmethod
+    def digest(filename):
+        # Return: the hexadecimal digest over the content of the given file
+        import hashlib
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def path(self, key, suffix=''):
+        return os.path.join(self.dir, key + suffix)
+
+    def get(self, key, suffix=''):
+        # Return: the path of the cached entry, or None on a cache miss
+        # Note: a hit refreshes the entry's modification time, which is what the LRU eviction is based upon
+        p = self.path(key, suffix)
+        if not os.path.exists(p):
+            return None
+        try:
+            os.utime(p)
+        except OSError:
+            pass
+        return p
+
+    def tempfile(self, suffix=''):
+        # Return: the path of a new, empty temporary file inside the cache, to be filled and then handed to put()
+        import tempfile
+        os.makedirs(self.dir, exist_ok=True)
+        fd, p = tempfile.mkstemp(suffix=suffix + '.tmp', dir=self.dir)
+        os.close(fd)
+        return p
+
+    def put(self, key, filename, suffix=''):
+        # Move the given temporary file (see tempfile()) into the cache under the given key, and evict old entries if the cache grew too large
+        # Return: the path of the cached entry
+        os.makedirs(self.dir, exist_ok=True)
+        p = self.path(key, suffix)
+        os.replace(filename, p)
+        self.evict(keep=p)
+        return p
+
+    def entries(self):
+        # Return: list of (mtime, size, path) of all cache entries, least recently used first
+        if not os.path.isdir(self.dir):
+            return []
+        result = []
+        for entry in os.scandir(self.dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                st = entry.stat()
+                result.append((st.st_mtime, st.st_size, entry.path))
+        return sorted(result)
+
+    def evict(self, keep=None):
+        # Remove the least recently used entries until the cache fits its maximum size
+        # Return: the number of entries removed
+        if self.maxSize is None:
+            return 0
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, p in entries:
+            if total <= self.maxSize:
+                break
+            if p == keep:
+                continue
+            try:
+                os.remove(p)
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def info(self):
+        # Return: the number of entries and their total size in bytes
+        entries = self.entries()
+        return len(entries), sum(size for _, size, _ in entries)
+
+    def clear(self):
+        # Remove all entries of this cache
+        # Return: the number of entries removed
+        removed = 0
+        for _, _, p in self.entries():
+            try:
+                os.remove(p)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+
+class BuildManifest:
+    """Record of everything that went into a target file, used to skip pandoc while the target is up-to-date"""
+
+    def __init__(self, cacheDir, targetFile):
+        self.target = targetFile
+        self.file = os.path.join(cacheDir, 'manifest', os.path.basename(targetFile) + '.json')
+        self.record = None
+
+    def compute(self, pArgs, inputs):
+        # Establish the record for this build: the full pandoc argument vector and the digest of every input file
+        # (None for input files that do not exist)
+        digests = {}
+        for filename in inputs:
+            digests[filename] = FileCache.digest(filename) if os.path.isfile(filename) else None
+        self.record = {'target': self.target, 'args': list(pArgs), 'inputs': digests}
+        return self.record
+
+    def stored(self):
+        # Return: the record of the previous build of the target, or None if there is none
+        import json
+        try:
+            with open(self.file, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def isCurrent(self):
+        # Return: True iff the target exists, is untouched since its previous build, and that build had the same record
+        previous = self.stored()
+        if not previous or not self.record or not os.path.exists(self.target):
+            return False
+        st = os.stat(self.target)
+        if previous.get('output') != [st.st_size, st.st_mtime_ns]:
+            return False
+        return all(previous.get(key) == self.record[key] for key in ('target', 'args', 'inputs'))
+
+    def save(self):
+        # Store the record of the (successful) build, together with the identity of the resulting target file
+        import json
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        st = os.stat(self.target)
+        self.record['output'] = [st.st_size, st.st_mtime_ns]
+        temp = tempName(self.file)
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(self.record, f, indent=1)
+        os.replace(temp, self.file)
+
+
+class DirectoryWatcher:
+    """Watch directory trees for changed files, through inotify where available (Linux) and by polling otherwise"""
+
+    # inotify event masks, see <sys/inotify.h>
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    IN_IGNORED = 0x8000
+
+    def __init__(self, dirs, interval=0.5):
+        # dirs: the directories to watch, including their sub directories; non-existing ones are ignored
+        # interval: the polling interval in seconds, when inotify is not available
+        self.dirs = [d for d in dirs if os.path.isdir(d)]
+        self.interval = interval
+        self.fd = None
+        self.watches = {}
+        try:
+            self._initInotify()
+            self.method = 'inotify'
+        except (OSError, AttributeError):
+            self.fd = None
+            self.snapshot = self._scan()
+            self.method = 'polling'
+
+    def _initInotify(self):
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.fd = fd
+        for d in self.dirs:
+            for root, subdirs, _ in os.walk(d):
+                self._addWatch(root)
+
+    def _addWatch(self, directory):
+        import ctypes
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed on " + directory)
+        self.watches[wd] = directory
+
+    def _scan(self):
+        # Return: dict of file name: (mtime, size) for all files in the watched directories
+        result = {}
+        for d in self.dirs:
+            for root, _, files in os.walk(d):
+                for name in files:
+                    p = os.path.join(root, name)
+                    try:
+                        st = os.stat(p)
+                    except OSError:
+                        continue
+                    result[p] = (st.st_mtime_ns, st.st_size)
+        return result
+
+    def _poll(self, timeout):
+        # Wait at most timeout seconds (or forever, when None) for changes
+        # Return: the set of changed file names, empty if none changed in time
+        import time
+        if self.fd is None:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.monotonic())))
+                current = self._scan()
+                changed = {p for p in set(current) | set(self.snapshot) if current.get(p) != self.snapshot.get(p)}
+                self.snapshot = current
+                if changed or (deadline is not None and time.monotonic() >= deadline):
+                    return changed
+        import select
+        import struct
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+            if mask & self.IN_IGNORED or wd not in self.watches:
+                continue
+            p = os.path.join(self.watches[wd], name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # A new (compile) folder: watch it as well
+                    for root, _, _ in os.walk(p):
+                        self._addWatch(root)
+                continue
+            changed.add(p)
+        return changed
+
+    def wait(self, debounce=1.0):
+        # Block until files have changed, and the burst of writes has settled for debounce seconds
+        # Return: the set of changed file names (temporary and hidden files excluded)
+        changed = set()
+        while not changed:
+            changed = {p for p in self._poll(None) if not self._ignore(p)}
+        while True:
+            more = self._poll(debounce)
+            if not more:
+                return changed
+            changed |= {p for p in more if not self._ignore(p)}
+
+    @staticmethod
+    def _ignore(filename):
+        name = os.path.basename(filename)
+        return name.startswith('.') or name.startswith('~') or name.endswith('~') or name.endswith('.tmp')
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class LatexBuild:
+    """Persistent build directory in which the LaTeX engine turns one document's .tex into pdf
+
+    The aux, toc and other state files of the previous build are kept, hence a small change in the document mostly
+    requires a single pass. Like latexmk, passes are repeated only as long as that state keeps changing.
+    """
+
+    # The files that carry state from one LaTeX pass to the next
+    stateExtensions = ('.aux', '.toc', '.lof', '.lot', '.out', '.nav', '.snm', '.bbl', '.bcf', '.idx', '.ind', '.glo')
+
+    def __init__(self, buildDir, jobname, engine='pdflatex', texInputs=None, maxPasses=5, engineOptions=None):
+        # buildDir: the persistent build directory of this document
+        # jobname: the base name of the .tex, .log and .pdf files
+        # texInputs: additional directories where the engine looks for LaTeX support files
+        # engineOptions: additional command line options of the engine (pandoc's --pdf-engine-opt)
+        self.dir = buildDir
+        self.jobname = jobname
+        self.engine = engine
+        self.engineOptions = engineOptions or []
+        self.texInputs = texInputs or []
+        self.maxPasses = maxPasses
+        self.texFile = os.path.join(buildDir, jobname + '.tex')
+        self.pdfFile = os.path.join(buildDir, jobname + '.pdf')
+        self.logFile = os.path.join(buildDir, jobname + '.log')
+        os.makedirs(buildDir, exist_ok=True)
+
+    def state(self):
+        # Return: dict of file name: digest of the state files in the build directory
+        result = {}
+        for entry in os.scandir(self.dir):
+            if entry.is_file() and os.path.splitext(entry.name)[1] in self.stateExtensions:
+                result[entry.name] = FileCache.digest(entry.path)
+        return result
+
+    def _log(self):
+        try:
+            with open(self.logFile, encoding='latin-1') as f:
+                return f.read()
+        except OSError:
+            return ''
+
+    def _usesBibtex(self):
+        try:
+            with open(os.path.join(self.dir, self.jobname + '.aux'), encoding='latin-1') as f:
+                return '\\bibdata' in f.read()
+        except OSError:
+            return False
+
+    def _run(self, args, formatDir=None):
+        env = dict(os.environ)
+        if self.texInputs:
+            # The trailing separator retains the engine's default search path
+            env['TEXINPUTS'] = os.pathsep.join(['.'] + self.texInputs + [env.get('TEXINPUTS', '')])
+        if formatDir:
+            env['TEXFORMATS'] = os.pathsep.join([formatDir, env.get('TEXFORMATS', '')])
+        return subprocess.call(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+
+    def compile(self, formatFile=None):
+        # Run the engine on the .tex file until the state files no longer change (or the maximum number of passes)
+        # formatFile: a precompiled format of the document's preamble to start the engine from (see LatexFormats)
+        # Return: the return code of the last engine (or biber/bibtex) run
+        previous = self.state()
+        engineArgs = [self.engine, '-interaction=nonstopmode', '-halt-on-error', '-file-line-error'] + self.engineOptions
+        if formatFile:
+            engineArgs.append('-fmt=' + os.path.splitext(os.path.basename(formatFile))[0])
+        for n in range(1, self.maxPasses + 1):
+            rc = self._run(engineArgs + ['-output-directory=' + self.dir, self.texFile],
+                           os.path.dirname(formatFile) if formatFile else None)
+            if rc != 0:
+                import re
+                errors = [line for line in self._log().splitlines() if line.startswith('!') or re.match(r'^[^:]+:\d+: ', line)]
+                print('\n>>>> ERROR: {} returned with {} (see {}):\n{}'.format(self.engine, rc, self.logFile,
+                                                                             '\n'.join(errors[:10])))
+                return rc
+            current = self.state()
+            if current.get(self.jobname + '.bcf') != previous.get(self.jobname + '.bcf'):
+                # biblatex: the bibliography needs to be (re)generated
+                rc = self._run(['biber', '--input-directory=' + self.dir, '--output-directory=' + self.dir, self.jobname])
+            elif current.get(self.jobname + '.aux') != previous.get(self.jobname + '.aux') and self._usesBibtex():
+                rc = self._run(['bibtex', os.path.join(self.dir, self.jobname)])
+            if rc != 0:
+                print('\n>>>> ERROR: bibliography processing returned with {}'.format(rc))
+                return rc
+            current = self.state()
+            rerun = 'Rerun to get' in self._log() or 'Rerun LaTeX' in self._log()
+            if current == previous and not rerun:
+                break
+            previous = current
+        print('* LaTeX passes         : {} ({}{})'.format(n, self.engine, ', precompiled preamble' if formatFile else ''))
+        return 0
+
+
+class LatexFormats:
+    """Cache of precompiled LaTeX formats, each holding the engine's state after reading a document's preamble
+
+    The preamble (everything before \\begin{document}) comes from the template and its support files, and hardly ever
+    changes, while loading its packages is most of the work of a pass over a short document. The mylatexformat package
+    dumps that state into a format file, from which the engine starts instead, skipping the preamble of the .tex. A
+    format is keyed by the preamble, the support files, and the engine's version and base format. A preamble that cannot
+    be dumped (e.g. fonts loaded by fontspec), or that a document only compiles without, is remembered as such, and
+    compiled as usual until one of these changes.
+    """
+
+    # Engine: its version and the stamp of its base format, probed once per process
+    engineVersions = {}
+
+    def __init__(self, cacheDir, engine, texInputs=None):
+        self.cache = FileCache(cacheDir, 'latex', default['latexFormatCacheSize'])
+        self.engine = engine
+        self.texInputs = texInputs or []
+
+    def engineVersion(self):
+        # Return: the version of the engine, together with the path and modification time of its base format (e.g.
+        # pdflatex.fmt), which is remade when the TeX installation is updated; empty if the engine cannot be run
+        if self.engine not in self.engineVersions:
+            try:
+                out = subprocess.run([self.engine, '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                     universal_newlines=True).stdout
+            except OSError:
+                out = ''
+            version = out.splitlines()[0] if out else ''
+            try:
+                baseFormat = subprocess.run(['kpsewhich', os.path.splitext(os.path.basename(self.engine))[0] + '.fmt'],
+                                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                            universal_newlines=True).stdout.strip()
+                if version and baseFormat:
+                    version += ' ({} {})'.format(baseFormat, os.stat(baseFormat).st_mtime_ns)
+            except OSError:
+                pass
+            self.engineVersions[self.engine] = version
+        return self.engineVersions[self.engine]
+
+    def supportStamp(self):
+        # Return: (relative path, size, modification time) of the LaTeX support files that the preamble may load
+        stamp = []
+        for entry in self.texInputs:
+            top = entry.rstrip('/\\')
+            if entry.endswith('//'):
+                walk = os.walk(top)
+            else:
+                walk = [(top, [], os.listdir(top))] if os.path.isdir(top) else []
+            for path, dirs, files in walk:
+                dirs.sort()
+                for name in sorted(files):
+                    st = os.stat(os.path.join(path, name))
+                    stamp.append((os.path.relpath(os.path.join(path, name), top), st.st_size, st.st_mtime_ns))
+        return stamp
+
+    def prepare(self, texFile):
+        # Find or make the format of the preamble of the given .tex
+        # Return: the path of the format file, or None when the preamble is to be compiled as usual
+        import shutil
+        import tempfile
+        with open(texFile, 'rb') as f:
+            preamble = f.read().split(b'\\begin{document}', 1)
+        if len(preamble) < 2 or not self.engineVersion():
+            return None
+        key = FileCache.key(preamble[0], self.engine, self.engineVersion(), os.environ.get('TEXINPUTS', ''),
+                            repr(self.supportStamp()))
+        formatFile = self.cache.get(key, '.fmt')
+        if formatFile or self.cache.get(key, '.failed'):
+            return formatFile
+        os.makedirs(self.cache.dir, exist_ok=True)
+        dumpDir = tempfile.mkdtemp(dir=self.cache.dir)
+        try:
+            build = LatexBuild(dumpDir, key, engine=self.engine, texInputs=self.texInputs)
+            rc = build._run([self.engine, '-ini', '-interaction=nonstopmode', '-halt-on-error', '-jobname=' + key,
+                             '-output-directory=' + dumpDir,
+                             '&' + os.path.splitext(os.path.basename(self.engine))[0], 'mylatexformat.ltx', texFile])
+            if rc == 0 and os.path.isfile(os.path.join(dumpDir, key + '.fmt')):
+                print('* LaTeX format         : precompiled the preamble')
+                return self.cache.put(key, os.path.join(dumpDir, key + '.fmt'), '.fmt')
+            print('* LaTeX format         : the preamble cannot be precompiled (see {}), hence it is compiled as usual'.format(
+                os.path.join(self.cache.dir, key + '.log')))
+            if os.path.isfile(build.logFile):
+                os.replace(build.logFile, os.path.join(self.cache.dir, key + '.log'))
+            self.reject(formatFile=self.cache.path(key, '.fmt'))
+            return None
+        finally:
+            shutil.rmtree(dumpDir, ignore_errors=True)
+
+    def reject(self, formatFile):
+        # Remember that the preamble of the given format is to be compiled as usual, and drop the format
+        key = os.path.splitext(os.path.basename(formatFile))[0]
+        marker = self.cache.tempfile('.failed')
+        self.cache.put(key, marker, '.failed')
+        if os.path.exists(formatFile):
+            os.remove(formatFile)
+
+
+class BibIndex:
+    """Cache of bibliographies converted to CSL JSON, from which the entries that a document cites are selected
+
+    Citation processing then only has to read the entries the document actually uses, instead of parsing the whole
+    (shared) bibliography on every run.
+    """
+
+    def __init__(self, cacheDir, pandocVersion):
+        self.cache = FileCache(cacheDir, 'bib', default['bibCacheSize'])
+        self.pandocVersion = tuple(int(n) for n in pandocVersion.split('.') if n.isdigit())
+        self.memoFile = os.path.join(cacheDir, 'bib-index.json')
+        self.memo = None
+
+    def _loadMemo(self):
+        import json
+        if self.memo is None:
+            try:
+                with open(self.memoFile, encoding='utf-8') as f:
+                    self.memo = json.load(f)
+            except (OSError, ValueError):
+                self.memo = {}
+        return self.memo
+
+    def _saveMemo(self):
+        import json
+        os.makedirs(os.path.dirname(self.memoFile), exist_ok=True)
+        temp = tempName(self.memoFile)
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(self.memo, f)
+        os.replace(temp, self.memoFile)
+
+    def digest(self, bibFile):
+        # Return: the digest of the bibliography, which is only recomputed when its modification time or size changed
+        st = os.stat(bibFile)
+        memo = self._loadMemo()
+        path = os.path.abspath(bibFile)
+        if path in memo and memo[path][:2] == [st.st_mtime_ns, st.st_size]:
+            return memo[path][2]
+        digest = FileCache.digest(bibFile)
+        memo[path] = [st.st_mtime_ns, st.st_size, digest]
+        self._saveMemo()
+        return digest
+
+    def convert(self, bibFile, outFile):
+        # Convert the bibliography to CSL JSON by pandoc (2.11 and newer) or pandoc-citeproc
+        # Return: True on success
+        if os.path.splitext(bibFile)[1].lower() == '.json':
+            import shutil
+            shutil.copyfile(bibFile, outFile)
+            return True
+        try:
+            if self.pandocVersion >= (2, 11):
+                reader = 'bibtex' if os.path.splitext(bibFile)[1].lower() == '.bibtex' else 'biblatex'
+                subprocess.run(['pandoc', '-f', reader, '-t', 'csljson', '-o', outFile, bibFile],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+            else:
+                result = subprocess.run(['pandoc-citeproc', '--bib2json', bibFile], stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, check=True)
+                with open(outFile, 'wb') as f:
+                    f.write(result.stdout)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('* WARNING: cannot convert bibliography {} to CSL JSON ({})'.format(bibFile, str(e)))
+            return False
+        return True
+
+    def entries(self, bibFile):
+        # Return: the entries of the bibliography in CSL JSON, or None if it cannot be converted
+        import json
+        key = FileCache.key(self.digest(bibFile), self.pandocVersion)
+        indexed = self.cache.get(key, '.json')
+        if not indexed:
+            converted = self.cache.tempfile('.json')
+            if not self.convert(bibFile, converted):
+                os.remove(converted)
+                return None
+            indexed = self.cache.put(key, converted, '.json')
+        with open(indexed, encoding='utf-8') as f:
+            return json.load(f)
+
+    def subset(self, bibFiles, keys):
+        # Select the entries with the given citation keys from the bibliographies (earlier ones take precedence)
+        # Return: the CSL JSON file holding the selected entries, or None if a bibliography cannot be converted
+        import json
+        digests = [self.digest(bibFile) for bibFile in bibFiles]
+        key = FileCache.key('subset', self.pandocVersion, *(digests + sorted(keys)))
+        subsetFile = self.cache.get(key, '.json')
+        if subsetFile:
+            return subsetFile
+        selected = {}
+        for bibFile in bibFiles:
+            entries = self.entries(bibFile)
+            if entries is None:
+                return None
+            for entry in entries:
+                if entry.get('id') in keys and entry['id'] not in selected:
+                    selected[entry['id']] = entry
+        missing = set(keys) - set(selected)
+        if missing:
+            print('* WARNING: citation keys not found in bibliography: ' + ', '.join(sorted(missing)))
+        temp = self.cache.tempfile('.json')
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(list(selected.values()), f, ensure_ascii=False)
+        return self.cache.put(key, temp, '.json')
+
+
+class ImagePipeline:
+    """Derives format-appropriate copies of the document's images, and points the document at them
+
+    Images are downscaled to the target resolution, converted to a format that the target can use (e.g. no TIFF for
+    LaTeX, no EPS for Word) and stripped of their metadata. The derived copies are kept in a cache keyed by the content
+    of the original, so unchanged images are never processed again. Raster images require Pillow; SVG and EPS are
+    converted by rsvg-convert and epstopdf when these are available. Images that cannot be processed are used as-is.
+    """
+
+    # The image profile per target format
+    profiles = {'docx': 'office', 'doc': 'office', 'tex': 'latex', 'pdf': 'latex'}
+    # The raster formats that each profile can use as they are
+    rasterFormats = {'office': ('.png', '.jpg', '.jpeg', '.gif'), 'latex': ('.png', '.jpg', '.jpeg')}
+    # Bump when the derivation changes, to invalidate the cached copies
+    revision = 1
+
+    def __init__(self, cacheDir, dpi=300, width=6.5, searchDirs=()):
+        # dpi, width: the target resolution, and the (text) width in inches that an image can occupy at most
+        self.cache = FileCache(cacheDir, 'images')
+        self.dpi = dpi
+        self.maxPixels = int(dpi * width)
+        self.searchDirs = list(searchDirs)
+        self.warned = False
+
+    def resolve(self, url):
+        # Return: the image file that the url of an image in the document refers to, or None if it is not a local file
+        if ':' in url.split('/')[0][2:]:
+            return None  # e.g. http://
+        for directory in self.searchDirs:
+            if os.path.isfile(os.path.join(directory, url)):
+                return os.path.join(directory, url)
+        return None
+
+    def derive(self, filename, profile):
+        # Return: the path of the derived copy of the image for the given profile, or None to use the original
+        ext = os.path.splitext(filename)[1].lower()
+        key = FileCache.key(FileCache.digest(filename), profile, self.maxPixels, self.revision)
+        for suffix in ('.png', '.jpg', '.pdf', '.none'):
+            cached = self.cache.get(key, suffix)
+            if cached:
+                return None if suffix == '.none' else cached
+        if ext == '.svg' and profile == 'latex':
+            derived = self._convert(['rsvg-convert', '-f', 'pdf', '-o', '{out}', filename], key, '.pdf')
+        elif ext == '.eps' and profile == 'latex':
+            derived = self._convert(['epstopdf', '--outfile={out}', filename], key, '.pdf')
+        elif ext in ('.svg', '.eps', '.pdf', '.ps'):
+            derived = None
+        else:
+            derived = self._raster(filename, profile, key)
+        if derived is None:
+            # Remember that the original is fine (or cannot be improved upon)
+            marker = self.cache.tempfile('.none')
+            self.cache.put(key, marker, '.none')
+        return derived
+
+    def _convert(self, command, key, suffix):
+        out = self.cache.tempfile(suffix)
+        try:
+            subprocess.run([arg.replace('{out}', out) for arg in command], stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, check=True)
+        except (OSError, subprocess.CalledProcessError):
+            os.remove(out)
+            return None
+        return self.cache.put(key, out, suffix)
+
+    def _raster(self, filename, profile, key):
+        try:
+            from PIL import Image
+        except ImportError:
+            if not self.warned:
+                print('* WARNING: Pillow is not installed, hence images are used as they are')
+                self.warned = True
+            return None
+        ext = os.path.splitext(filename)[1].lower()
+        try:
+            with Image.open(filename) as img:
+                needsFormat = ext not in self.rasterFormats[profile]
+                needsScale = max(img.size) > self.maxPixels
+                hasMetadata = bool(img.info.get('exif') or img.getexif() or
+                                   any(k not in ('dpi', 'icc_profile', 'transparency', 'gamma') for k in img.info))
+                if not (needsFormat or needsScale or hasMetadata) or getattr(img, 'is_animated', False):
+                    return None
+                img.load()
+                if needsScale:
+                    img.thumbnail((self.maxPixels, self.maxPixels), Image.LANCZOS)
+                hasAlpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+                if ext in ('.jpg', '.jpeg'):
+                    suffix = '.jpg'
+                elif ext == '.png' or hasAlpha or img.mode in ('1', 'P'):
+                    suffix = '.png'
+                else:
+                    # Photographs (many colours) become JPEG, drawings PNG
+                    sample = img.convert('RGB').resize((64, 64))
+                    suffix = '.jpg' if len(sample.getcolors(64 * 64)) > 256 else '.png'
+                out = self.cache.tempfile(suffix)
+                options = {'dpi': (self.dpi, self.dpi)}
+                if img.info.get('icc_profile'):
+                    options['icc_profile'] = img.info['icc_profile']
+                if suffix == '.jpg':
+                    img.convert('RGB').save(out, 'JPEG', quality=92, optimize=True, **options)
+                else:
+                    if img.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+                        img = img.convert('RGBA' if hasAlpha else 'RGB')
+                    img.save(out, 'PNG', optimize=True, **options)
+        except (OSError, ValueError) as e:
+            print('* WARNING: cannot process image {} ({})'.format(filename, str(e)))
+            return None
+        return self.cache.put(key, out, suffix)
+
+    def deriveAll(self, filenames, profile):
+        # Derive the images concurrently
+        # Return: dict of original file name: derived file name, for the images that have a derived copy
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            derived = pool.map(lambda filename: self.derive(filename, profile), filenames)
+            return {filename: d for filename, d in zip(filenames, derived) if d}
+
+    def rewrite(self, ast, fmt):
+        # Let the images of the document (AST) point at the copies derived for the target format; a filter of the
+        # FilterChain
+        # Return: False if the document has no images that need to be replaced
+        profile = self.profiles.get(fmt)
+        if not profile:
+            return False
+        images = [node for node in astNodes(ast['blocks']) if node['t'] == 'Image']
+        originals = {}
+        for node in images:
+            filename = self.resolve(node['c'][2][0])
+            if filename:
+                originals[node['c'][2][0]] = filename
+        derived = self.deriveAll(sorted(set(originals.values())), profile)
+        replaced = 0
+        for node in images:
+            filename = originals.get(node['c'][2][0])
+            if filename in derived:
+                node['c'][2][0] = os.path.abspath(derived[filename]).replace(os.sep, '/')
+                replaced += 1
+        if not replaced:
+            return False
+        print('* images ({:<5})       : {} of {} replaced by derived copies'.format(fmt, replaced, len(images)))
+        return True
+
+
+# The filters that run in doPandoc's own process (see FilterChain), by the name that --filter gives them, e.g.
+# astFilters['acronyms'] = expandAcronyms for 'doPandoc thesis pdf --filter acronyms'
+astFilters = {}
+
+# The Python filter files that were loaded (see FilterChain.resolve), by path: (modification time, filter)
+filterModules = {}
+
+
+class FilterChain:
+    """Python filters that run in doPandoc's own process, one after the other, on one and the same parsed document
+
+    For each --filter, pandoc writes the whole document as JSON to a new process and parses the result back. The
+    filters of a chain instead share a single tree: the document (pandoc JSON AST) is read once, each filter changes
+    it in place, and the result is written once for the writer. A filter is a function(ast, fmt), where fmt is the
+    target format as pandoc hands it to filters (e.g. 'latex'); it returns a new document (dict), or False when it left
+    the document as it was, and anything else when it changed the document in place.
+    """
+
+    # The format that pandoc hands to filters, per target format
+    filterFormats = {'tex': 'latex', 'pdf': 'latex'}
+
+    def __init__(self, filters=()):
+        # filters: list of (name, function)
+        self.filters = list(filters)
+
+    @staticmethod
+    def resolve(name, searchDirs=('.',)):
+        # Find the in-process filter for a --filter argument: one that is registered in astFilters under that name,
+        # or a Python file (looked up as pandoc does: as given, or in the filters directory of the data directories)
+        # that defines doPandocFilter(ast, fmt) at its top level. The file is parsed, not run, to find out: a common
+        # pandoc filter reads the document from stdin as soon as it is loaded, hence only opted in files are loaded
+        # Return: (function, the file defining it or None), or (None, None) when the filter is left to pandoc
+        import ast
+        import importlib.util
+        if name in astFilters:
+            return astFilters[name], None
+        if not name.endswith('.py'):
+            return None, None
+        for filename in [name] + [os.path.join(d, 'filters', name) for d in searchDirs]:
+            if os.path.isfile(filename):
+                break
+        else:
+            return None, None
+        filename = os.path.abspath(filename)
+        mtime = os.stat(filename).st_mtime_ns
+        if filterModules.get(filename, (None,))[0] != mtime:
+            try:
+                with open(filename, 'rb') as f:
+                    tree = ast.parse(f.read(), filename)
+            except (SyntaxError, ValueError):
+                tree = None  # for pandoc to report
+            if not tree or not any(isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == 'doPandocFilter'
+                                   for node in tree.body):
+                filterModules[filename] = (mtime, None)
+            else:
+                spec = importlib.util.spec_from_file_location('doPandoc_filter_' + FileCache.key(filename)[:12], filename)
+                module = importlib.util.module_from_spec(spec)
+                try:
+                    spec.loader.exec_module(module)
+                except (Exception, SystemExit) as e:
+                    raise InputError('cannot load filter ({!r})'.format(e), filename)
+                filterModules[filename] = (mtime, getattr(module, 'doPandocFilter', None))
+        function = filterModules[filename][1]
+        return (function, filename) if callable(function) else (None, None)
+
+    def run(self, astFile, fmt, outFile):
+        # Apply the filters in turn to the document in astFile, for the given target format, and write it to outFile
+        # Return: True if outFile was written, False if no filter changed the document
+        import json
+        if not self.filters:
+            return False
+        with open(astFile, encoding='utf-8') as f:
+            ast = json.load(f)
+        changed = False
+        for name, function in self.filters:
+            result = function(ast, self.filterFormats.get(fmt, fmt))
+            if isinstance(result, dict):
+                ast = result
+            changed = changed or result is not False
+        if not changed:
+            return False
+        with open(outFile, 'w', encoding='utf-8') as f:
+            json.dump(ast, f)
+        return True
+
+
+def filterArguments(args):
+    # Find the filters among pandoc arguments: -F name, -Fname, --filter name, --filter=name, and --citeproc (-C),
+    # which pandoc runs in the order given among the filters
+    # Return: list of (index, number of arguments, filter name or None for citeproc)
+    found, i = [], 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ('-C', '--citeproc'):
+            found.append((i, 1, None))
+        elif arg[:2] == '-F' and len(arg) > 2:
+            found.append((i, 1, arg[2:]))
+        elif arg.split('=', 1)[0] == '--filter' and '=' in arg:
+            found.append((i, 1, arg.split('=', 1)[1]))
+        elif arg in ('-F', '--filter') and i + 1 < len(args):
+            found.append((i, 2, args[i + 1]))
+            i += 1
+        i += 1
+    return found
+
+
+def citedKeys(texts):
+    # Scan the texts for the citation keys they use, e.g. [@smith04, p. 33; -@doe99] or @smith04 says
+    # Return: the set of keys, or None when all entries are to be included (nocite: '@*')
+    import re
+    keys = set()
+    for text in texts:
+        for key in re.findall(r'(?<![\w@.])-?@([\w][\w:.#$%&+?<>~/-]*)', text):
+            keys.add(key.rstrip('.:;,?/-'))
+        if re.search(r'(?<![\w@.])@\*', text):
+            return None
+    return keys
+
+
+# The metadata blocks parsed by frontMatter(), by the digest of the block
+frontMatters = {}
+
+
+def frontMatter(filename):
+    # Parse the metadata block at the top of the given source once: a YAML-block (from '---' up to '---' or '...') or a
+    # MultiMarkdown metadata block (up to the first empty line). Only the leading part of the file, up to the end of the
+    # block, is read
+    # Return: dict of (lower case) key: value, a string or a list of strings; empty when the source has no metadata block
+    import re
+    head, block = b'', None
+    with open(filename, 'rb') as f:
+        while block is None:
+            chunk = f.read(4096)
+            head += chunk
+            lines = [line.rstrip('\r') for line in head.decode('utf-8', 'replace').lstrip('\ufeff').split('\n')]
+            if chunk:
+                lines = lines[:-1]  # the last line may continue in the next chunk
+            if not lines:
+                block = None if chunk else []
+            elif lines[0].rstrip() == '---':
+                ends = [n for n, line in enumerate(lines[1:], 1) if line.rstrip() in ('---', '...')]
+                block = lines[:ends[0] + 1] if ends else (None if chunk else [])
+            elif re.match(r'^[A-Za-z0-9][\w .-]*:', lines[0]):
+                ends = [n for n, line in enumerate(lines) if not line.strip()]
+                block = lines[:ends[0]] if ends else (None if chunk else lines)
+            else:
+                block = []
+    key = FileCache.key(*block)
+    if key not in frontMatters:
+        frontMatters[key] = parseMetadata(block)
+    return frontMatters[key]
+
+
+def parseMetadata(lines):
+    # Parse the lines of a metadata block (see frontMatter) as far as doPandoc needs it: the top level keys with their
+    # value, a list ('[a, b]', or items on separate '- ' lines) or a string; nested structures are left out
+    # Return: dict of (lower case) key: value
+    import re
+    yaml = bool(lines) and lines[0].rstrip() == '---'
+    meta, key = {}, None
+    for line in (lines[1:-1] if yaml else lines):
+        if yaml and key and re.match(r'^\s*-\s', line):
+            item = line.strip()[1:].strip().strip('\'"')
+            meta[key] = (meta[key] if isinstance(meta[key], list) else []) + [item]
+            continue
+        match = re.match(r'^([^\s:#-][^:]*):(?:\s+(.*))?\s*$', line)
+        if match:
+            key = match.group(1).strip().lower()
+            if not yaml:
+                key = key.replace(' ', '')  # MultiMarkdown ignores spaces in keys
+            value = (match.group(2) or '').strip()
+            if value.startswith('[') and value.endswith(']'):
+                meta[key] = [item.strip().strip('\'"') for item in value[1:-1].split(',') if item.strip()]
+            else:
+                meta[key] = value.strip('\'"')
+        elif not yaml and key and line.strip():
+            meta[key] = (meta[key] + ' ' + line.strip()).strip()  # continuation of a MultiMarkdown value
+        elif yaml and line.strip() and not line.startswith((' ', '\t', '#')):
+            key = None
+    return meta
+
+
+def metadataFiles(meta, key):
+    # Return: the file names under the given key of the metadata (see frontMatter), e.g. 'bibliography', as a list
+    value = meta.get(key) or []
+    return [value] if isinstance(value, str) else value
+
+
+class PandocServerPool:
+    """Pool of long-lived pandoc-server processes on localhost that render jobs without starting pandoc for each of them
+
+    A job is given as the pandoc argument vector that would otherwise be run as a process. Jobs that the server cannot
+    handle (pdf output, external filters, unknown options, or targets such as docx that embed local images, which the
+    server cannot read), and jobs that fail on the server, transparently fall back to running pandoc as a process.
+    """
+
+    # Pandoc options (with a value) and the corresponding pandoc-server request parameter
+    valueOptions = {'-f': 'from', '--from': 'from', '-r': 'from', '--read': 'from', '-t': 'to', '--to': 'to',
+                    '-w': 'to', '--write': 'to', '--top-level-division': 'top-level-division',
+                    '--toc-depth': 'toc-depth', '--shift-heading-level-by': 'shift-heading-level-by',
+                    '--wrap': 'wrap', '--columns': 'columns', '--dpi': 'dpi', '--highlight-style': 'highlight-style',
+                    '--number-offset': 'number-offset', '--reference-location': 'reference-location'}
+    # Pandoc flags and the corresponding (boolean) pandoc-server request parameter
+    flagOptions = {'-N': 'number-sections', '--number-sections': 'number-sections', '-s': 'standalone',
+                   '--standalone': 'standalone', '--toc': 'table-of-contents', '--table-of-contents': 'table-of-contents',
+                   '--reference-links': 'reference-links', '--section-divs': 'section-divs',
+                   '--strip-comments': 'strip-comments', '--ascii': 'ascii', '--listings': 'listings',
+                   '-C': 'citeproc', '--citeproc': 'citeproc'}
+    # Output formats (by extension of the target file) that the server can produce, and whether they are binary
+    outputFormats = {'.tex': ('latex', False), '.docx': ('docx', True), '.odt': ('odt', True), '.html': ('html', False),
+                     '.md': ('markdown', False), '.mmd': ('markdown_mmd', False), '.rtf': ('rtf', False),
+                     '.epub': ('epub', True), '.json': ('json', False)}
+
+    def __init__(self, size=2, timeout=10):
+        # size: the number of server processes to keep warm
+        # timeout: the number of seconds to wait for a server to come up
+        import queue
+        self.servers = []
+        self.idle = queue.Queue()
+        command = self.command()
+        if command:
+            for _ in range(size):
+                server = self._start(command, timeout)
+                if server:
+                    self.servers.append(server)
+                    self.idle.put(server)
+        self.available = len(self.servers) > 0
+
+    @staticmethod
+    def command():
+        # Return: the command that starts a pandoc server, or None if this pandoc cannot act as a server
+        import shutil
+        if shutil.which('pandoc-server'):
+            return ['pandoc-server']
+        try:
+            return ['pandoc', 'server'] if pandocInfo()['server'] else None
+        except (OSError, subprocess.CalledProcessError, ValueError, IndexError, InputError):
+            return None
+
+    @staticmethod
+    def _start(command, timeout):
+        # Start one server on a free local port and wait until it accepts connections
+        # Return: (process, port), or None when it did not come up in time
+        import socket
+        import time
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        try:
+            process = subprocess.Popen(command + ['--port', str(port)], stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL)
+        except OSError:
+            return None
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and process.poll() is None:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+                return process, port
+            except OSError:
+                time.sleep(0.05)
+        process.kill()
+        return None
+
+    def request(self, pArgs):
+        # Translate a pandoc argument vector into a pandoc-server request
+        # Return: (request, target file, binary output), or None if the server cannot handle this job
+        import base64
+        params = {'standalone': True, 'files': {}}
+        target = source = None
+        dataDir = ''
+        variables, metadata = {}, {}
+        i = 1
+        while i < len(pArgs):
+            arg = pArgs[i]
+            option, _, attached = arg.partition('=')
+            takesValue = option in self.valueOptions or option in (
+                '-o', '--output', '--template', '--reference-doc', '--reference-docx', '--data-dir', '-M',
+                '--metadata', '-V', '--variable', '--bibliography', '--csl')
+            if takesValue and not attached:
+                if i + 1 == len(pArgs):
+                    return None
+                i += 1
+                value = pArgs[i]
+            else:
+                value = attached
+            if option in self.valueOptions:
+                params[self.valueOptions[option]] = int(value) if value.lstrip('-').isdigit() else value
+            elif option in self.flagOptions:
+                params[self.flagOptions[option]] = True
+            elif option in ('-o', '--output'):
+                target = value
+            elif option == '--data-dir':
+                dataDir = value
+            elif option in ('--template', '--reference-doc', '--reference-docx'):
+                # The server has no access to our file system; hand it the file
+                name = value if os.path.isfile(value) else os.path.join(dataDir, value)
+                if not os.path.isfile(name):
+                    return None
+                with open(name, 'rb') as f:
+                    content = f.read()
+                if option == '--template':
+                    params['template'] = content.decode('utf-8')
+                else:
+                    params['reference-doc'] = os.path.basename(name)
+                    params['files'][os.path.basename(name)] = base64.b64encode(content).decode('ascii')
+            elif option in ('--bibliography', '--csl'):
+                # Likewise the files for citeproc, under a name of their own
+                if not os.path.isfile(value):
+                    return None
+                with open(value, 'rb') as f:
+                    content = f.read()
+                name = '{}-{}'.format(len(params['files']), os.path.basename(value))
+                params['files'][name] = base64.b64encode(content).decode('ascii')
+                if option == '--csl':
+                    params['csl'] = name
+                else:
+                    params.setdefault('bibliography', []).append(name)
+            elif option in ('-M', '--metadata', '-V', '--variable'):
+                key, _, val = value.partition(':' if ':' in value and '=' not in value else '=')
+                (metadata if option in ('-M', '--metadata') else variables)[key] = val if val else True
+            elif not arg.startswith('-') and source is None:
+                source = arg
+            else:
+                return None  # e.g. --filter: the server does not run external processes
+            i += 1
+        if not (target and source and os.path.isfile(source)):
+            return None
+        ext = os.path.splitext(target)[1].lower()
+        if 'to' not in params:
+            if ext not in self.outputFormats:
+                return None
+            params['to'] = self.outputFormats[ext][0]
+        binary = self.outputFormats.get(ext, (None, False))[1]
+        if variables: params['variables'] = variables
+        if metadata: params['metadata'] = metadata
+        with open(source, encoding='utf-8') as f:
+            params['text'] = f.read()
+        if binary and self.localResources(params['text'], params.get('from', '')):
+            return None  # the target embeds files, e.g. images, that the server cannot read
+        return params, target, binary
+
+    @staticmethod
+    def localResources(text, reader):
+        # Return: True if the document (in the given reader format) refers to images in the local file system
+        import json
+        import re
+        if reader.split('+')[0] == 'json':
+            try:
+                targets = [node['c'][-1][0] for node in astNodes(json.loads(text)) if node['t'] == 'Image']
+            except (ValueError, KeyError, IndexError, TypeError):
+                return True
+        else:
+            targets = re.findall(r'!\[[^\]]*\]\(\s*<?([^)\s>]+)', text)
+            targets += re.findall(r'^\s{0,3}\[[^\]]+\]:\s*<?(\S+)', text, re.MULTILINE)
+            targets += re.findall(r'<img\s[^>]*src=["\']?([^"\'\s>]+)', text, re.IGNORECASE)
+        return any(not re.match(r'^[A-Za-z][\w+.-]*:', target) or target.lower().startswith('file:')
+                   for target in targets)
+
+    def run(self, pArgs):
+        # Render the job on one of the servers, or as a pandoc process when that is not possible
+        # Return: the return code, as pandoc would have returned it
+        job = self.request(pArgs) if self.available else None
+        if job is None:
+            return subprocess.call(pArgs)
+        params, target, binary = job
+        import base64
+        import json
+        import urllib.error
+        import urllib.request
+        process, port = self.idle.get()
+        try:
+            req = urllib.request.Request('http://127.0.0.1:{}/'.format(port), data=json.dumps(params).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json', 'Accept': 'application/json'})
+            with urllib.request.urlopen(req, timeout=600) as response:
+                result = json.loads(response.read().decode('utf-8'))
+        except (OSError, ValueError, urllib.error.URLError):
+            # Server failed (or refused the job): let pandoc itself do the job, and report
+            result = None
+        finally:
+            self.idle.put((process, port))
+        if not isinstance(result, dict) or 'output' not in result:
+            return subprocess.call(pArgs)
+        for message in result.get('messages', []):
+            print('[{}] {}'.format(message.get('verbosity', 'INFO'), message.get('message', message)))
+        output = result['output']
+        with open(target, 'wb') as f:
+            f.write(base64.b64decode(output) if result.get('base64') or binary else output.encode('utf-8'))
+        return 0
+
+    def close(self):
+        for process, _ in self.servers:
+            process.terminate()
+        for process, _ in self.servers:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.servers = []
+        self.available = False
+
+
+class GitRefs:
+    """Read-only access to the refs and the loose objects of a git repository, straight from its .git directory
+
+    This suffices to resolve HEAD and the tags, and to establish the version of HEAD (see Git.version) without running
+    git. Objects are read from the loose objects and the (version 2) packs. Anything out of the ordinary, such as a
+    linked worktree or a merge, is left to git itself.
+    """
+
+    # Our versioning scheme tags commits as 'v<major>.<minor>'
+    versionTag = r'^v(\d+)\.(\d+)$'
+    # The maximum number of commits that is walked in search of the nearest tag
+    maxWalk = 1000
+    # The number of versions that the memo remembers
+    memoSize = 64
+
+    def __init__(self, gitDir):
+        self.gitDir = gitDir
+        self.memoFile = os.path.join(gitDir, 'doPandoc-version.json')
+        self.stateFile = os.path.join(gitDir, 'doPandoc-state.json')
+        self.pushedFile = os.path.join(gitDir, 'doPandoc-pushed.json')
+
+    @classmethod
+    def find(cls, directory='.'):
+        # Return: GitRefs for the repository that holds the given directory, or None if there is none, or when its
+        # .git is not a plain directory (a linked worktree or a submodule)
+        path = os.path.abspath(directory)
+        while True:
+            gitDir = os.path.join(path, '.git')
+            if os.path.isdir(gitDir):
+                return None if os.path.exists(os.path.join(gitDir, 'commondir')) else cls(gitDir)
+            if os.path.exists(gitDir):
+                return None
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    def packedRefs(self):
+        # Return: dict of ref: object id, dict of ref: commit id for the peeled (annotated) tags, and whether all
+        # annotated tags are peeled, as listed in packed-refs
+        refs, peeled, fullyPeeled = {}, {}, False
+        try:
+            with open(os.path.join(self.gitDir, 'packed-refs'), encoding='utf-8') as f:
+                name = None
+                for line in f:
+                    line = line.rstrip('\n')
+                    if line.startswith('#'):
+                        fullyPeeled = 'fully-peeled' in line.split()
+                    elif line.startswith('^'):
+                        if name: peeled[name] = line[1:]
+                    elif line:
+                        oid, _, name = line.partition(' ')
+                        refs[name] = oid
+        except OSError:
+            pass
+        return refs, peeled, fullyPeeled
+
+    def looseRefs(self, prefix):
+        # Return: dict of ref: object id of the loose refs under the given prefix, e.g. 'refs/tags'
+        refs = {}
+        top = os.path.join(self.gitDir, *prefix.split('/'))
+        for root, _, files in os.walk(top):
+            for filename in files:
+                name = prefix + '/' + os.path.relpath(os.path.join(root, filename), top).replace(os.sep, '/')
+                try:
+                    with open(os.path.join(root, filename), encoding='utf-8') as f:
+                        refs[name] = f.read().strip()
+                except OSError:
+                    pass
+        return refs
+
+    def ref(self, name):
+        # Return: the object id that the given ref (e.g. 'HEAD' or 'refs/heads/master') resolves to, or None
+        for _ in range(5):  # follow symbolic refs
+            try:
+                with open(os.path.join(self.gitDir, *name.split('/')), encoding='utf-8') as f:
+                    value = f.read().strip()
+            except OSError:
+                return self.packedRefs()[0].get(name)
+            if not value.startswith('ref: '):
+                return value or None
+            name = value[5:]
+        return None
+
+    # The types of the objects in a pack, by their number
+    packTypes = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+
+    def packs(self):
+        # Return: list of (index, pack) of the packs in the repository, both memory mapped, mapped on first use
+        import mmap
+        if getattr(self, '_packs', None) is None:
+            self._packs = []
+            packDir = os.path.join(self.gitDir, 'objects', 'pack')
+            for name in sorted(os.listdir(packDir)) if os.path.isdir(packDir) else []:
+                if not name.endswith('.idx') or not os.path.isfile(os.path.join(packDir, name[:-4] + '.pack')):
+                    continue
+                try:
+                    with open(os.path.join(packDir, name), 'rb') as f:
+                        index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    with open(os.path.join(packDir, name[:-4] + '.pack'), 'rb') as f:
+                        pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    continue
+                if index[:8] == b'\377tOc\0\0\0\2':  # only version 2 indexes, as git writes them
+                    self._packs.append((index, pack))
+        return self._packs
+
+    @staticmethod
+    def packOffset(index, oid):
+        # Return: the offset of the given object in the pack of the given (version 2) index, or None if it is not there
+        import struct
+        name = bytes.fromhex(oid)
+        size = len(name)
+        count = struct.unpack_from('>I', index, 8 + 255 * 4)[0]
+        low = struct.unpack_from('>I', index, 8 + (name[0] - 1) * 4)[0] if name[0] else 0
+        high = struct.unpack_from('>I', index, 8 + name[0] * 4)[0]
+        names = 8 + 256 * 4
+        while low < high:
+            middle = (low + high) // 2
+            found = index[names + middle * size:names + (middle + 1) * size]
+            if found < name:
+                low = middle + 1
+            elif found > name:
+                high = middle
+            else:
+                offsets = names + count * (size + 4)
+                offset = struct.unpack_from('>I', index, offsets + middle * 4)[0]
+                if offset & 0x80000000:
+                    offset = struct.unpack_from('>Q', index, offsets + count * 4 + (offset & 0x7fffffff) * 8)[0]
+                return offset
+        return None
+
+    def packed(self, pack, offset, hashSize=20, depth=0):
+        # Return: the type and content of the object at the given offset in the pack, its deltas applied
+        # hashSize: the size of the object names in bytes (20 for SHA-1, 32 for SHA-256)
+        import zlib
+        byte = pack[offset]
+        kind, size, shift, pos = (byte >> 4) & 7, byte & 15, 4, offset + 1
+        while byte & 0x80:
+            byte = pack[pos]
+            size |= (byte & 0x7f) << shift
+            shift, pos = shift + 7, pos + 1
+        base = None
+        if kind == 6:  # delta against the object at a relative offset
+            byte = pack[pos]
+            relative, pos = byte & 0x7f, pos + 1
+            while byte & 0x80:
+                byte = pack[pos]
+                relative, pos = ((relative + 1) << 7) | (byte & 0x7f), pos + 1
+            base = self.packed(pack, offset - relative, hashSize, depth + 1)
+        elif kind == 7:  # delta against the object with the given name
+            base = self.raw(pack[pos:pos + hashSize].hex(), depth + 1)
+            pos += hashSize
+        decompressor = zlib.decompressobj()
+        data = b''
+        while not decompressor.eof and pos < len(pack):
+            data += decompressor.decompress(pack[pos:pos + 65536])
+            pos += 65536
+        if base is None:
+            return self.packTypes.get(kind), data
+        if base[0] is None or depth > 50:
+            return None, None
+        return base[0], self.applyDelta(base[1], data)
+
+    @staticmethod
+    def applyDelta(base, delta):
+        # Return: the object that results from applying the (git pack) delta to the base object
+        def varint(pos):
+            value = shift = 0
+            while True:
+                byte = delta[pos]
+                value, shift, pos = value | (byte & 0x7f) << shift, shift + 7, pos + 1
+                if not byte & 0x80:
+                    return value, pos
+        _, pos = varint(0)  # the size of the base
+        _, pos = varint(pos)  # the size of the result
+        result = bytearray()
+        while pos < len(delta):
+            opcode = delta[pos]
+            pos += 1
+            if opcode & 0x80:  # copy from the base
+                start = length = 0
+                for n in range(4):
+                    if opcode & (1 << n):
+                        start, pos = start | delta[pos] << (8 * n), pos + 1
+                for n in range(3):
+                    if opcode & (0x10 << n):
+                        length, pos = length | delta[pos] << (8 * n), pos + 1
+                result += base[start:start + (length or 0x10000)]
+            elif opcode:  # insert the next bytes
+                result += delta[pos:pos + opcode]
+                pos += opcode
+        return bytes(result)
+
+    def raw(self, oid, depth=0):
+        # Return: the type and content of the given object, loose or packed, or None, None when it cannot be read
+        import zlib
+        try:
+            with open(os.path.join(self.gitDir, 'objects', oid[:2], oid[2:]), 'rb') as f:
+                data = zlib.decompress(f.read())
+            header, _, content = data.partition(b'\0')
+            return header.split(b' ')[0].decode('ascii'), content
+        except (OSError, ValueError, zlib.error):
+            pass
+        try:
+            for index, pack in self.packs():
+                offset = self.packOffset(index, oid)
+                if offset is not None:
+                    return self.packed(pack, offset, len(oid) // 2, depth)
+        except (ValueError, IndexError, zlib.error):
+            pass
+        return None, None
+
+    def object(self, oid):
+        # Return: the type (str) and the header lines (list of (key, value)) of the given object, or None, None when it
+        # cannot be read
+        kind, content = self.raw(oid)
+        if kind is None:
+            return None, None
+        lines = []
+        for line in content.split(b'\n'):
+            if not line:
+                break
+            key, _, value = line.decode('utf-8', 'replace').partition(' ')
+            lines.append((key, value))
+        return kind, lines
+
+    def tags(self):
+        # Return: dict of commit id: the names of the tags on that commit, or None if a tag cannot be resolved in-process
+        packed, peeled, fullyPeeled = self.packedRefs()
+        refs = {name: oid for name, oid in packed.items() if name.startswith('refs/tags/')}
+        loose = self.looseRefs('refs/tags')
+        refs.update(loose)
+        tags = {}
+        for name, oid in refs.items():
+            if name not in loose and name in peeled:
+                oid = peeled[name]
+            elif name in loose or not fullyPeeled:
+                # Peel annotated tags down to their commit
+                for _ in range(5):
+                    kind, lines = self.object(oid)
+                    if kind != 'tag':
+                        break
+                    oid, kind = dict(lines).get('object'), dict(lines).get('type')
+                    if kind == 'commit':
+                        break
+                if kind != 'commit':
+                    return None
+            tags.setdefault(oid, []).append(name[len('refs/tags/'):])
+        return tags
+
+    def tagStamp(self):
+        # Return: a digest that changes whenever a tag is added, moved or removed
+        stamp = sorted(self.looseRefs('refs/tags').items())
+        try:
+            st = os.stat(os.path.join(self.gitDir, 'packed-refs'))
+            stamp.append((st.st_size, st.st_mtime_ns))
+        except OSError:
+            pass
+        return FileCache.key(*stamp)
+
+    def memo(self):
+        # Return: the versions of commits (commit id: [major, minor, commits]) established earlier, as far as the tags
+        # did not change since
+        import json
+        try:
+            with open(self.memoFile, encoding='utf-8') as f:
+                memo = json.load(f)
+            return memo['versions'] if memo['tags'] == self.tagStamp() else {}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def remember(self, oid, version):
+        # Store the version (major, minor, commits) of the given commit in the memo, which keeps the latest ones only
+        import json
+        versions = self.memo()
+        versions.pop(oid, None)
+        versions[oid] = list(version)
+        versions = dict(list(versions.items())[-self.memoSize:])
+        try:
+            temp = tempName(self.memoFile)
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump({'tags': self.tagStamp(), 'versions': versions}, f)
+            os.replace(temp, self.memoFile)
+        except OSError:
+            pass
+
+    def tagsPushed(self):
+        # Return: True if the tags did not change since the last push by doPandoc (see rememberPushed)
+        import json
+        try:
+            with open(self.pushedFile, encoding='utf-8') as f:
+                return json.load(f)['tags'] == self.tagStamp()
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+    def rememberPushed(self):
+        # Remember that the tags, as they are now, were pushed
+        import json
+        try:
+            temp = tempName(self.pushedFile)
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump({'tags': self.tagStamp()}, f)
+            os.replace(temp, self.pushedFile)
+        except OSError:
+            pass
+
+    def refStamp(self):
+        # Return: a digest that changes whenever HEAD, a branch, a remote branch or a tag moves, or the configuration (e.g.
+        # the remotes) changes
+        stamp = [self.ref('HEAD')] + sorted(self.looseRefs('refs').items())
+        for name in ('HEAD', 'packed-refs', 'config'):
+            try:
+                st = os.stat(os.path.join(self.gitDir, name))
+                stamp.append((name, st.st_size, st.st_mtime_ns, st.st_ino))
+            except OSError:
+                pass
+        return FileCache.key(*stamp)
+
+    def _loadState(self):
+        import json
+        try:
+            with open(self.stateFile, encoding='utf-8') as f:
+                memo = json.load(f)
+            return memo['stamp'], memo['state']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, {}
+
+    def stateMemo(self):
+        # Return: the stamp of the refs as they are now (see refStamp), and the repository state (see Git.state) that was
+        # remembered for them, which is empty when they moved since
+        stamp = self.refStamp()
+        stored, state = self._loadState()
+        return stamp, state if stored == stamp else {}
+
+    def rememberState(self, stamp, **entries):
+        # Store the given entries of the repository state (e.g. snapshot=...) in the memo, for the refs as they were when
+        # these were established, i.e., the given stamp
+        import json
+        stored, state = self._loadState()
+        state = dict(state if stored == stamp else {}, **entries)
+        try:
+            temp = tempName(self.stateFile)
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump({'stamp': stamp, 'state': state}, f)
+            os.replace(temp, self.stateFile)
+        except OSError:
+            pass
+
+    def version(self):
+        # Establish the version of HEAD: the nearest version tag and the number of commits on top of it, as
+        # 'git describe --tags' would
+        # Return: (major, minor, commits), or None when this cannot be established in-process
+        import re
+        head = self.ref('HEAD')
+        if not head:
+            return None
+        versions = self.memo()
+        if head in versions:
+            return tuple(versions[head])
+        tags = self.tags()
+        if tags is None:
+            return None
+        oid, commits = head, 0
+        while commits <= self.maxWalk:
+            if oid in tags:
+                found = [re.match(self.versionTag, tag) for tag in tags[oid]]
+                if not all(found):
+                    return None  # the nearest tag is not ours
+                major, minor = max((int(m.group(1)), int(m.group(2))) for m in found)
+                break
+            if oid in versions:
+                major, minor, previous = versions[oid]
+                commits += previous
+                break
+            kind, lines = self.object(oid)
+            parents = [value for key, value in lines or [] if key == 'parent']
+            if kind != 'commit' or len(parents) != 1:
+                return None
+            oid = parents[0]
+            commits += 1
+        else:
+            return None
+        self.remember(head, (major, minor, commits))
+        return major, minor, commits
+
+
+class StageIndex:
+    """The size, modification time and inode of the textual assets of the project at the last commit
+
+    Comparing these with the assets as they are now tells which assets changed, without reading any of them; only those
+    are staged, and nothing is committed when none changed (see Git.commit). The same is kept of the other files that
+    git tracks, which tells, as long as git's index is as it was then, that none of these changed either.
+    """
+
+    def __init__(self, gitDir):
+        self.file = os.path.join(gitDir, 'doPandoc-stage.json')
+        self.indexFile = os.path.join(gitDir, 'index')
+        self.record = None
+
+    @classmethod
+    def find(cls):
+        # Return: the StageIndex of the repository in the current working directory, or None if it cannot hold one
+        refs = GitRefs.find()
+        return cls(refs.gitDir) if refs else None
+
+    @staticmethod
+    def scan(pathspecs):
+        # Return: dict of file: [mtime, size, inode] of the files that the given pathspecs (as in Git.stagePaths) match;
+        # as in git, a '*' also matches the files in sub directories
+        import fnmatch
+        files = {}
+        for pathspec in pathspecs:
+            top, pattern = os.path.split(pathspec)
+            for root, _, names in os.walk(top):
+                for name in names:
+                    path = os.path.join(root, name)
+                    if fnmatch.fnmatchcase(os.path.relpath(path, top).replace(os.sep, '/'), pattern):
+                        files[path.replace(os.sep, '/')] = StageIndex.stat(path)
+        return files
+
+    @staticmethod
+    def stat(path):
+        # Return: [mtime, size, inode] of the given file, or None if there is none
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+    def stored(self):
+        # Return: the record of the last commit (empty before the first): the stats of its 'assets' and, if known, of the
+        # other 'tracked' files and of git's 'index' at the time
+        import json
+        try:
+            with open(self.file, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def changes(self, pathspecs):
+        # Establish the assets as they are now, and compare them with those at the last commit
+        # Return: the list of new and changed files, and the list of removed files
+        self.record = self.scan(pathspecs)
+        stored = self.stored().get('assets', {})
+        changed = [f for f, stat in self.record.items() if stored.get(f) != stat]
+        removed = [f for f in stored if f not in self.record]
+        return changed, removed
+
+    def trackedUnchanged(self):
+        # Return: whether the tracked files other than the assets are as they were at the last commit, or None if this
+        # cannot be told without git, i.e., when git's index changed since (e.g. by a commit outside doPandoc)
+        stored, index = self.stored(), self.stat(self.indexFile)
+        if 'tracked' not in stored or not index or stored['index'] != index[:2]:
+            return None
+        return all(self.stat(path) == stat for path, stat in stored['tracked'].items())
+
+    def save(self, tracked):
+        # Store the assets as they were established by changes(), after they have been committed
+        # tracked: the files that git tracks (see Git.trackedFiles), of which those other than the assets are stored along
+        import json
+        if self.record is None:
+            return
+        index = self.stat(self.indexFile)
+        record = {'assets': self.record, 'tracked': {path: self.stat(path) for path in tracked if path not in self.record},
+                  'index': index[:2] if index else None}
+        temp = tempName(self.file)
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(record, f)
+        os.replace(temp, self.file)
+
+
 class Git:
     # represents the handle to the operating system calls to address any git command for this.
+    # The state of the repository (branch, upstream, ahead/behind) is read by a single git call into a
+    # snapshot, which is kept until an operation that changes the repository invalidates it (see state())
+
+    # The paths holding the textual assets of the project, staged by commit(); '{project}' is the Scrivener project
+    # The version of git, once asked for (see programVersion)
+    gitVersion = None
 
-    def __init__(self, project=None):
+    stagePaths = ['{project}.scriv/Files/Docs/*.rtf', '{project}.scriv/Files/Docs/*_synopsis.txt',
+                  '{project}.scriv/Files/Docs/*.comments', '{project}.scriv/Settings/*', '{project}.scriv/Snapshots/*',
+                  'src/*', 'templates/*']
+
+    def __init__(self, project=None, trace=None):
         assert project, "Git requires a project name, got none"
         self.project = project
+        self.trace = trace or Trace()
+        self.snapshot = None
+        self.remote_url = None
         # Check use of git, if not, initialise git
         try:
-            result = subprocess.run(args=['git', 'status'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
-                                    check=True)
+            self.state()
         except subprocess.CalledProcessError as e:
-            assert "Not a git repository" in str(e.stderr), "gitCommit: unknown exception thrown, quitting ({})".format(
+            assert "not a git repository" in str(e.stderr).lower(), "gitCommit: unknown exception thrown, quitting ({})".format(
                 str(e.stderr))
             self.init()
 
+    @staticmethod
+    def run(*args, input=None, env=None):
+        # Run one git command, without a shell, in the current working directory
+        # input: the bytes to feed git on stdin, if any
+        # env: environment variables to set for git, if any
+        # Return: the output of git (str); raises subprocess.CalledProcessError on failure
+        return subprocess.run(args=['git'] + list(args), input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              env=dict(os.environ, **env) if env else None, check=True).stdout.decode('utf-8').rstrip()
+
+    @classmethod
+    def programVersion(cls):
+        # Return: the version of git as a tuple of numbers, e.g. (2, 39, 5); git is asked once per process
+        import re
+        if cls.gitVersion is None:
+            out = subprocess.run(['git', '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 check=True).stdout.decode('utf-8')
+            cls.gitVersion = tuple(int(n) for n in re.findall(r'\d+', out.split()[2])[:3])
+        return cls.gitVersion
+
+    @staticmethod
+    def files(revision, paths):
+        # Read files as they are in the given revision (e.g. a tag), by a single 'git cat-file' for all of them
+        # paths: relative to the current working directory
+        # Return: list of the contents (bytes) of the files, None for the files that the revision does not have
+        prefix = Git.run('rev-parse', '--show-prefix')
+        request = ''.join('{}:{}\n'.format(revision, os.path.normpath(os.path.join(prefix, path)).replace(os.sep, '/'))
+                          for path in paths)
+        out = subprocess.run(args=['git', 'cat-file', '--batch'], input=request.encode('utf-8'),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+        contents, pos = [], 0
+        for _ in paths:
+            end = out.index(b'\n', pos)
+            header = out[pos:end].split()
+            pos = end + 1
+            if len(header) != 3:
+                contents.append(None)  # '<name> missing'
+                continue
+            size = int(header[2])
+            contents.append(out[pos:pos + size] if header[1] == b'blob' else None)  # None if not a file, e.g. a tree
+            pos += size + 1
+        return contents
+
+    def state(self):
+        # Return: the snapshot of the repository state, read from 'git status --porcelain=v2 --branch' when there is none:
+        # dict with 'oid' (of HEAD, None before the first commit), 'current' (the branch, None when detached),
+        # 'upstream' (None when not tracking), and 'ahead' and 'behind' (commits). Untracked files are not looked for
+        # Note: the snapshot is remembered under .git (see GitRefs.stateMemo) until a ref moves, hence a later run on
+        # the same commit takes it from there without running git
+        if self.snapshot is None:
+            refs = GitRefs.find()
+            stamp, memo = refs.stateMemo() if refs else (None, {})
+            if 'snapshot' in memo:
+                self.snapshot = dict(memo['snapshot'])
+                if 'branches' in memo:
+                    self.snapshot['branches'] = {br: br for br in memo['branches']}
+                return self.snapshot
+            snapshot = {'oid': None, 'current': None, 'upstream': None, 'ahead': 0, 'behind': 0}
+            # Without optional locks, status leaves git's index as it is, which tells StageIndex that nothing changed
+            # (a git older than 2.15 passes over the variable)
+            for line in self.run('status', '--porcelain=v2', '--branch', '--untracked-files=no',
+                                 env={'GIT_OPTIONAL_LOCKS': '0'}).splitlines():
+                if not line.startswith('# '):
+                    continue  # a changed file
+                key, _, value = line[2:].partition(' ')
+                if key == 'branch.oid' and value != '(initial)':
+                    snapshot['oid'] = value
+                elif key == 'branch.head' and value != '(detached)':
+                    snapshot['current'] = value
+                elif key == 'branch.upstream':
+                    snapshot['upstream'] = value
+                elif key == 'branch.ab':
+                    ahead, behind = value.split()
+                    snapshot['ahead'], snapshot['behind'] = int(ahead), -int(behind)
+            self.snapshot = snapshot
+            if refs:
+                refs.rememberState(stamp, snapshot=snapshot)
+        return self.snapshot
+
+    def invalidate(self):
+        # Forget the snapshot of the repository state; to be called after each operation that changes the repository
+        self.snapshot = None
+
     def init(self):
         print("* ** Initializing local git ...")
         try:
-            result = subprocess.run(args=['git', 'init'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
-                                    check=True)
+            self.run('init')
         except subprocess.CalledProcessError as e:
             raise NotImplementedError(
                 "Error initializing git: ({}) - git not used, hence no versioning".format(e.stdout))
+        self.invalidate()
         # Do first commit
         major = minor = 0
         msg = "Project initiated in git, first commit"
@@ -149,15 +1937,22 @@ class Git:
     def getUrl(self):
         # Assess whether a git server has been configured.
         # Return: the url of the configured git server, or None if not configured
-        if not hasattr(self, 'remote_url'):
+        if self.remote_url is None:
+            refs = GitRefs.find()
+            stamp, memo = refs.stateMemo() if refs else (None, {})
+            if 'remote' in memo:
+                self.remote_url = memo['remote']
+                return self.remote_url
             try:
-                result = subprocess.run(args=['git', 'remote', 'get-url', 'origin'], stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE, shell=True, check=True).stdout.decode('ascii').rstrip()
-                self.remote_url = result
+                self.remote_url = self.run('remote', 'get-url', 'origin')
             except subprocess.CalledProcessError as e:
-                assert ("Not a git repository" in str(e.stderr)) or ("No such remote 'origin'" in str(
+                assert ("not a git repository" in str(e.stderr).lower()) or ("No such remote 'origin'" in str(
                     e.stderr)), "gitCommit: unknown exception thrown, quitting ({})".format(str(e.stderr))
+                if refs:
+                    refs.rememberState(stamp, remote=None)
                 return None
+            if refs:
+                refs.rememberState(stamp, remote=self.remote_url)
         return self.remote_url
 
     def askUrl(self):
@@ -217,36 +2012,47 @@ class Git:
         # * True otherwise, i.e., version tag is applied successfully
         assert msg, "gitCommit(): Require useful message, got None"
 
-        # Stage (add) the changes to git
-        try:
-            result = subprocess.run(args=['git', 'add', self.project + '.scriv/Files/Docs/*.rtf'],
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, check=True)
-            result = subprocess.run(args=['git', 'add', self.project + '.scriv/Files/Docs/*_synopsis.txt'],
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, check=True)
-            result = subprocess.run(args=['git', 'add', self.project + '.scriv/Files/Docs/*.comments'],
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, check=True)
-            result = subprocess.run(args=['git', 'add', self.project + '.scriv/Settings/*'], stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE, shell=True, check=True)
-            result = subprocess.run(args=['git', 'add', self.project + '.scriv/Snapshots/*'], stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE, shell=True, check=True)
-            result = subprocess.run(args=['git', 'add', 'src/*'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                    shell=True, check=True)
-            result = subprocess.run(args=['git', 'add', 'templates/*'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                    shell=True, check=True)
-            result = subprocess.run(args=['git', 'add', '-u'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                    shell=True, check=True)
+        # Stage (add) the new textual assets to git in one go; the changes to tracked files are staged by the commit (-a).
+        # A pathspec in a directory that does not exist would fail the whole add, hence these are left out
+        pathspecs = [p.format(project=self.project) for p in self.stagePaths]
+        pathspecs = [p for p in pathspecs if os.path.isdir(os.path.dirname(p))]
+        stageIndex = StageIndex.find()
+        try:
+            if stageIndex:
+                # Only the assets that changed since the last commit are staged, if any
+                with self.trace.phase('git add'):
+                    changed, removed = stageIndex.changes(pathspecs)
+                    # Other tracked files that changed are committed (-a) as well; git is asked about these only when
+                    # their stats at the last commit do not tell
+                    if not changed and not removed:
+                        unchanged = stageIndex.trackedUnchanged()
+                        if unchanged is None and not self.run('status', '--porcelain', '--untracked-files=no'):
+                            stageIndex.save(self.trackedFiles())
+                            unchanged = True
+                        if unchanged:
+                            print("* Branch is up-to-date, hence maintaining current version and same commit ({}).".format(
+                                self.version(True)))
+                            return False
+                    if changed:
+                        self.stage(changed)
+            elif pathspecs:
+                with self.trace.phase('git add'):
+                    self.run('add', '--', *pathspecs)
         except subprocess.CalledProcessError as e:
+            self.invalidate()
             print("* git staging error: ({}) - maintaining current version ({}).".format(e.stderr.decode('ascii'),
                                                                                          self.version(True)))
             return False
 
         # Commit the changes to head, use commit message
         try:
-            result = subprocess.run(args=['git', 'commit', '-m"' + msg + '"'], stdin=None, input=None,
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, timeout=None,
-                                    check=True)
+            with self.trace.phase('git commit'):
+                self.run('commit', '-a', '-m', msg)
         except subprocess.CalledProcessError as e:
-            if ("nothing added to commit" in str(e.stdout)) or ("Your branch is up-to-date with" in str(e.stdout)):
+            self.invalidate()
+            if ("nothing added to commit" in str(e.stdout)) or ("nothing to commit" in str(e.stdout)):
+                if stageIndex:
+                    stageIndex.save(self.trackedFiles())  # e.g., only ignored files changed
                 print("* Branch is up-to-date, hence maintaining current version and same commit ({}).".format(
                     self.version(True)))
                 return False
@@ -255,29 +2061,55 @@ class Git:
                     "* WARNING: git local commit error: ({})\n*\tMaintaining current version and same commit ({}).".format(
                         e.stderr.decode('ascii'), self.version(True)))
                 return False
+        self.invalidate()
+        if stageIndex:
+            stageIndex.save(self.trackedFiles())
         # On use of versioning (i.e. major and minor have an actual value) and new version is eminent, tag Head with version
         if major and minor:
             try:
-                return self.tagHead(major, minor) == "v" + str(major) + "." + str(minor)
+                with self.trace.phase('git tag'):
+                    return self.tagHead(major, minor) == "v" + str(major) + "." + str(minor)
             except subprocess.CalledProcessError as e:
                 print("Caught an exception during tagging: watskebeurt??")
                 if not ("fatal: tag " + "'v" + str(major) + "." + str(minor) + "' already exists" in str(e.stdout)):
                     return False
         return True
 
-    def push(self):
+    def trackedFiles(self):
+        # Return: the files that git tracks in the whole repository, relative to the current working directory
+        return [path for path in self.run('ls-files', '-z', '--', ':/').split('\0') if path]
+
+    def stage(self, files):
+        # Stage the given files in one go, however many there are; files that are ignored by git are passed over. Git
+        # 2.25 and newer read them from stdin; an older git gets them in chunks that fit on a command line
+        if self.programVersion() >= (2, 25):
+            chunks = [(['--pathspec-from-file=-', '--pathspec-file-nul'], '\0'.join(files).encode('utf-8'))]
+        else:
+            chunks = [[]]
+            for f in files:
+                if chunks[-1] and len(' '.join(chunks[-1] + [f])) > default['gitCommandLength']:
+                    chunks.append([])
+                chunks[-1].append(f)
+            chunks = [(['--'] + chunk, None) for chunk in chunks]
+        for args, input in chunks:
+            try:
+                self.run('--literal-pathspecs', 'add', *args, input=input)
+            except subprocess.CalledProcessError as e:
+                if not (e.returncode == 1 and b'ignored by one of your .gitignore files' in e.stderr):
+                    raise
+
+    def push(self, queue=False):
         # Push the local git commits to the remote repository
-        # return: True on success, False when not pushed (deliberately or on fault)
+        # queue: hand the push to a detached helper (see PushQueue) instead of waiting for the remote
+        # return: True on success (or when queued), False when not pushed (deliberately or on fault)
         if not self.getUrl():
             # No remote repository yet, create one
             remote_url = self.askUrl()
             if remote_url:
                 # The remote server was just introduced, hence add origin to remote
                 try:
-                    result = subprocess.run(args=['git', 'remote', 'add', 'origin', remote_url + '/' + project],
-                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, check=True)
-                    result = subprocess.run(args=['git', 'push', '--set-upstream', 'origin', 'master'],
-                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, check=True)
+                    self.run('remote', 'add', 'origin', remote_url + '/' + self.project)
+                    self.run('push', '--set-upstream', 'origin', 'master')
                 except subprocess.CalledProcessError as e:
                     print(
                         "* git: cannot add origin to remote, or add upstream (tracking) reference ({}) - remote git not used".format(
@@ -285,23 +2117,33 @@ class Git:
                     # Clear the remote url reference and return false
                     self.remote_url = None
                     return False
+                finally:
+                    self.invalidate()
             else:
                 # User chose local git only
                 return False
         # Here, a new remote server may just have been setup. Or, we already had a remote server. Then, do the actual push.
         if self.getUrl():
+            state = self.state()
+            refs = GitRefs.find()
+            pushQueue = PushQueue.find() if queue and state['current'] else None
+            if pushQueue:
+                pushQueue.report()
+            # A tag made since the last push (or one that we cannot tell about) is pushed even if the branch is not ahead
+            if state['upstream'] and not state['ahead'] and refs and refs.tagsPushed():
+                print("* nothing to push to server ({})".format(self.getUrl()))
+                return True
+            if pushQueue:
+                pushQueue.add(self.project, state['current'])
+                pushQueue.start()
+                print("* push queued for server ({}); see 'doPandoc push-queue'".format(self.getUrl()))
+                return True
             print("* pushing commit to server ({})".format(self.getUrl()))
             try:
-                result = subprocess.run(args=['git', 'push', '--follow-tags'], stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE, shell=True, check=True)
+                self.pushBranch(state['current'])
                 return True
             except subprocess.CalledProcessError as e:
-                if str(e.stderr).find(
-                        "fatal: The current branch '" + self.getBranches()['current'] + "' has no upstream branch") > 0:
-                    result = subprocess.run(
-                        args=['git', 'push', '--set-upstream', 'origin', self.getBranches()['current']],
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, check=True)
-                elif str(e.stderr).find("fatal: unable to access") > 0:
+                if str(e.stderr).find("fatal: unable to access") > 0:
                     # Push returned error: GIT CANNOT ACCESS THE REMOTE REPOSITORY, aither because it has not yet been
                     # assume (i) we are offline, and (ii) synchronisation will happen next time
                     print("* WARNING: {}.\nNot connected? Try next time".format(e.stderr.decode('ascii')))
@@ -309,14 +2151,33 @@ class Git:
                     raise NotImplementedError(e.stderr)
         return False
 
+    def pushBranch(self, branch=None):
+        # Push the given branch (by default the current one) and its tags to origin, and have the branch track its
+        # remote branch if it does not yet; raises subprocess.CalledProcessError on failure
+        state = self.state()
+        try:
+            if branch is None or (branch == state['current'] and state['upstream']):
+                self.run('push', '--follow-tags')
+            else:
+                self.run('push', '--follow-tags', '--set-upstream', 'origin', branch)
+        finally:
+            self.invalidate()
+        refs = GitRefs.find()
+        if refs:
+            refs.rememberPushed()
+
     def version(self, concat=False):
         # Establish tag (=version), hash and commits on top of current version
         # return either concatenated version; or the three version parts major, minor, commits; or None if git not found or unexpected versioning scheme
         # Note: when no versioning is found, our versioning scheme 'v<major>.<minor>-<commits>' will be initialised
-		import re
+        import re
+        refs = GitRefs.find()
+        found = refs.version() if refs else None
+        if found:
+            major, minor, commits = found
+            return 'v{}.{}-{}'.format(major, minor, commits) if concat else found
         try:
-            root = subprocess.run(args=['git', 'describe', '--tags', '--long', '--always'], stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE, shell=True, check=True).stdout.decode('ascii').rstrip()
+            root = self.run('describe', '--tags', '--long', '--always')
         except subprocess.CalledProcessError as e:
             # Apparently git is not used
             print("* git not used ({})".format(e.stderr.decode('ascii')))
@@ -327,17 +2188,18 @@ class Git:
                 tag, commits, hash = root.split('-')
                 if (tag[0] == 'v') and (tag[1:].count('.') == 1):
                     major, minor = tag[1:].split('.')
+                    if refs and refs.ref('HEAD'):
+                        refs.remember(refs.ref('HEAD'), (int(major), int(minor), int(commits)))
                 else:
                     print("WARNING: tag expected in major.minor format (our specific versioning), found unexpected format: {}".format(tag))
                     return None
-			else:
+            else:
                 print("WARNING: git's default tag-commits-hash format expected, found unexpected format: {}".format(root))
                 return None
         else:
             # Enforce our versioning scheme by initializing it with v0.0-curr_commits
             major = minor = '0'
-            commits = subprocess.run(args=['git', 'rev-list', 'HEAD', '--count'], stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE, shell=True, check=True).stdout.decode('ascii').rstrip()
+            commits = self.run('rev-list', 'HEAD', '--count')
             print("* ** init versioning ({})".format(self.tagHead(major, minor)))
         if concat:
             return 'v' + major + '.' + minor + '-' + commits
@@ -349,7 +2211,8 @@ class Git:
         # * V: the incremented version, based on the requested level, either concatenated as "v<major>.<minor>-<commits>" or all three seperately
         # * P: the previous version, concatenated as "v<major>.<minor>-<commits>"
         # * or None on failure
-        major, minor, commits = self.version()
+        with self.trace.phase('version'):
+            major, minor, commits = self.version()
         if not (major or minor or commits):  # Apparently no git usage yet
             print("INFORM: No GIT repository found, hence no versioning applied")
             return (None, None) if concat else (None, None, None, None)
@@ -385,9 +2248,8 @@ class Git:
         tag = 'v' + str(major) + '.' + str(minor)
         tagMsg = 'Version ' + tag
         try:
-            result = subprocess.run(args=['git', 'tag', '-a', tag, '-m "' + tagMsg + '"'], stdin=None, input=None,
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, timeout=None,
-                                    check=True).stderr.decode('ascii').rstrip()
+            result = subprocess.run(args=['git', 'tag', '-a', tag, '-m', tagMsg], stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, check=True).stderr.decode('ascii').rstrip()
             if result:
                 print("INFO: taghead = {}".format(result))
                 return None
@@ -400,47 +2262,34 @@ class Git:
                 return None
 
     def getBranches(self):
-        # Return the current branch
-        if not hasattr(self, 'branches'):
-            self.branches = {}
+        # Return: dict of the local branches (name: name), with the current branch as 'current'
+        state = self.state()
+        if 'branches' not in state:
+            refs = GitRefs.find()
+            stamp = refs.refStamp() if refs else None
+            state['branches'] = {}
             # Assume no issues to result from this call. If it does, we probably want to abort anyway. Make further distinction to errors through Try/Except if required.
-            result = subprocess.run(args=['git', 'branch'], stdin=None, input=None, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE, shell=True, timeout=None, check=True).stdout.decode(
-                'ascii').rstrip()
-            for br in result.splitlines():
-                if br[0] == '*':
-                    self.branches['current'] = br[2:]
-                #					print("debug: * ({})".format(self.branches['current']))
-                else:
-                    self.branches[br[2:]] = br[2:]
-        #					print("debug:   ({})".format(self.branches[br[2:]]))
-        return self.branches
-
-    def addBranch(self, branch, current=False):
-        if not hasattr(self, 'branches'):
-            self.branches = {}
-        self.branches[branch] = branch
-        if current: self.setCurrentBranch(branch)
-
-    def setCurrentBranch(self, branch=None):
-        assert hasattr(self, 'branches'), "setCurrentBranch(): cannot set current branch if no branch exist yet"
-        assert branch, "setCurrentBranch(): branch name required, got none"
-        temp = self.branches['current']
-        self.branches['current'] = branch
-        self.branches[temp] = temp
+            for br in self.run('for-each-ref', '--format=%(refname:short)', 'refs/heads/').splitlines():
+                state['branches'][br] = br
+            if refs:
+                refs.rememberState(stamp, branches=list(state['branches']))
+        branches = dict(state['branches'])
+        branches['current'] = state['current']
+        return branches
 
     def getStatus(self):
-        # Return the current branch
-        if not hasattr(self, 'status'):
-            # Assume no issues to result from this call. If it does, we probably want to abort anyway. Make further distinction to errors through Try/Except if required.
-            results = subprocess.run(args=['git', 'status'], stdin=None, input=None, stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE, shell=True, timeout=None, check=True).stdout.decode(
-                'ascii').rstrip()
-            # The second line provides the requested information
-            lines = results.splitlines()
-            self.status = lines[1]
-        #			print("debug: status is ({})".format(self.status))
-        return self.status
+        # Return the relation of the current branch to its upstream branch, as the second line of 'git status' reads
+        state = self.state()
+        if not state['upstream']:
+            return "Your branch has no upstream branch."
+        if state['ahead'] and state['behind']:
+            return "Your branch and '{}' have diverged, and have {} and {} different commits each, respectively.".format(
+                state['upstream'], state['ahead'], state['behind'])
+        if state['ahead']:
+            return "Your branch is ahead of '{}' by {} commit(s).".format(state['upstream'], state['ahead'])
+        if state['behind']:
+            return "Your branch is behind '{}' by {} commit(s).".format(state['upstream'], state['behind'])
+        return "Your branch is up to date with '{}'.".format(state['upstream'])
 
     def checkout(self, branch=None):
         # Change, in a safe way, to the requested branch. Create the branch if it does not exist yet.
@@ -455,45 +2304,195 @@ class Git:
         # 2 - check whether the branch exists
         if not (branch in list(self.getBranches().values())):
             # Branch doesn't exist hence create it:
-            # 2.1 - make sure to sit on the master, since we want that to be its parent
-            if self.getBranches()['current'] != "master":
-                # 2.1a - Change to master branch
-                try:
-                    result = subprocess.run(args=['git', 'checkout', 'master'], stdin=None, input=None,
-                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, timeout=None,
-                                            check=True).stdout.decode('ascii').rstrip()
-                except subprocess.CalledProcessError as e:
-                    raise NotImplementedError(
-                        "checkout(): git checkout 'master' returned error: {}".format(str(e.stderr)))
-                # 2.1b - pull the master since we want to branch from the latest commit at the master
-                result = subprocess.run(args=['git', 'pull'], stdin=None, input=None, stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE, shell=True, timeout=None, check=True).stdout.decode(
-                    'ascii').rstrip()
-            # 2.2 - create the branch, and update the object with its name
-            result = subprocess.run(args=['git', 'checkout', '-b', branch], stdin=None, input=None,
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, timeout=None,
-                                    check=True).stdout.decode('ascii').rstrip()
-            # 2.3 - update the object with its name
-            self.addBranch(branch, True)
-            # 2.4 - push the new branch to remote
-            #			print("debug: git push --set-upstream origin {}".format(branch))
-            result = subprocess.run(args=['git', 'push', '--set-upstream', 'origin', branch], stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE, shell=True, check=True)
+            try:
+                # 2.1 - make sure to sit on the master, since we want that to be its parent
+                if self.getBranches()['current'] != "master":
+                    # 2.1a - Change to master branch
+                    try:
+                        self.run('checkout', 'master')
+                    except subprocess.CalledProcessError as e:
+                        raise NotImplementedError(
+                            "checkout(): git checkout 'master' returned error: {}".format(str(e.stderr)))
+                    # 2.1b - pull the master since we want to branch from the latest commit at the master
+                    self.run('pull')
+                # 2.2 - create the branch
+                self.run('checkout', '-b', branch)
+                # 2.3 - push the new branch to remote
+                self.run('push', '--set-upstream', 'origin', branch)
+            finally:
+                self.invalidate()
             return branch
         # 3 - branch exists, so just change to it ...
-        result = subprocess.run(args=['git', 'checkout', branch], stdin=None, input=None, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, shell=True, timeout=None, check=True).stdout.decode(
-            'ascii').rstrip()
-        if ("Switched to branch" in result.rsplit(maxsplit=1)) or ("Your branch is ahead of" in result):
-            # (Both responses imply that the checkout was successful, although the latter indicates that we have changes that are not pushed to the remote, yet, which is irrelevant now)
-            # ... and set the object to the correct current
-            self.setCurrentBranch(result.rsplit(maxsplit=1))
-            return result.rsplit(maxsplit=1)[1]
-        else:
+        try:
+            self.run('checkout', branch)
+        except subprocess.CalledProcessError as e:
             raise NotImplementedError(
-                "checkout(): git returned unexpected string during checkout of ({}): {}".format(branch, result))
+                "checkout(): git returned unexpected string during checkout of ({}): {}".format(branch, str(e.stderr)))
+        finally:
+            self.invalidate()
+        return branch
+
+
+class PushQueue:
+    """The pushes that are pending for a repository, kept in a file under .git
 
-        # Set default template extensions for the various pandoc target formats
+    A detached helper process ('doPandoc push-queue run') carries them out, so that nobody waits for the remote. A push
+    that fails, e.g. because we are offline, stays in the queue and is retried with backoff, by the helper as long as it
+    lingers, and by the helper that a later build starts otherwise.
+    """
+
+    def __init__(self, gitDir):
+        self.file = os.path.join(gitDir, 'doPandoc-push.json')
+        self.lockFile = self.file + '.lock'
+        self.helperFile = os.path.join(gitDir, 'doPandoc-push.pid')
+        self.workTree = os.path.dirname(os.path.abspath(gitDir))
+
+    @classmethod
+    def find(cls):
+        # Return: the PushQueue of the repository in the current working directory, or None if it cannot hold one
+        refs = GitRefs.find()
+        return cls(refs.gitDir) if refs else None
+
+    def entries(self):
+        # Return: list of the pending pushes, each a dict with 'project', 'branch', 'queued', 'attempts', 'next' (the
+        # time of the next attempt) and 'error' (of the last attempt)
+        import json
+        try:
+            with open(self.file, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def update(self, change):
+        # Replace the pending pushes by change(pending pushes), guarded against concurrent updates
+        # Return: the new list of pending pushes
+        import json
+        import time
+        for _ in range(100):
+            try:
+                fd = os.open(self.lockFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                if time.time() - os.path.getmtime(self.lockFile) > 10:
+                    os.remove(self.lockFile)  # left behind by a process that died
+                time.sleep(0.05)
+        else:
+            raise OSError('push queue is locked: ' + self.lockFile)
+        try:
+            entries = change(self.entries())
+            with open(self.file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(entries, f, indent=1)
+            os.replace(self.file + '.tmp', self.file)
+        finally:
+            os.close(fd)
+            os.remove(self.lockFile)
+        return entries
+
+    def add(self, project, branch):
+        # Queue a push of the given branch, or have a pending push of that branch attempted right away
+        import time
+
+        def change(entries):
+            now = time.time()
+            for entry in entries:
+                if entry['branch'] == branch:
+                    entry['next'] = now
+                    return entries
+            return entries + [{'project': project, 'branch': branch, 'queued': now, 'attempts': 0, 'next': now,
+                               'error': None}]
+
+        return self.update(change)
+
+    def remove(self, branch=None):
+        # Drop the pending push of the given branch, or all pending pushes
+        return self.update(lambda entries: [e for e in entries if branch is not None and e['branch'] != branch])
+
+    def helperAlive(self):
+        # Return: True if a helper is carrying out the queue (it touches its pid file while it lingers)
+        import time
+        try:
+            return time.time() - os.path.getmtime(self.helperFile) < 2 * default['pushPoll'] + 60
+        except OSError:
+            return False
+
+    def start(self):
+        # Start a detached helper that carries out the pending pushes, unless there are none or a helper is running
+        # Return: True if a helper was started
+        if not self.entries() or self.helperAlive():
+            return False
+        flags = {}
+        if os.name == 'nt':
+            flags['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            flags['start_new_session'] = True
+        # Nobody is there to answer a credential prompt, hence git is to fail (and the failure to be reported) instead
+        env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), 'push-queue', 'run'], cwd=self.workTree,
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env, **flags)
+        return True
+
+    def report(self):
+        # Print the pending pushes that failed in the background, e.g. for want of credentials
+        # Return: the number of these
+        failed = [entry for entry in self.entries() if entry['attempts']]
+        for entry in failed:
+            print("* WARNING: push of {} failed {} time(s) in the background: {}\n  Run 'doPandoc push-queue run' to push "
+                  "it in the foreground".format(entry['branch'], entry['attempts'], entry['error']))
+        return len(failed)
+
+    def run(self):
+        # Carry out the pending pushes that are due, and linger while pushes are pending, retrying with backoff
+        # Return: the number of pushes that are still pending
+        import time
+        try:
+            fd = os.open(self.helperFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if self.helperAlive():
+                return len(self.entries())  # another helper is at it
+            fd = os.open(self.helperFile, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+        os.write(fd, str(os.getpid()).encode('ascii'))
+        os.close(fd)
+        started = time.time()
+        try:
+            with cd(self.workTree):
+                while True:
+                    os.utime(self.helperFile)
+                    now = time.time()
+                    entries = self.entries()
+                    for entry in [e for e in entries if e['next'] <= now]:
+                        self.attempt(entry)
+                    entries = self.entries()
+                    if not entries or time.time() - started > default['pushLinger']:
+                        return len(entries)
+                    time.sleep(default['pushPoll'])
+        finally:
+            os.remove(self.helperFile)
+
+    def attempt(self, entry):
+        # Push the branch of the given entry, and drop the entry on success or postpone it on failure
+        # Return: True on success
+        import time
+        try:
+            Git(entry['project']).pushBranch(entry['branch'])
+        except (subprocess.CalledProcessError, OSError) as e:
+            error = e.stderr.decode('utf-8', 'replace') if getattr(e, 'stderr', None) else str(e)
+            lines = [line for line in error.splitlines() if line.strip()]
+            error = next((line for line in lines if line.startswith(('fatal:', 'error:'))), lines[0] if lines else 'push failed')
+
+            def change(entries):
+                for other in entries:
+                    if other['branch'] == entry['branch']:
+                        other['attempts'] += 1
+                        other['error'] = error
+                        other['next'] = time.time() + min(default['pushBackoff'] * 2 ** (other['attempts'] - 1),
+                                                          default['pushBackoffMax'])
+                return entries
+
+            self.update(change)
+            return False
+        # A push of the branch that was queued meanwhile (which moved its next attempt) remains pending
+        self.update(lambda entries: [e for e in entries if e['branch'] != entry['branch'] or e['next'] != entry['next']])
+        return True
 
 
 default = {}
@@ -512,6 +2511,78 @@ default['-r'] = 'results'
 default['-p'] = None
 default['-c'] = 'YAML'
 
+# The target formats that can be requested, either one at a time or several at once (e.g. 'pdf,docx,tex')
+targetFormats = ['doc', 'docx', 'tex', 'pdf']
+
+# Pandoc options that shape the parsed document rather than its rendering. The parse options are applied when the
+# source is read into pandoc's JSON AST (and hence are part of the AST cache key); the reader options (filters, metadata)
+# are applied once to the parsed document. All other (pass-through) options are handed to each of the writers.
+parseOptions = ['--default-image-extension', '--track-changes', '--shift-heading-level-by', '--base-header-level',
+                '--tab-stop', '--indented-code-classes']
+readerOptions = ['-F', '--filter', '--lua-filter', '-M', '--metadata', '--metadata-file', '--bibliography', '--csl',
+                 '--citation-abbreviations']
+
+# The doPandoc cache directory, relative to (i.e., next to) the results directory, and the maximum size of the parsed
+# document (AST) cache
+default['cacheDir'] = '.doPandoc'
+default['astCacheSize'] = 256 * 1024 * 1024
+
+# Watch mode: the polling interval (when inotify is not available) and the quiet period after a burst of writes before
+# rebuilding, in seconds
+default['watchInterval'] = 0.5
+default['watchDebounce'] = 1.0
+
+# The number of warm pandoc servers in the pool (see --pool)
+default['poolSize'] = 2
+
+# Building pdf in a persistent LaTeX build directory (see --latex-build): the engine, the maximum number of passes, the
+# build directory (within the results directory) and the LaTeX support files directory (within the templates directory)
+default['latexEngine'] = 'pdflatex'
+default['latexPasses'] = 5
+default['latexBuildDir'] = '.latex'
+default['latexSupportDir'] = os.path.join('tex', 'latex')
+
+# The maximum size of the cache of precompiled LaTeX preambles (see --latex-format)
+default['latexFormatCacheSize'] = 512 * 1024 * 1024
+
+# The maximum size of the cache of bibliographies in CSL JSON and their cited subsets (see --no-bib-subset)
+default['bibCacheSize'] = 128 * 1024 * 1024
+
+# Image preprocessing: the resolution of the derived images, and the widest an image can be (in inches, i.e., the text
+# width) before it is downscaled
+default['imageDpi'] = 300
+default['imageWidth'] = 6.5
+
+# The length of the file arguments of a git command, within the limits of the command line on any platform (see
+# Git.stage)
+default['gitCommandLength'] = 16000
+
+# Pushing in the background (see PushQueue): the delay before retrying a failed push (doubled on each failure) and its
+# maximum, how long the helper lingers for pushes that are pending, and how often it looks at the queue, in seconds
+default['pushBackoff'] = 30
+default['pushBackoffMax'] = 3600
+default['pushLinger'] = 900
+default['pushPoll'] = 5
+
+# Concurrent builds (see LockFile): how long to wait for the lock of a project before giving up, and the age at which a
+# lock of a holder that cannot be looked for (on another host) is considered left behind, in seconds; the holder
+# refreshes its lock three times in this period
+default['lockWait'] = 300
+default['lockStale'] = 900
+default['projectLock'] = 'project.lock'
+
+# The build service (see 'doPandoc serve'): its port, the number of queued builds beyond which requests are refused, and
+# the number of finished builds that it reports on
+default['servePort'] = 8642
+default['serveQueue'] = 32
+default['serveHistory'] = 100
+
+# Building all documents (see --all): the files in the docs directory that are included by documents rather than built
+default['batchExclude'] = ['preamble.mmd', 'user.mmd']
+
+# The extensions of the (Scrivener compiled) sources that doPandoc finds by itself, i.e. chapters and batches
+sourceExtensions = ('.mmd', '.md', '.markdown', '.txt')
+
 # Configure which pandoc extensions to include in the command
 pandocExts = 'markdown_mmd'
 pandocExts = pandocExts + '+auto_identifiers'  # For headers without an explicitly specified identifier, a unique identifier based on the header text will be automatically assigned.
@@ -540,10 +2611,1171 @@ pandocExts = pandocExts + '+fenced_code_attributes'
 pandocExts = pandocExts + '+link_attributes'
 pandocExts = pandocExts + '+smart'  # Produce typographically correct output, converting straight quotes to curly quotes, --- to em-dashes, -- to en-dashes, and ... to ellipses, etc.
 
-# Get all arguments and ACK the command
-parser = argparse.ArgumentParser(
-    description='Wrapper around pandoc and git to spare lotsa typing!',
-    epilog='''Besides the arguments above, any APPENDED arguments will be transferred 1-to-1 to pandoc, e.g., --toc. \n
+
+def formatList(value):
+    # Argparse type for the target format(s): a single format, or a comma separated list such as 'pdf,docx,tex'
+    # Return: the list of requested formats, in order of appearance and without duplicates
+    formats = []
+    for fmt in value.split(','):
+        fmt = fmt.strip().lower()
+        if fmt not in targetFormats:
+            raise argparse.ArgumentTypeError(
+                "invalid format '{}' (choose from {})".format(fmt, ', '.join(targetFormats)))
+        if fmt not in formats:
+            formats.append(fmt)
+    return formats
+
+
+def splitPassThrough(extra):
+    # Divide the pass-through pandoc arguments into those for parsing the source, those for the reader (applied once
+    # to the parsed document) and those for the writers (applied for each target format)
+    # Return: parse, reader, writer - each a list of arguments
+    parse, reader, writer = [], [], []
+    i = 0
+    while i < len(extra):
+        arg = extra[i]
+        option = arg.split('=', 1)[0]
+        if arg[:2] in ('-M', '-F') and len(arg) > 2 and arg[1] != '-':
+            # Short option with its value attached, e.g. -Mlang=nl
+            reader.append(arg)
+        elif arg in ('-C', '--citeproc'):
+            reader.append(arg)  # citation processing, which runs among the filters
+        elif option in parseOptions or option in readerOptions:
+            group = parse if option in parseOptions else reader
+            if '=' in arg or i + 1 == len(extra):
+                group.append(arg)
+            else:
+                group.extend(extra[i:i + 2])
+                i += 1
+        else:
+            writer.append(arg)
+        i += 1
+    return parse, reader, writer
+
+
+def cacheDirectory(targetDir):
+    # Return: the doPandoc cache directory, which lives next to the results directory
+    return os.path.join(os.path.dirname(os.path.normpath(targetDir)), default['cacheDir'])
+
+
+class DependencyGraph:
+    """The files that the sources depend upon, and the targets that are built from them, kept in the doPandoc cache
+
+    A source is scanned in a single pass for its MultiMarkdown transclusions ({{file}}), its images, its citations and
+    the bibliography and csl named in its metadata, and only rescanned when it changed. Transcluded files are scanned in
+    turn. Together with the inputs that each target was last built from, this tells which targets a changed file affects.
+    """
+
+    # One pattern for all references that a source holds: transclusions, inline images, image reference definitions and
+    # citations (see citedKeys)
+    referencePattern = (r'\{\{(?P<include>[^{}\s][^{}]*?)\}\}'
+                        r'|!\[[^\]]*\]\(\s*<?(?P<image>[^)\s>]+)'
+                        r'|^\s{0,3}\[[^\]]+\]:\s*<?(?P<imageDef>\S+\.(?i:png|jpe?g|gif|tiff?|bmp|svg|pdf|eps))(?=[\s>]|$)'
+                        r'|(?<![\w@.])-?@(?P<citation>\*|[\w][\w:.#$%&+?<>~/-]*)')
+    # MultiMarkdown placeholders that look like transclusions, but are not
+    placeholders = ('TOC',)
+    # The number of levels of transclusion that is followed
+    maxDepth = 16
+
+    def __init__(self, cacheDir=None):
+        # cacheDir: the doPandoc cache directory, or None to keep the graph in memory only; the files are recorded
+        # relative to the project directory next to it (the current working directory without a cache directory)
+        self.file = os.path.join(cacheDir, 'dependencies.json') if cacheDir else None
+        self.base = os.path.dirname(os.path.abspath(cacheDir)) if cacheDir else os.getcwd()
+        # Scanned file: {'stamp': [mtime, size], 'refs': {kind: [reference, ...]}}
+        self.sources = {}
+        # Target: {'sources': [file, ...], 'searchDirs': [directory, ...], 'inputs': [file, ...]}
+        self.targets = {}
+        # The sources and targets recorded by this process, which save() merges into the stored graph
+        self.modified = set()
+        self.sources, self.targets = self._load()
+
+    def _load(self):
+        # Return: the sources and the targets of the stored graph
+        import json
+        if not self.file:
+            return {}, {}
+        try:
+            with open(self.file, encoding='utf-8') as f:
+                graph = json.load(f)
+            return dict(graph['sources']), dict(graph['targets'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}, {}
+
+    def name(self, path):
+        # Return: the name under which the given file is recorded, i.e., relative to the project directory
+        return os.path.relpath(os.path.abspath(path), self.base).replace(os.sep, '/')
+
+    def path(self, name):
+        return os.path.normpath(os.path.join(self.base, name))
+
+    @classmethod
+    def scan(cls, filename):
+        # Scan the given source for the files and citations it refers to
+        # Return: dict of kind ('include', 'image', 'citation', 'bibliography' or 'csl'): list of references as written
+        import re
+        with open(filename, encoding='utf-8', errors='replace') as f:
+            text = f.read()
+        refs = {'include': [], 'image': [], 'citation': []}
+        for match in re.finditer(cls.referencePattern, text, re.MULTILINE):
+            kind = match.lastgroup
+            ref = match.group(kind).strip()
+            if kind == 'include' and ref in cls.placeholders:
+                continue
+            if kind == 'citation' and ref != '*':
+                ref = ref.rstrip('.:;,?/-')
+            kind = 'image' if kind == 'imageDef' else kind
+            if ref not in refs[kind]:
+                refs[kind].append(ref)
+        meta = frontMatter(filename)
+        refs['bibliography'] = metadataFiles(meta, 'bibliography')
+        refs['csl'] = metadataFiles(meta, 'csl')
+        return refs
+
+    def refs(self, filename):
+        # Return: the references of the given source (see scan), rescanned only when it changed since it was recorded
+        name = self.name(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return {}
+        entry = self.sources.get(name)
+        if not entry or entry['stamp'] != [st.st_mtime_ns, st.st_size]:
+            entry = self.sources[name] = {'stamp': [st.st_mtime_ns, st.st_size], 'refs': self.scan(filename)}
+            self.modified.add(('sources', name))
+        return entry['refs']
+
+    @staticmethod
+    def resolve(ref, directories):
+        # Return: the existing files that the reference denotes, looked for in the given directories in turn, or the
+        # candidates (one per directory) when there are none; a transclusion 'file.*' denotes the file in any format
+        import glob
+        candidates = [os.path.normpath(os.path.join(directory, ref)) for directory in directories]
+        for candidate in candidates:
+            if ref.endswith('.*'):
+                found = sorted(glob.glob(glob.escape(candidate[:-2]) + '.*'))
+                if found:
+                    return found, True
+            elif os.path.isfile(candidate):
+                return [candidate], True
+        return candidates, False
+
+    def dependencies(self, sources, searchDirs, candidates=False):
+        # Establish the files that the given sources depend upon, following their transclusions
+        # searchDirs: the directories to look for referenced files, after the directory of the referring file
+        # candidates: list the places where a missing file would be found, instead of the reference as written
+        # Return: list of the files, in order of first reference, without the sources themselves
+        result, seen = [], set()
+        pending = [(source, 0) for source in sources]
+        while pending:
+            filename, depth = pending.pop(0)
+            if filename in seen:
+                continue
+            seen.add(filename)
+            refs = self.refs(filename)
+            directories = [os.path.dirname(filename)] + list(searchDirs)
+            for kind in ('include', 'image', 'bibliography', 'csl'):
+                for ref in refs.get(kind, []):
+                    found, exists = self.resolve(ref, directories[:1] if kind == 'include' else directories)
+                    files = found if exists or candidates else [ref]
+                    result += [f for f in files if f not in result and f not in sources]
+                    if kind == 'include' and exists and depth < self.maxDepth:
+                        pending += [(f, depth + 1) for f in found]
+        return result
+
+    def citations(self, sources):
+        # Return: the citation keys of the given sources and their transclusions ('*' for all entries), in order
+        result = []
+        for filename in list(sources) + [f for f in self.dependencies(sources, []) if os.path.isfile(f)]:
+            result += [key for key in self.refs(filename).get('citation', []) if key not in result]
+        return result
+
+    def register(self, target, sources, searchDirs, inputs=()):
+        # Record that the given target is built from the given sources, resolving their references in the given search
+        # directories, and from the given other inputs (e.g. its template)
+        entry = {'sources': [self.name(f) for f in sources], 'searchDirs': [self.name(d) for d in searchDirs],
+                 'inputs': [self.name(f) for f in inputs]}
+        if self.targets.get(self.name(target)) != entry:
+            self.targets[self.name(target)] = entry
+            self.modified.add(('targets', self.name(target)))
+
+    def affected(self, changed):
+        # Return: the recorded targets (names relative to the project directory) that the given changed files feed,
+        # including the files that a target's sources refer to but that did not exist when it was built
+        changed = {self.name(f) for f in changed}
+        result = []
+        for target, entry in sorted(self.targets.items()):
+            sources = [self.path(name) for name in entry['sources']]
+            files = set(entry['sources']) | set(entry['inputs'])
+            files |= {self.name(f) for f in self.dependencies(sources, [self.path(d) for d in entry['searchDirs']],
+                                                              candidates=True)}
+            if files & changed:
+                result.append(target)
+        return result
+
+    def save(self):
+        # Store what this process recorded since it was loaded, merged into the graph as stored by now: concurrent
+        # builds (e.g. the workers of a batch) each record their own targets, and take turns in doing so
+        import json
+        if not (self.file and self.modified):
+            return
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        with LockFile(self.file + '.lock'):
+            graph = dict(zip(('sources', 'targets'), self._load()))
+            for part, name in self.modified:
+                graph[part][name] = getattr(self, part)[name]
+            temp = tempName(self.file)
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump(graph, f)
+            os.replace(temp, self.file)
+        self.sources, self.targets = graph['sources'], graph['targets']
+        self.modified = set()
+
+
+def documentDependencies(src_filename, searchDirs, graph=None):
+    # Establish the files the source depends upon: its transclusions and what these depend upon, its images, and the
+    # bibliography and csl named in its metadata
+    # Each referenced file is resolved against the directory of the referring file and the given search directories
+    # graph: the DependencyGraph that remembers the references of the files, or None to scan them all
+    # Return: list of file names; a file that cannot be found is listed as referenced
+    return (graph or DependencyGraph()).dependencies([src_filename], searchDirs)
+
+
+###########
+# Chapter-parallel processing: the chapters (section files) of a document are parsed concurrently, after which their
+# ASTs are merged into one document. Numbering and citations are applied to the merged document, hence are correct.
+###########
+
+def discoverSources(mmdDir, pattern='*', chapters=False):
+    # Find the buildable sources in the docs directory whose name, with or without its extension, matches the (glob)
+    # pattern: the source files, the Scrivener compile folders that hold a source of their own name (docs/<source>/<source>)
+    # and, when chapters is set, the directories holding chapter files. The metadata files that documents include (see
+    # default['batchExclude']) are not documents by themselves
+    # Return: list of (source, whether it is a chapter directory), in order of their names
+    import fnmatch
+    sources, roots = [], set()
+    for name in sorted(os.listdir(mmdDir)):
+        path = os.path.join(mmdDir, name)
+        root, ext = os.path.splitext(name)
+        if name.startswith('.') or name in default['batchExclude'] or root in roots:
+            continue  # a source and a chapter directory of the same name would build the same targets
+        if not (fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(root, pattern)):
+            continue
+        if os.path.isfile(path) and ext.lower() in sourceExtensions:
+            sources.append((name, False))
+        elif os.path.isdir(path) and os.path.isfile(os.path.join(path, name)):
+            sources.append((name, False))
+        elif os.path.isdir(path) and chapters and chapterFiles(path):
+            sources.append((name, True))
+        else:
+            continue
+        roots.add(root)
+    return sources
+
+
+def chapterFiles(directory, names=None):
+    # Return: the chapter files in the given (Scrivener compile) directory, in natural order of their names
+    # names: the names of the files in the directory, when not to be listed from disk (e.g. as they were in a git tag)
+    import re
+    names = [name for name in (os.listdir(directory) if names is None else names)
+             if os.path.splitext(name)[1].lower() in sourceExtensions and not name.startswith('.')]
+    names.sort(key=lambda name: [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)])
+    return [os.path.join(directory, name) for name in names]
+
+
+def autoIdentifier(text):
+    # Return: the identifier pandoc's auto_identifiers extension derives from the (plain) text of a header
+    import re
+    text = re.sub(r'!?\[([^\]]*)\]\([^)]*\)', r'\1', text)  # links and images: keep their text
+    text = re.sub(r'\[\^[^\]]*\]|[*`\[\]]', '', text)  # footnotes and emphasis
+    text = ''.join(c for c in text.lower() if c.isalnum() or c in '_-. \t\n')
+    text = re.sub(r'\s+', '-', text.strip())
+    text = re.sub(r'^[^a-z]+', '', text)  # identifiers start with a letter
+    return text if text else 'section'
+
+
+def uniqueIdentifier(identifier, used):
+    # Return: the identifier, numbered when it is already used elsewhere in the document (as pandoc does)
+    n = 1
+    unique = identifier
+    while unique in used:
+        unique = identifier + '-' + str(n)
+        n += 1
+    return unique
+
+
+def chapterDefinitions(texts):
+    # Collect what chapters may refer to across chapter boundaries: link reference definitions, and the (implicit)
+    # references to headers
+    # Return: dict of lower-case label: (index of the defining chapter, reference definition line)
+    import re
+    definitions = {}
+    used = set()
+    for index, text in enumerate(texts):
+        for label, target in re.findall(r'^\s{0,3}\[([^\]^@][^\]]*)\]:\s*(.+?)\s*$', text, re.MULTILINE):
+            definitions.setdefault(label.lower(), (index, '[{}]: {}'.format(label, target)))
+        for header in re.findall(r'^#{1,6}[ \t]+(.+?)[ \t#]*$', text, re.MULTILINE):
+            explicit = re.search(r'\{#([^\s}]+)[^}]*\}\s*$|\[([^\]\s]+)\]\s*$', header)
+            title = header[:explicit.start()].strip() if explicit else header
+            identifier = (explicit.group(1) or explicit.group(2)) if explicit else autoIdentifier(title)
+            identifier = uniqueIdentifier(identifier, used)
+            used.add(identifier)
+            definitions.setdefault(title.lower(), (index, '[{}]: #{}'.format(title, identifier)))
+    return definitions
+
+
+def chapterText(texts, index, definitions):
+    # Return: the text of the given chapter, extended with the definitions it uses but which live in other chapters
+    # Note: the definitions are appended, since a metadata block must remain at the start of the text
+    import re
+    text = texts[index]
+    labels = {label.lower() for label in re.findall(r'\[([^\]^@#][^\]]*)\](?!\(|:)', text)}
+    extra = [line for label, (where, line) in sorted(definitions.items())
+             if label in labels and where != index]
+    return text + ('\n\n' + '\n'.join(extra) + '\n' if extra else '')
+
+
+def astNodes(node):
+    # Generator over all pandoc AST elements (dicts with a 't' key) in the given (part of a) document
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if 't' in node:
+                yield node
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+
+
+# The position of the attributes [identifier, classes, key-values] in the content of the AST elements that have them
+astAttrPosition = {'Header': 1, 'Div': 0, 'Span': 0, 'CodeBlock': 0, 'Code': 0, 'Link': 0, 'Image': 0, 'Table': 0,
+                   'Figure': 0}
+
+
+def mergeAsts(asts):
+    # Merge the ASTs (as parsed from pandoc's JSON output) of consecutive chapters into one document
+    # Identifiers that occur in more than one chapter are numbered to be unique, as pandoc does within a document,
+    # and the links within a chapter follow its renamed identifiers. The metadata of earlier chapters takes precedence.
+    # Return: the merged AST
+    merged = {'pandoc-api-version': asts[0]['pandoc-api-version'], 'meta': {}, 'blocks': []}
+    used = set()
+    for ast in asts:
+        if ast['pandoc-api-version'] != merged['pandoc-api-version']:
+            raise ValueError("chapters were parsed with different pandoc versions")
+        for key, value in ast['meta'].items():
+            merged['meta'].setdefault(key, value)
+        renamed = {}
+        nodes = list(astNodes(ast['blocks']))
+        for node in nodes:
+            pos = astAttrPosition.get(node['t'])
+            if pos is None or not isinstance(node.get('c'), list) or node['t'] in ('Link', 'Image'):
+                continue
+            attr = node['c'][pos]
+            if not isinstance(attr, list) or not attr or not attr[0]:
+                continue
+            identifier = uniqueIdentifier(attr[0], used)
+            if identifier != attr[0]:
+                renamed[attr[0]] = attr[0] = identifier
+            used.add(identifier)
+        if renamed:
+            for node in nodes:
+                if node['t'] == 'Link':
+                    target = node['c'][2]
+                    if target[0].startswith('#') and target[0][1:] in renamed:
+                        target[0] = '#' + renamed[target[0][1:]]
+        merged['blocks'].extend(ast['blocks'])
+    return merged
+
+
+class Redline:
+    """Block-level comparison of two versions of a document (pandoc JSON ASTs), marking what was inserted and deleted
+
+    Blocks are compared by a digest of their JSON: first per chapter (a level 1 header and the blocks up to the next),
+    so that an unchanged chapter costs one comparison, and then block by block within the chapters that changed. The
+    text of changed blocks is marked as pandoc marks tracked changes when reading docx, i.e. by spans with the class
+    'insertion' or 'deletion', which the docx writer turns into tracked changes again. Blocks without text of their own
+    (e.g. tables) are wrapped in a div with that class. markup() renders the marks for the other formats.
+    """
+
+    def __init__(self, author='doPandoc', date=None):
+        import time
+        self.author = author
+        self.date = date or time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    @staticmethod
+    def digest(block):
+        # Return: the fingerprint of the given block
+        import hashlib
+        import json
+        return hashlib.sha1(json.dumps(block, sort_keys=True, separators=(',', ':')).encode('utf-8')).digest()
+
+    @staticmethod
+    def chapters(blocks):
+        # Return: list of (start, end) of the chapters in the blocks; the blocks before the first chapter form one too
+        starts = [i for i, block in enumerate(blocks) if block['t'] == 'Header' and block['c'][0] == 1]
+        if not starts or starts[0] != 0:
+            starts.insert(0, 0)
+        return list(zip(starts, starts[1:] + [len(blocks)]))
+
+    def mark(self, block, change):
+        # Return: the block, its text marked as the given change ('insertion' or 'deletion')
+        attr = ['', [change], [['author', self.author], ['date', self.date]]]
+        t, c = block['t'], block.get('c')
+        if t in ('Para', 'Plain'):
+            return {'t': t, 'c': [{'t': 'Span', 'c': [attr, c]}]}
+        if t == 'Header':
+            return {'t': t, 'c': [c[0], c[1], [{'t': 'Span', 'c': [attr, c[2]]}]]}
+        if t == 'BlockQuote':
+            return {'t': t, 'c': [self.mark(b, change) for b in c]}
+        if t == 'BulletList':
+            return {'t': t, 'c': [[self.mark(b, change) for b in item] for item in c]}
+        if t == 'OrderedList':
+            return {'t': t, 'c': [c[0], [[self.mark(b, change) for b in item] for item in c[1]]]}
+        if t == 'Div':
+            return {'t': t, 'c': [c[0], [self.mark(b, change) for b in c[1]]]}
+        return {'t': 'Div', 'c': [attr, [block]]}
+
+    def deleted(self, block):
+        # Return: the (old) block, marked as deleted. Its identifiers are dropped, since the current document may use
+        # them, and a deleted header is not numbered
+        for node in astNodes(block):
+            pos = astAttrPosition.get(node['t'])
+            if pos is not None and node['t'] not in ('Link', 'Image') and isinstance(node.get('c'), list) \
+                    and isinstance(node['c'][pos], list) and node['c'][pos]:
+                node['c'][pos][0] = ''
+        if block['t'] == 'Header' and 'unnumbered' not in block['c'][1][1]:
+            block['c'][1][1].append('unnumbered')
+        return self.mark(block, 'deletion')
+
+    def compare(self, old, new):
+        # Compare the old with the new document
+        # Return: the new document, including the deleted blocks, with the changes marked; and a dict with the number
+        # of 'chapters' that changed, and the number of blocks that were 'inserted' and 'deleted'
+        import difflib
+        oldDigests = [self.digest(block) for block in old['blocks']]
+        newDigests = [self.digest(block) for block in new['blocks']]
+        oldChapters, newChapters = self.chapters(old['blocks']), self.chapters(new['blocks'])
+        oldKeys = [b''.join(oldDigests[start:end]) for start, end in oldChapters]
+        newKeys = [b''.join(newDigests[start:end]) for start, end in newChapters]
+        blocks = []
+        counts = {'chapters': 0, 'inserted': 0, 'deleted': 0}
+        chapterMatcher = difflib.SequenceMatcher(None, oldKeys, newKeys, autojunk=False)
+        for op, i1, i2, j1, j2 in chapterMatcher.get_opcodes():
+            newStart, newEnd = (newChapters[j1][0], newChapters[j2 - 1][1]) if j2 > j1 else (0, 0)
+            if op == 'equal':
+                blocks.extend(new['blocks'][newStart:newEnd])
+                continue
+            counts['chapters'] += max(i2 - i1, j2 - j1)
+            oldStart, oldEnd = (oldChapters[i1][0], oldChapters[i2 - 1][1]) if i2 > i1 else (0, 0)
+            blockMatcher = difflib.SequenceMatcher(None, oldDigests[oldStart:oldEnd], newDigests[newStart:newEnd])
+            for bop, b1, b2, c1, c2 in blockMatcher.get_opcodes():
+                if bop == 'equal':
+                    blocks.extend(new['blocks'][newStart + c1:newStart + c2])
+                    continue
+                blocks.extend(self.deleted(block) for block in old['blocks'][oldStart + b1:oldStart + b2])
+                blocks.extend(self.mark(block, 'insertion') for block in new['blocks'][newStart + c1:newStart + c2])
+                counts['deleted'] += b2 - b1
+                counts['inserted'] += c2 - c1
+        return dict(new, blocks=blocks), counts
+
+    @staticmethod
+    def markup(ast, fmt):
+        # Underline the insertions and strike out the deletions of the document (AST), for the target formats that
+        # have no tracked changes (all but docx); a filter of the FilterChain
+        # Return: False if the format keeps the changes as they are
+        if fmt == 'docx':
+            return False
+        # Underline is known to pandoc 2.10 (API 1.21) and later
+        style = {'insertion': 'Underline' if ast['pandoc-api-version'][:2] >= [1, 21] else 'Emph',
+                 'deletion': 'Strikeout'}
+        for node in astNodes(ast['blocks']):
+            if node['t'] == 'Span' and node['c'][0][1][:1] in (['insertion'], ['deletion']):
+                node['c'][1] = [{'t': style[node['c'][0][1][0]], 'c': node['c'][1]}]
+        return True
+
+
+def cacheCommand(argv):
+    # Handle 'doPandoc cache [info | clear]': inspect or clear the caches of the project in the current working directory
+    cacheParser = argparse.ArgumentParser(prog='doPandoc cache', description='Inspect or clear the doPandoc caches')
+    cacheParser.add_argument('action', nargs='?', choices=['info', 'clear'], default='info',
+                             help='show the size of the caches (default), or remove their content')
+    cacheParser.add_argument('-r', '--rDir', default=default['-r'],
+                             help='(optional) the results directory (relative) next to which the caches live ')
+    cacheArgs = cacheParser.parse_args(argv)
+    cacheDir = cacheDirectory(cacheArgs.rDir)
+    names = sorted(entry.name for entry in os.scandir(cacheDir) if entry.is_dir()) if os.path.isdir(cacheDir) else []
+    print('* cache directory is   : ' + cacheDir)
+    for name in names:
+        cache = FileCache(cacheDir, name)
+        if cacheArgs.action == 'clear':
+            print('* {:<21}: removed {} entries'.format(name, cache.clear()))
+        else:
+            entries, size = cache.info()
+            print('* {:<21}: {} entries, {:.1f} MB'.format(name, entries, size / (1024 * 1024)))
+    if not names:
+        print('* (no caches found)')
+
+
+def depsCommand(argv):
+    # Handle 'doPandoc deps [file ...]': show what the targets of the project in the current working directory were built
+    # from, or which of them the given files affect
+    depsParser = argparse.ArgumentParser(prog='doPandoc deps',
+                                         description='Show the dependencies of the targets, as recorded by their builds')
+    depsParser.add_argument('files', nargs='*',
+                            help='(optional) show only the targets that these (changed) files affect')
+    depsParser.add_argument('-r', '--rDir', default=default['-r'],
+                            help='(optional) the results directory (relative) next to which the caches live ')
+    depsArgs = depsParser.parse_args(argv)
+    graph = DependencyGraph(cacheDirectory(depsArgs.rDir))
+    if depsArgs.files:
+        affected = graph.affected(depsArgs.files)
+        for target in affected:
+            print(target)
+        if not affected:
+            print('* (no targets affected)')
+        return
+    for target, entry in sorted(graph.targets.items()):
+        sources = [graph.path(name) for name in entry['sources']]
+        files = graph.dependencies(sources, [graph.path(d) for d in entry['searchDirs']])
+        print('* {}'.format(target))
+        for name in entry['sources'] + sorted({graph.name(f) for f in files} | set(entry['inputs'])):
+            print('    {}{}'.format(name, '' if os.path.exists(graph.path(name)) else ' (missing)'))
+        citations = graph.citations(sources)
+        if citations:
+            print('    citations: ' + ', '.join(citations))
+    if not graph.targets:
+        print('* (no targets built yet)')
+    graph.save()
+
+
+def pushQueueCommand(argv):
+    # Handle 'doPandoc push-queue [status | run | clear]': show, carry out or drop the pending pushes of the repository in
+    # the current working directory
+    import time
+    queueParser = argparse.ArgumentParser(prog='doPandoc push-queue',
+                                          description='Show, carry out or drop the pushes that are pending in the background')
+    queueParser.add_argument('action', nargs='?', choices=['status', 'run', 'clear'], default='status',
+                             help='show the pending pushes (default), push them now, or drop them')
+    queueArgs = queueParser.parse_args(argv)
+    pushQueue = PushQueue.find()
+    if not pushQueue:
+        print('* no git repository (or a linked worktree) here, hence no push queue')
+        return
+    if queueArgs.action == 'run':
+        pending = pushQueue.run()
+        print('* pending pushes       : {}'.format(pending))
+        return
+    if queueArgs.action == 'clear':
+        print('* dropped pushes       : {}'.format(len(pushQueue.entries())))
+        pushQueue.remove()
+        return
+    entries = pushQueue.entries()
+    print('* helper               : ' + ('running' if pushQueue.helperAlive() else 'not running'))
+    for entry in entries:
+        print('* {:<21}: queued {}, {} failed attempt(s){}'.format(
+            entry['branch'], time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['queued'])), entry['attempts'],
+            ', next in {:.0f} s ({})'.format(max(0, entry['next'] - time.time()), entry['error']) if entry['attempts'] else ''))
+    if not entries:
+        print('* (no pending pushes)')
+
+
+def benchProject(directory, chapters=10, citations=5, bibSize=1000, images=5, seed=1, pandoc=None):
+    # Generate a synthetic Scrivener project in the layout doPandoc expects, the same for the same parameters: a .scriv
+    # tree, src\docs holding the compiled document, src\bib, src\images and templates
+    # pandoc: the pandoc executable to take the default templates from, or None for placeholder templates
+    # Return: the name of the source document
+    import random
+    import struct
+    import zlib
+    rng = random.Random(seed)
+    project = os.path.basename(os.path.abspath(directory))
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+             'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua']
+    for sub in ('src/docs', 'src/bib', 'src/images', 'templates/tex/latex', project + '.scriv/Files/Docs',
+                project + '.scriv/Settings', project + '.scriv/Snapshots', 'results'):
+        os.makedirs(os.path.join(directory, *sub.split('/')), exist_ok=True)
+
+    def write(name, content, mode='w'):
+        with open(os.path.join(directory, *name.split('/')), mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as f:
+            f.write(content)
+
+    def sentence(n):
+        return ' '.join(rng.choice(words) for _ in range(n)).capitalize() + '.'
+
+    keys = ['key{:05d}'.format(n) for n in range(bibSize)]
+    write('src/bib/bench.bib', ''.join(
+        '@article{{{},\n  author = {{Author, A{}}},\n  title = {{{}}},\n  journal = {{Journal of {}}},\n  year = {{{}}}\n}}\n\n'.format(
+            key, n, sentence(6)[:-1], rng.choice(words).capitalize(), 1950 + n % 70) for n, key in enumerate(keys)))
+
+    def png(width, height):
+        # A grayscale gradient, stored without any metadata
+        rows = b''.join(b'\0' + bytes((x + y) % 256 for x in range(width)) for y in range(height))
+
+        def chunk(kind, data):
+            return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+        return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) + \
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+    for n in range(1, images + 1):
+        write('src/images/figure-{}.png'.format(n), png(2400, 1600), 'wb')
+
+    text = ['---', 'title: Synthetic benchmark document', 'author: doPandoc bench', 'category: bench',
+            'bibliography: src/bib/bench.bib', '---', '']
+    for n in range(1, chapters + 1):
+        text += ['# Chapter {}'.format(n), '']
+        # The citations of the chapter are spread over its paragraphs
+        cites = ['[@{}]'.format(rng.choice(keys)) for _ in range(citations)] if keys else []
+        for p in range(4):
+            text += [(sentence(rng.randint(8, 20)) + ' ' + sentence(rng.randint(8, 20)) + ' ' +
+                      ' '.join(cites[p * len(cites) // 4:(p + 1) * len(cites) // 4])).rstrip(), '']
+        if images:
+            figure = (n - 1) % images + 1
+            text += ['![Figure {}](src/images/figure-{}.png)'.format(figure, figure), '']
+        write('{}.scriv/Files/Docs/{}.rtf'.format(project, n), '{\\rtf1\\ansi ' + sentence(12) + '}')
+        write('{}.scriv/Files/Docs/{}_synopsis.txt'.format(project, n), sentence(8))
+    write('src/docs/synthetic.mmd', '\n'.join(text))
+    write(project + '.scriv/Settings/ui.plist', '<plist/>')
+    write(project + '.scriv/' + project + '.scrivx', '<ScrivenerProject/>')
+    if pandoc:
+        write('templates/pandoc-docstyle.tex', subprocess.check_output([pandoc, '-D', 'latex']), 'wb')
+        write('templates/pandoc-docstyle.docx',
+              subprocess.check_output([pandoc, '--print-default-data-file', 'reference.docx']), 'wb')
+    else:
+        write('templates/pandoc-docstyle.tex', '$body$\n')
+        write('templates/pandoc-docstyle.docx', '')
+    return 'synthetic'
+
+
+def benchTools(directory):
+    # Write stand-ins for the pandoc and git executables into the given directory, which do (almost) nothing, so that
+    # timing doPandoc with them on the PATH measures the cost of doPandoc itself
+    # Return: the directory
+    tools = {'pandoc': '''
+import json, re, sys
+args = sys.argv[1:]
+if args == ['-v']:
+    print('pandoc 2.19.2')
+    sys.exit(0)
+out = args[args.index('-o') + 1] if '-o' in args else None
+to = args[args.index('-t') + 1] if '-t' in args else None
+if to == 'csljson':
+    with open(args[-1], encoding='utf-8') as f:
+        entries = [{'id': key, 'type': 'article-journal'} for key in re.findall(r'^@\\w+\\{([^,\\s]+),', f.read(), re.M)]
+    content = json.dumps(entries)
+elif to == 'json':
+    content = json.dumps({'pandoc-api-version': [1, 22, 2], 'meta': {}, 'blocks': []})
+else:
+    content = 'doPandoc bench'
+if out:
+    with open(out, 'w', encoding='utf-8') as f:
+        f.write(content)
+else:
+    print(content)
+''', 'git': '''
+import sys
+args = sys.argv[1:]
+if args[:1] == ['status']:
+    print('# branch.oid ' + 40 * '1')
+    print('# branch.head master')
+    print('# branch.upstream origin/master')
+    print('# branch.ab +1 -0')
+elif args[:1] == ['describe']:
+    print('v1.2-3-gabcdef0')
+elif args[:2] == ['remote', 'get-url']:
+    print('https://git.example.org/bench')
+elif args[:1] == ['rev-list']:
+    print('3')
+'''}
+    os.makedirs(directory, exist_ok=True)
+    for name, script in tools.items():
+        filename = os.path.join(directory, name)
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write('#!' + sys.executable + '\n' + script.lstrip('\n'))
+        os.chmod(filename, 0o755)
+    return directory
+
+
+def benchCommand(argv):
+    # Handle 'doPandoc bench': time doPandoc on a synthetic project, with stand-ins for pandoc and git (the cost of
+    # doPandoc itself) and/or with the real pandoc (end-to-end), and write the timings as JSON
+    import json
+    import platform
+    import shutil
+    import statistics
+    import tempfile
+    import time
+    benchParser = argparse.ArgumentParser(prog='doPandoc bench',
+                                          description='Time doPandoc on a synthetic Scrivener project, and compare with an earlier benchmark')
+    benchParser.add_argument('--chapters', type=int, default=10, help='the number of chapters (default 10)')
+    benchParser.add_argument('--citations', type=int, default=5, help='the number of citations per chapter (default 5)')
+    benchParser.add_argument('--bib-size', type=int, default=1000, help='the number of bibliography entries (default 1000)')
+    benchParser.add_argument('--images', type=int, default=5, help='the number of images (default 5)')
+    benchParser.add_argument('--seed', type=int, default=1, help='the seed of the generated text (default 1)')
+    benchParser.add_argument('-n', '--runs', type=int, default=5, help='the number of runs per scenario (default 5)')
+    benchParser.add_argument('-f', '--format', default='tex', help='the target format(s) (default tex)')
+    benchParser.add_argument('--mode', choices=['wrapper', 'pandoc', 'both'], default='wrapper',
+                             help='time doPandoc with stand-ins for pandoc and git (wrapper, the default), with the real pandoc (pandoc), or both')
+    benchParser.add_argument('-o', '--output', default='doPandoc-bench.json',
+                             help='the file to write the timings to (default doPandoc-bench.json)')
+    benchParser.add_argument('--compare', metavar='BASELINE', help='an earlier output file to compare the timings with')
+    benchParser.add_argument('--keep', action='store_true', help='keep the generated project (its location is shown)')
+    benchArgs = benchParser.parse_args(argv)
+
+    parameters = {'chapters': benchArgs.chapters, 'citations': benchArgs.citations, 'bibSize': benchArgs.bib_size,
+                  'images': benchArgs.images, 'seed': benchArgs.seed, 'format': benchArgs.format, 'runs': benchArgs.runs}
+    # The scenarios: a build from scratch, a build from the cached parse, and a build that is up-to-date
+    scenarios = [('full', ['--force', '--no-cache']), ('cached', ['--force']), ('up-to-date', [])]
+    modes = ['wrapper', 'pandoc'] if benchArgs.mode == 'both' else [benchArgs.mode]
+    report = {'parameters': parameters, 'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+              'results': []}
+    tmp = tempfile.mkdtemp(prefix='doPandoc-bench-')
+    try:
+        for mode in modes:
+            env = dict(os.environ)
+            if mode == 'wrapper':
+                if os.name == 'nt':
+                    print('* wrapper mode needs stand-ins that Windows cannot run without a shell; skipped')
+                    continue
+                env['PATH'] = benchTools(os.path.join(tmp, 'bin')) + os.pathsep + env.get('PATH', '')
+                pandoc = None
+                # Also time the git phases, against the stand-in
+                modeScenarios = scenarios + [('git', ['--force', '-g', 'doPandoc bench'])]
+            else:
+                pandoc = shutil.which('pandoc')
+                if not pandoc:
+                    print('* pandoc not found, hence no end-to-end timings')
+                    continue
+                report['environment']['pandoc'] = pandocInfo()['version']
+                modeScenarios = scenarios
+            projectDir = os.path.join(tmp, mode, 'Bench')
+            source = benchProject(projectDir, benchArgs.chapters, benchArgs.citations, benchArgs.bib_size,
+                                  benchArgs.images, benchArgs.seed, pandoc)
+            for scenario, options in modeScenarios:
+                command = [sys.executable, os.path.abspath(__file__), source, benchArgs.format, '--no-open'] + options
+                times, rcs = [], []
+                for _ in range(benchArgs.runs):
+                    start = time.perf_counter()
+                    rcs.append(subprocess.run(command, cwd=projectDir, env=env, stdin=subprocess.DEVNULL,
+                                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode)
+                    times.append(time.perf_counter() - start)
+                result = {'mode': mode, 'scenario': scenario, 'median': statistics.median(times), 'min': min(times),
+                          'mean': statistics.mean(times), 'times': times, 'failed': sum(1 for rc in rcs if rc != 0)}
+                report['results'].append(result)
+                print('* {:<21}: median {:.1f} ms, min {:.1f} ms over {} runs{}'.format(
+                    mode + ' ' + scenario, 1000 * result['median'], 1000 * result['min'], len(times),
+                    ' ({} failed)'.format(result['failed']) if result['failed'] else ''))
+            if benchArgs.keep:
+                print('* project kept in      : ' + projectDir)
+    finally:
+        if not benchArgs.keep:
+            shutil.rmtree(tmp, ignore_errors=True)
+    with open(benchArgs.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    print('* timings written to   : ' + benchArgs.output)
+
+    if benchArgs.compare:
+        with open(benchArgs.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('parameters') != parameters:
+            print('* WARNING: the baseline was made with other parameters: {}'.format(baseline.get('parameters')))
+        before = {(r['mode'], r['scenario']): r['median'] for r in baseline.get('results', [])}
+        for result in report['results']:
+            key = (result['mode'], result['scenario'])
+            if key in before and before[key] > 0:
+                ratio = result['median'] / before[key]
+                print('* {:<21}: {:.1f} ms -> {:.1f} ms ({:+.0%}){}'.format(
+                    ' '.join(key), 1000 * before[key], 1000 * result['median'], ratio - 1,
+                    '  SLOWER' if ratio > 1.1 else ''))
+
+
+def poolBenchCommand(argv):
+    # Handle 'doPandoc pool-bench': show the latency per small document of a pandoc process versus a warm pandoc server
+    import statistics
+    import tempfile
+    import time
+    benchParser = argparse.ArgumentParser(prog='doPandoc pool-bench',
+                                          description='Compare rendering small documents by pandoc processes and by warm pandoc servers')
+    benchParser.add_argument('-n', '--runs', type=int, default=20, help='the number of documents to render (default 20)')
+    benchParser.add_argument('-t', '--to', default='latex', help='the target format (default latex)')
+    benchArgs = benchParser.parse_args(argv)
+    pool = PandocServerPool(size=1)
+    if not pool.available:
+        print('* no pandoc server available (requires pandoc-server, or pandoc 3 or newer)')
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'small.mmd')
+        with codecs.open(source, encoding='utf-8', mode='w') as f:
+            f.write('---\ntitle: Benchmark\n...\n\n# Chapter\n\nSome *small* document with a [link](#chapter).\n')
+        pArgs = ['pandoc', '-f', pandocExts, '-t', benchArgs.to, '-o', os.path.join(tmp, 'small.out'), source]
+        timings = {}
+        for name, run in (('process', subprocess.call), ('server', pool.run)):
+            timings[name] = []
+            for _ in range(benchArgs.runs):
+                start = time.perf_counter()
+                rc = run(pArgs)
+                timings[name].append(time.perf_counter() - start)
+                if rc != 0:
+                    print('* {} run failed ({})'.format(name, rc))
+                    break
+    pool.close()
+    for name, times in timings.items():
+        print('* {:<21}: median {:.1f} ms, mean {:.1f} ms over {} runs'.format(
+            name, 1000 * statistics.median(times), 1000 * statistics.mean(times), len(times)))
+    if len(timings) == 2 and timings['server']:
+        print('* speed-up             : {:.1f}x'.format(
+            statistics.median(timings['process']) / statistics.median(timings['server'])))
+
+
+# The warm PandocServerPool of a worker process of 'doPandoc serve', if any
+servePool = None
+
+
+def serveWorker(poolSize):
+    # Initialise a worker process of 'doPandoc serve'. The worker lives as long as the service, hence it keeps the
+    # pandoc probe, the parsed metadata blocks and its pandoc servers warm between builds
+    global servePool
+    sys.stdin = open(os.devnull)  # nobody is there to answer git's questions
+    if poolSize:
+        servePool = PandocServerPool(size=poolSize)
+        if not servePool.available:
+            servePool = None
+
+
+def serveBuild(project, source, formats, options, extra):
+    # Build a document in a worker process of 'doPandoc serve', as build() does in the given project directory
+    # Return: dict with 'returnCodes', 'targetFiles', 'version' and 'log' (the console output of the build), or with
+    # 'error' and 'log' when the build could not be carried out
+    import contextlib
+    import io
+    import traceback
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log), cd(project):
+            result = build(source, formats, options, extra, pool=servePool)
+        return {'returnCodes': result.returnCodes, 'targetFiles': result.targetFiles, 'version': result.version,
+                'log': log.getvalue()}
+    except InputError as e:
+        return {'error': str(e), 'log': log.getvalue()}
+    except Exception as e:
+        return {'error': '{}: {}'.format(type(e).__name__, e), 'log': log.getvalue() + traceback.format_exc()}
+
+
+class BuildService:
+    """The build requests of 'doPandoc serve': queued, coalesced and carried out by a bounded number of workers
+
+    A request that is identical to one that is still queued (same project, source, formats, options and pandoc
+    arguments) joins it, hence is served by the same render. A request that is identical to one that is running is
+    queued, since the sources may have changed after that build started, and waits for it to finish. The builds are
+    carried out by long-lived worker processes (each build changes the working directory, which threads cannot do
+    independently).
+    """
+
+    # The options that a build request may not set: git (commit, tag, push and checkout) is left to the owner of the
+    # project; and those that name directories or files, which must stay inside the project
+    refusedOptions = ('git', 'checkout', 'level')
+    pathOptions = ('rDir', 'sDir', 'dDir', 'bib', 'template')
+    # The pandoc arguments that a build request may pass, and whether they take a value: those that neither run
+    # programs (e.g. filters), nor read or write files of the requester's choosing (e.g. -o)
+    extraOptions = {'-N': False, '--number-sections': False, '-s': False, '--standalone': False, '--toc': False,
+                    '--table-of-contents': False, '--reference-links': False, '--section-divs': False,
+                    '--strip-comments': False, '--ascii': False, '--listings': False, '--no-highlight': False,
+                    '-C': False, '--citeproc': False, '--toc-depth': True, '--top-level-division': True,
+                    '--shift-heading-level-by': True, '--number-offset': True, '--wrap': True, '--columns': True,
+                    '--dpi': True, '--reference-location': True, '--track-changes': True, '--tab-stop': True,
+                    '--eol': True, '-M': True, '--metadata': True, '-V': True, '--variable': True}
+    # The metadata that names files for citeproc to read
+    fileMetadata = ('bibliography', 'csl', 'citation-abbreviations')
+
+    def __init__(self, workers=2, queueSize=32, poolSize=None, root=None):
+        # workers: the number of concurrent builds; queueSize: the number of queued builds beyond which requests are
+        # refused; poolSize: the number of warm pandoc servers per worker; root: the directory that the projects must
+        # be in, if any
+        import collections
+        import multiprocessing
+        import threading
+        from concurrent.futures import ProcessPoolExecutor
+        self.queueSize = queueSize
+        self.root = os.path.realpath(root) if root else None
+        # The workers are spawned rather than forked, since the service runs threads
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=serveWorker, initargs=(poolSize,))
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.queue = collections.deque()
+        self.jobs = collections.OrderedDict()  # id: job, the finished ones only the most recent
+        self.running = set()  # the keys of the running jobs
+        self.count = 0
+        self.dispatchers = [threading.Thread(target=self.dispatch, daemon=True) for _ in range(workers)]
+        for dispatcher in self.dispatchers:
+            dispatcher.start()
+
+    def request(self, body):
+        # Turn the body of a build request into the arguments of build()
+        # body: dict with 'project' (directory), 'source', 'formats' (list, or comma separated), and optionally
+        # 'options' (dict, see buildOptions) and 'extra' (list of pandoc arguments)
+        # Return: (key, arguments); raises ValueError for an invalid request
+        import json
+        import re
+        if not isinstance(body, dict) or not isinstance(body.get('source'), str):
+            raise ValueError('a build request needs a "project", a "source" and "formats"')
+        project = os.path.realpath(str(body.get('project') or '.'))
+        if not os.path.isdir(project):
+            raise ValueError('project directory not found: ' + project)
+        if self.root and os.path.commonpath([self.root, project]) != self.root:
+            raise ValueError('project is outside ' + self.root)
+        formats = body.get('formats') or ''
+        if not (isinstance(formats, str) or isinstance(formats, list) and all(isinstance(f, str) for f in formats)):
+            raise ValueError('"formats" is a list of formats, or a comma separated string')
+        try:
+            formats = formatList(formats if isinstance(formats, str) else ','.join(formats))
+        except argparse.ArgumentTypeError as e:
+            raise ValueError(str(e))
+        if not isinstance(body.get('options') or {}, dict):
+            raise ValueError('"options" is an object of option: value')
+        if not isinstance(body.get('extra') or [], list):
+            raise ValueError('"extra" is a list of pandoc arguments')
+        options = dict(body.get('options') or {})
+        for option in self.refusedOptions:
+            if option in options:
+                raise ValueError('option "{}" is not available to build requests'.format(option))
+        for option in self.pathOptions:
+            value = options.get(option)
+            if value is not None and (not isinstance(value, str) or os.path.isabs(value) or
+                                      '..' in value.replace('\\', '/').split('/')):
+                raise ValueError('option "{}" names a path outside the project: {}'.format(option, value))
+        options.update(open=False, watch=False, pool=None)
+        try:
+            buildOptions(options)  # raises ValueError for unknown options
+        except TypeError as e:
+            raise ValueError('invalid options: {}'.format(e))
+        extra = [str(arg) for arg in body.get('extra') or []]
+        i = 0
+        while i < len(extra):
+            if extra[i][:2] in ('-M', '-V') and len(extra[i]) > 2:
+                option, attached, value = extra[i][:2], True, extra[i][2:]  # the value attached, e.g. -Mlang=nl
+            else:
+                option, attached, value = extra[i].partition('=')
+            if option not in self.extraOptions:
+                raise ValueError('pandoc argument "{}" is not available to build requests'.format(extra[i]))
+            if self.extraOptions[option] and not attached:
+                if i + 1 == len(extra):
+                    raise ValueError('pandoc argument "{}" needs a value'.format(option))
+                i += 1
+                value = extra[i]
+            if option in ('-M', '--metadata') and re.split('[:=]', value, 1)[0] in self.fileMetadata:
+                raise ValueError('metadata "{}" is not available to build requests'.format(value))
+            i += 1
+        key = json.dumps([project, body['source'], formats, options, extra], sort_keys=True)
+        return key, (project, body['source'], formats, options, extra)
+
+    def submit(self, body):
+        # Queue a build request, or join the identical request that is queued already
+        # Return: the job (dict); raises ValueError for an invalid request, and OverflowError when the queue is full
+        import threading
+        import time
+        key, arguments = self.request(body)
+        with self.lock:
+            for job in self.queue:
+                if job['key'] == key:
+                    job['requests'] += 1
+                    return job
+            if len(self.queue) >= self.queueSize:
+                raise OverflowError('{} builds are queued already'.format(len(self.queue)))
+            self.count += 1
+            job = {'id': str(self.count), 'key': key, 'arguments': arguments, 'state': 'queued', 'requests': 1,
+                   'queued': time.time(), 'started': None, 'finished': None, 'result': None, 'done': threading.Event()}
+            self.jobs[job['id']] = job
+            self.queue.append(job)
+            self.ready.notify()
+        return job
+
+    def dispatch(self):
+        # Carry out the queued jobs, one at a time, on a worker
+        import time
+        while True:
+            with self.lock:
+                # The first queued job that is not running already
+                job = None
+                while job is None:
+                    job = next((job for job in self.queue if job['key'] not in self.running), None)
+                    if job is None:
+                        self.ready.wait()
+                self.queue.remove(job)
+                self.running.add(job['key'])
+                job['state'], job['started'] = 'running', time.time()
+            try:
+                result = self.executor.submit(serveBuild, *job['arguments']).result()
+            except Exception as e:  # e.g. a worker that died
+                result = {'error': '{}: {}'.format(type(e).__name__, e), 'log': ''}
+            with self.lock:
+                ok = 'error' not in result and all(rc == 0 for rc in result['returnCodes'].values())
+                job['state'], job['finished'], job['result'] = 'done' if ok else 'failed', time.time(), result
+                job['done'].set()
+                self.running.discard(job['key'])
+                self.ready.notify_all()
+                finished = [i for i, j in self.jobs.items() if j['finished']]
+                for i in finished[:max(0, len(finished) - default['serveHistory'])]:
+                    del self.jobs[i]
+
+    @staticmethod
+    def describe(job):
+        # Return: the job as it is reported to clients
+        described = {k: v for k, v in job.items() if k not in ('key', 'arguments', 'done', 'result')}
+        described.update(zip(('project', 'source', 'formats'), job['arguments'][:3]))
+        described.update(job['result'] or {})
+        return described
+
+    def status(self):
+        # Return: dict with the number of 'queued' and 'running' builds, and the known 'jobs'
+        with self.lock:
+            jobs = [self.describe(job) for job in self.jobs.values()]
+        for job in jobs:
+            job.pop('log', None)
+        return {'queued': sum(job['state'] == 'queued' for job in jobs),
+                'running': sum(job['state'] == 'running' for job in jobs), 'jobs': jobs}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def serveCommand(argv):
+    # Handle 'doPandoc serve': build documents on request, over HTTP on a local port or a Unix socket
+    import hmac
+    import http.server
+    import json
+    import secrets
+    import socket
+    import socketserver
+    serveParser = argparse.ArgumentParser(prog='doPandoc serve',
+                                          description='Build documents on request, keeping the workers, caches and pandoc servers warm')
+    serveParser.add_argument('--host', default='127.0.0.1', help='the address to listen on (default 127.0.0.1)')
+    serveParser.add_argument('--port', type=int, default=default['servePort'],
+                             help='the port to listen on (default {})'.format(default['servePort']))
+    serveParser.add_argument('--socket', metavar='PATH', help='listen on this Unix socket instead of a port')
+    serveParser.add_argument('-j', '--jobs', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                             help='the number of documents built at the same time (default: half the cores)')
+    serveParser.add_argument('--queue', type=int, default=default['serveQueue'],
+                             help='the number of queued builds beyond which requests are refused (default {})'.format(
+                                 default['serveQueue']))
+    serveParser.add_argument('--pool', type=int, nargs='?', const=default['poolSize'], default=None, metavar='N',
+                             help='keep N (default {}) warm pandoc servers per worker'.format(default['poolSize']))
+    serveParser.add_argument('--root', metavar='DIR', required=True, help='only build projects in this directory')
+    serveParser.add_argument('--token-file', metavar='PATH',
+                             help='also write the token that requests must carry to this file (readable by you only)')
+    serveArgs = serveParser.parse_args(argv)
+    # The token of this service, which each request carries as 'Authorization: Bearer <token>'; other local users, and
+    # web pages in a browser, cannot learn it
+    token = secrets.token_urlsafe(24)
+    if serveArgs.token_file:
+        fd = os.open(serveArgs.token_file, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(token + '\n')
+    service = BuildService(serveArgs.jobs, serveArgs.queue, serveArgs.pool, serveArgs.root)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        # POST /build: queue a build (see BuildService.request); waits for its result unless ?wait=0
+        # GET /jobs/<id>: the state and result of a build; GET /status: the queue and the recent builds
+        # Each request carries the token of the service; a build request is JSON, which a web page cannot send to
+        # another site without its consent
+
+        def authorised(self):
+            # Return: True if the request carries the token; otherwise, it is answered here
+            scheme, _, given = (self.headers.get('Authorization') or '').partition(' ')
+            if scheme == 'Bearer' and hmac.compare_digest(given.strip().encode('utf-8'), token.encode('utf-8')):
+                return True
+            self.reply(401, {'error': 'the request lacks the token of the service'},
+                       [('WWW-Authenticate', 'Bearer')])
+            return False
+
+        def reply(self, status, content, headers=()):
+            data = json.dumps(content, indent=1).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for header in headers:
+                self.send_header(*header)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if not self.authorised():
+                return
+            path = self.path.split('?', 1)[0].rstrip('/')
+            if path in ('', '/status'):
+                self.reply(200, service.status())
+            elif path.startswith('/jobs/'):
+                with service.lock:
+                    job = service.jobs.get(path[len('/jobs/'):])
+                    job = job and service.describe(job)
+                if job:
+                    self.reply(200, job)
+                else:
+                    self.reply(404, {'error': 'unknown job'})
+            else:
+                self.reply(404, {'error': 'unknown path'})
+
+        def do_POST(self):
+            if not self.authorised():
+                return
+            path, _, query = self.path.partition('?')
+            if path.rstrip('/') != '/build':
+                return self.reply(404, {'error': 'unknown path'})
+            if self.headers.get_content_type() != 'application/json':
+                return self.reply(415, {'error': 'a build request is application/json'})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+                job = service.submit(body)
+            except ValueError as e:
+                return self.reply(400, {'error': str(e)})
+            except OverflowError as e:
+                return self.reply(503, {'error': str(e)}, [('Retry-After', '10')])
+            if 'wait=0' in query.split('&'):
+                return self.reply(202, service.describe(job))
+            job['done'].wait()
+            self.reply(200 if job['state'] == 'done' else 500, service.describe(job))
+
+        def log_message(self, format, *args):
+            print('* {:<21}: {}'.format(self.command or 'request', format % args))
+
+    if serveArgs.socket:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise InputError('Unix sockets are not supported on this platform', serveArgs.socket)
+
+        class Server(http.server.ThreadingHTTPServer):
+            address_family = socket.AF_UNIX
+
+            def server_bind(self):
+                socketserver.TCPServer.server_bind(self)
+                self.server_name, self.server_port = 'localhost', 0
+
+        if os.path.exists(serveArgs.socket):
+            os.remove(serveArgs.socket)  # left behind by an earlier service
+        server = Server(serveArgs.socket, Handler)
+        where = serveArgs.socket
+    else:
+        server = http.server.ThreadingHTTPServer((serveArgs.host, serveArgs.port), Handler)
+        where = 'http://{}:{}'.format(serveArgs.host, server.server_port)
+    print('* serving              : {} ({} workers, up to {} queued; press Ctrl-C to stop)'.format(
+        where, serveArgs.jobs, serveArgs.queue))
+    print('* token                : ' + token)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('* stopped serving')
+    finally:
+        server.server_close()
+        service.close()
+        if serveArgs.socket and os.path.exists(serveArgs.socket):
+            os.remove(serveArgs.socket)
+
+
+def argumentParser():
+    # Return: the parser of the doPandoc command line
+    parser = argparse.ArgumentParser(
+        description='Wrapper around pandoc and git to spare lotsa typing!',
+        epilog='''Besides the arguments above, any APPENDED arguments will be transferred 1-to-1 to pandoc, e.g., --toc. \n
             Execute this program by including the location of the program in the environment's PATH variable. \n
 			All relative directories are relative to the current working directory of the shell.\n
             Make sure you include templates\ and src\ directories in the working directory.
@@ -559,283 +3791,1212 @@ parser = argparse.ArgumentParser(
 			When this project is under git control, it will manage your versions and branches for you in a specific scenario: \n
 			1. to be added
     '''
-)
-parser.add_argument('source', help='the name of the source file; leaving out the extension assumes .mmd')
-parser.add_argument('format', choices=['doc', 'docx', 'tex', 'pdf'], help='the target format: [doc | docx | tex | pdf]')
-parser.add_argument('-g', '--git', nargs='?', const=None,
-                    help='(optional) use git-versioning to commit the current text, tagged as new minor version. The text following this argument is considered the commit message (try to scale it to 50 chars). Only useful when you checked out your scrivener project from git. Without text, i.e., only "-g" implies default git message',
-                    default=default['-g'])
-parser.add_argument('-l', '--level', choices=['none', 'minor', 'major'],
-                    help='(optional) the version level that will be incremented (requires option -g <msg>)',
-                    default=default['-l'])
-parser.add_argument('-c', '--checkout', nargs='?', const=default['-c'],
-                    help='(optional, implies -g) perform a git checkout. The default branch to checkout to is specified by the "category" parameter in the documents YAML-block, but can be overridden by "-c <branch>"',
-                    default=None)
-parser.add_argument('-t', '--template',
-                    help='(optional) your style template file; leaving out the extension implies compatibility with specified target format ',
-                    default=default['-t'])
-parser.add_argument('-d', '--dDir',
-                    help='(optional) the root directory (relative to your project dir) holding the style template file ',
-                    default=default['-d'])
-parser.add_argument('-s', '--sDir', help='(optional) the root directory (relative) holding the source document files ',
-                    default=default['-s'])
-parser.add_argument('-r', '--rDir',
-                    help='(optional) the results directory (relative) holding the generated target file ',
-                    default=default['-r'])
-parser.add_argument('-b', '--bib',
-                    help='(optional) your bib file, overriding what has been specified in the YAML-block; leaving out the extension assumes .bib')
-parser.add_argument('-p', '--proj',
-                    help='(optional) the scrivener project(.scriv) directory holding the scrivener sources; assumes {} '.format(
-                        default['-p']), default=default['-p'])
-parser.add_argument('-v', '--version',
-                    help='(optional) when using git, it will show the latest version of the current branch of the document, or "None" if no version can be established (e.g., no git used)',
-                    action='store_true')
-args = parser.parse_known_args()
+    )
+    parser.add_argument('source', help='the name of the source file; leaving out the extension assumes .mmd. A pattern such as "ch*" (quoted) builds all sources in the docs directory that match it, as --all does')
+    parser.add_argument('format', type=formatList,
+                        help='the target format: [doc | docx | tex | pdf], or several of them separated by commas (e.g. "pdf,docx,tex"), in which case the source is parsed once and the formats are rendered in parallel')
+    parser.add_argument('-g', '--git', nargs='?', const=None,
+                        help='(optional) use git-versioning to commit the current text, tagged as new minor version. The text following this argument is considered the commit message (try to scale it to 50 chars). Only useful when you checked out your scrivener project from git. Without text, i.e., only "-g" implies default git message',
+                        default=default['-g'])
+    parser.add_argument('-l', '--level', choices=['none', 'minor', 'major'],
+                        help='(optional) the version level that will be incremented (requires option -g <msg>)',
+                        default=default['-l'])
+    parser.add_argument('-c', '--checkout', nargs='?', const=default['-c'],
+                        help='(optional, implies -g) perform a git checkout. The default branch to checkout to is specified by the "category" parameter in the documents YAML-block, but can be overridden by "-c <branch>"',
+                        default=None)
+    parser.add_argument('-t', '--template',
+                        help='(optional) your style template file; leaving out the extension implies compatibility with specified target format ',
+                        default=default['-t'])
+    parser.add_argument('-d', '--dDir',
+                        help='(optional) the root directory (relative to your project dir) holding the style template file ',
+                        default=default['-d'])
+    parser.add_argument('-s', '--sDir', help='(optional) the root directory (relative) holding the source document files ',
+                        default=default['-s'])
+    parser.add_argument('-r', '--rDir',
+                        help='(optional) the results directory (relative) holding the generated target file ',
+                        default=default['-r'])
+    parser.add_argument('-b', '--bib',
+                        help='(optional) your bib file, overriding what has been specified in the YAML-block; leaving out the extension assumes .bib')
+    parser.add_argument('-p', '--proj',
+                        help='(optional) the scrivener project(.scriv) directory holding the scrivener sources; assumes {} '.format(
+                            default['-p']), default=default['-p'])
+    parser.add_argument('-v', '--version',
+                        help='(optional) when using git, it will show the latest version of the current branch of the document, or "None" if no version can be established (e.g., no git used)',
+                        action='store_true')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='(optional) always parse the source, i.e., do not use (nor update) the cache of parsed documents. Use "doPandoc cache [info | clear]" to inspect or clear the caches')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='(optional) after building, keep watching the docs, images and bib sources and the templates, and rebuild the affected target(s) when they change. Git is not used while watching')
+    parser.add_argument('--pool', type=int, nargs='?', const=default['poolSize'], default=None, metavar='N',
+                        help='(optional) render on N (default {}) warm pandoc servers instead of starting pandoc for each job; implied by --watch. Requires pandoc-server (pandoc 3 or newer); falls back to pandoc processes otherwise. Run "doPandoc pool-bench" to compare both'.format(
+                            default['poolSize']))
+    parser.add_argument('--chapters', action='store_true',
+                        help='(optional) the source is a directory (in the docs directory) holding the chapters of the document as separate files. These are parsed in parallel, and only when changed, after which they are merged into one document')
+    parser.add_argument('--latex-build', action='store_true',
+                        help='(optional) for pdf, let pandoc produce the .tex only, and run LaTeX in a persistent build directory ({}) that retains the aux, toc and bibliography state between builds; passes stop as soon as that state is stable. The engine is {}, unless overridden by --pdf-engine'.format(
+                            os.path.join(default['-r'], default['latexBuildDir'], '<source>'), default['latexEngine']))
+    parser.add_argument('--latex-format', action='store_true',
+                        help='(optional) for pdf, precompile the preamble of the .tex (by the mylatexformat package) into a format that is cached, and start LaTeX from it; implies --latex-build. Preambles that cannot be precompiled are compiled as usual')
+    parser.add_argument('--no-bib-subset', dest='bib_subset', action='store_false',
+                        help='(optional) hand pandoc the complete bibliography, instead of only the entries that the document cites (taken from a cached CSL JSON index of the bibliography)')
+    parser.add_argument('--diff-against', metavar='TAG', default=None,
+                        help='(optional) render a redline of the changes since the given git tag (e.g. v1.2) into <source>-diff-<tag>.<format>: tracked changes in docx, underlined insertions and struck out deletions otherwise')
+    parser.add_argument('--image-dpi', type=int, default=default['imageDpi'], metavar='DPI',
+                        help='(optional) the resolution of the images in the target (default {}): larger images are downscaled to fit the text width at this resolution'.format(default['imageDpi']))
+    parser.add_argument('--no-image-prep', dest='image_prep', action='store_false',
+                        help='(optional) use the images as they are, instead of derived copies that are downscaled, converted to a format that suits the target, and stripped of metadata')
+    parser.add_argument('--no-open', dest='open', action='store_false',
+                        help='(optional) do not open the resulting files, e.g. for batch or nightly builds')
+    parser.add_argument('--trace', action='store_true',
+                        help='(optional) record the wall-clock and CPU time of each phase of the build (including the child processes), summarize them, and write them to <source>.trace.json in the results directory, in the Chrome trace event format')
+    parser.add_argument('--all', action='store_true',
+                        help='(optional) build all sources in the docs directory (leave out the source then): the source files, the Scrivener compile folders and, with --chapters, the chapter directories. They are committed and pushed once, and rendered in parallel')
+    parser.add_argument('-j', '--jobs', type=int, default=None, metavar='N',
+                        help='(optional) with --all or a pattern, build N documents at the same time (default: the number of cores divided by the number of formats)')
+    parser.add_argument('--force', action='store_true',
+                        help='(optional) always run pandoc, even when the target file is up-to-date with its source, template, bibliography, images and pandoc arguments')
+    return parser
+
+
+def buildOptions(options=None):
+    # Complete the given options with the defaults of the command line, e.g. buildOptions({'git': 'my message'})
+    # options: dict of option (by its argparse dest, e.g. 'rDir' or 'bib_subset'): value, or a complete argparse.Namespace
+    # Return: argparse.Namespace holding all options except the source and the format
+    if isinstance(options, argparse.Namespace):
+        return options
+    namespace = argparse.Namespace(**{action.dest: action.default for action in argumentParser()._actions
+                                      if action.dest not in ('help', 'source', 'format')})
+    for key, value in (options or {}).items():
+        if not hasattr(namespace, key):
+            raise ValueError('unknown doPandoc option: ' + key)
+        setattr(namespace, key, value)
+    return namespace
+
 
 ###########
-# Process the arguments and assign parameters with proper values
+# Building a document
 ###########
 
-# Check first if only the version of the current branched document was requested
-# if args[0].version:
-#	print ('* Version of current document branch: ' + Git(None).version())
-#	exit(0)
-
-source = args[0].source
-path, srcfile = os.path.split(source)
-root, ext = os.path.splitext(srcfile)
-if not ext:
-    ext = '.mmd'
-sourceFile = root + ext
-
-gitMessage = args[0].git
-targetDir = args[0].rDir
-format = args[0].format
-templateDir = args[0].dDir
-project = args[0].proj
-if path == os.path.join(args[0].sDir, "docs"):
-    sourceDir = args[0].sDir
-else:
-    sourceDir = os.path.join(path, args[0].sDir)
-baseDir = os.getcwd()  # The shell's current working directory
+# The pandoc version and capabilities per pandoc executable, probed once per process (see pandocInfo)
+pandocProbes = {}
 
-# Get the Scrivener project name, i.e., the name of the current working directory (no path) if no command argument has been given
-dirname: List[str] = baseDir.rsplit('\\', 1)
-project = dirname[1] if not args[0].proj else args[0].proj
-# Make exception for my dissertation:
-if dirname[1] == "Dissertation": project = 'DissertatieBrandt'
 
-mmdDir = os.path.join(sourceDir, "docs")
-bibDir = os.path.join(sourceDir, "bib")
-imgDir = os.path.join(sourceDir, "images")
+def pandocInfo(cacheDir=None):
+    # Probe the pandoc on the PATH for its version and capabilities. The outcome is kept for the remainder of the
+    # process and, when given a cache directory, on disk until the pandoc executable is replaced
+    # Return: dict with 'version' (str) and 'server' (bool, whether pandoc can run as a server)
+    import json
+    import shutil
+    executable = shutil.which('pandoc')
+    if not executable:
+        raise InputError('pandoc not found', 'PATH')
+    st = os.stat(executable)
+    stamp = [executable, st.st_mtime_ns, st.st_size]
+    if tuple(stamp) in pandocProbes:
+        return pandocProbes[tuple(stamp)]
+    memo = os.path.join(cacheDir, 'pandoc.json') if cacheDir else None
+    info = None
+    if memo and os.path.exists(memo):
+        try:
+            with open(memo, encoding='utf-8') as f:
+                stored = json.load(f)
+            if stored['stamp'] == stamp:
+                info = stored['info']
+        except (OSError, ValueError, KeyError):
+            pass
+    if info is None:
+        out = subprocess.check_output([executable, '-v']).decode('utf-8')
+        version = out.splitlines()[0].split()[1]
+        major = int(version.split('.')[0]) if version.split('.')[0].isdigit() else 0
+        info = {'version': version, 'server': major >= 3 or bool(shutil.which('pandoc-server'))}
+        if memo:
+            os.makedirs(cacheDir, exist_ok=True)
+            temp = tempName(memo)
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump({'stamp': stamp, 'info': info}, f)
+            os.replace(temp, memo)
+    pandocProbes[tuple(stamp)] = info
+    return info
 
-root, ext = os.path.splitext(args[0].template)
-if not ext:
-    ext = default[args[0].format]
-templateFile = root + ext
 
-if args[0].bib:  # If it's not defined here, YAML-block data is assumed
-    root, ext = os.path.splitext(args[0].bib)
-    print('debug: bib file name: <' + root + '>, extension: <' + ext + '>')
-    if not ext:
-        ext = '.bib'
-    bibFile = root + ext
+class Trace:
+    """Wall-clock and CPU time per phase of a build, including the CPU time of the child processes (see --trace)
 
-targetFile = os.path.splitext(sourceFile)[0] + '.' + format
+    Phases may nest, e.g. the pandoc probe within the argument resolution. The trace is written in the Chrome trace event
+    format, which chrome://tracing and Perfetto show as a timeline, and which is plain JSON for anything else.
+    """
 
-###########
-# Present relevant parameter details
-###########
-out = subprocess.check_output(['pandoc', '-v']).decode('utf-8')  # Get pandoc version
-pandocVersion = out.splitlines()[0].split()[1]
-
-print('**********************')
-print('*')
-print('* Processing project <' + project + '>:')
-print('* pandoc version is    : ' + pandocVersion)
-print('* base directory is    : ' + baseDir)
-print('* template directory is: ' + templateDir)
-print('* source file is       : ' + sourceFile)
-print('* target file is       : ' + targetFile)
-print('* template file is     : ' + os.path.join(templateDir, templateFile))
+    def __init__(self):
+        import threading
+        import time
+        self.events = []
+        self.depth = {}
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.mainThread = threading.get_ident()
 
-###########
-# Check existence of main files
-###########
-if not os.path.exists(os.path.join(baseDir, mmdDir, sourceFile)):
-    print('* WARNING: source file not found', os.path.join(baseDir, mmdDir, sourceFile))
-    print('*\tsearching subfolder ...')
-    # Especially with scrivener mmd projects, an additional compile folder may be introduced
-    if not os.path.exists(os.path.join(baseDir, mmdDir, sourceFile, sourceFile)):
-        InputError('source file not found', os.path.join(baseDir, mmdDir, sourceFile, sourceFile))
-    else:
-        src_filename = os.path.join(mmdDir, sourceFile, sourceFile)
-else:
-    src_filename = os.path.join(mmdDir, sourceFile)
-if not os.path.exists(os.path.join(baseDir, templateDir, templateFile)): InputError('template file not found',
-                                                                                    os.path.join(baseDir, templateDir,
-                                                                                                 templateFile))
+    @staticmethod
+    def childrenTime():
+        # Return: the CPU time (user and system) of the child processes that have been waited for, or None where the
+        # platform does not tell (Windows)
+        try:
+            import resource
+        except ImportError:
+            return None
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
 
-###########
-# Establish the branch we are working on
-###########
+    def phase(self, name):
+        # Return: a context manager that records the time spent in it as the given phase
+        import contextlib
+        import threading
+        import time
 
-if args[0].checkout:
-    # Only perform a git checkout when command line option -c has been given
-    if sourceFile.split('.')[-1] == 'mmd':
-        # Parse the multimarkdown file for a YAML block containing the "category: <my category>" line
-        # unless there was an argument to the doPandoc to this concern
-        # On failure, the branch name becomes 'master'
-        if args[0].checkout == 'YAML':
-            # No argument given, hence parse the YAML block
-            with codecs.open(src_filename, encoding='utf-8', mode='r') as f:
-                line = f.readline()
-                if line.find("---") == -1:
-                    # The YAML block must start with several dashes, AND, must be the first line in the file
-                    # no YAML block found
-                    branch = args[0].checkout
-                else:
-                    # First line is YAML block
-                    for line in f:
-                        if line.lower().find("category") == -1 and line.find("...") == -1: continue
-                        if line.find("...") != -1:
-                            # End of YAML block found
-                            branch = args[0].checkout
-                            break
-                        else:
-                            # Line found, will read "category: '<my particular category name>'"
-                            # Hence: (1) remove 'category:', and
-                            # (2a) since a git branch cannot contain spaces, translate all spaces into an underscore
-                            # (2b) and remove any quotes that we might we used to enclose a sentence (with spaces) as title
-                            # (3) and check that the resulting name is valid for git
-                            #							import re
-                            category = " ".join(line.rsplit(sep="category:", maxsplit=1)[1].split()).replace(" ",
-                                                                                                             "_").translate(
-                                {ord(c): None for c in "'\""})
-                            try:
-                                branch = subprocess.run(
-                                    args=['git', 'check-ref-format', '--normalize', "heads/" + category],
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
-                                    check=True).stdout.decode('ascii').rstrip()
-                            except subprocess.CalledProcessError as e:
-                                print("* git error: illegal branch name ({})".format(str(e.stderr.decode('ascii'))))
-                                exit(1)
-                            #							branch = re.sub('\s+', '_', line.rsplit(sep="category:", maxsplit=1)[1].strip())
-                            #							branch = branch.translate({ord(c): "_" for c in " !@#$%^&*()[]{};:,./<>?\|`'~-=+"})
-                            break
+        @contextlib.contextmanager
+        def record():
+            tid = threading.get_ident()
+            with self.lock:
+                # The phases of worker threads nest within the phase that the main thread is in
+                depth = self.depth[tid] = self.depth.get(tid, self.depth.get(self.mainThread, 0)) + 1
+            wall, cpu, children = time.perf_counter(), time.process_time(), self.childrenTime()
+            try:
+                yield
+            finally:
+                end = time.perf_counter()
+                event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                         'ts': round((wall - self.origin) * 1e6), 'dur': round((end - wall) * 1e6),
+                         'args': {'cpu': time.process_time() - cpu, 'depth': depth}}
+                if children is not None:
+                    event['args']['children'] = self.childrenTime() - children
+                with self.lock:
+                    self.events.append(event)
+                    self.depth[tid] -= 1
+
+        return record()
+
+    def totals(self):
+        # Return: list of (name, depth, wall, cpu, children) per phase, in order of their start; the times in seconds
+        # are summed over all occurrences of a phase at the same depth
+        totals = {}
+        for event in sorted(self.events, key=lambda e: e['ts']):
+            key = (event['name'], event['args']['depth'])
+            wall, cpu, children = totals.get(key, (0, 0, None))
+            if 'children' in event['args']:
+                children = (children or 0) + event['args']['children']
+            totals[key] = (wall + event['dur'] / 1e6, cpu + event['args']['cpu'], children)
+        return [(name, depth) + times for (name, depth), times in totals.items()]
+
+    def summary(self):
+        # Print the time per phase
+        print('* {:<21}: {:>9} {:>9} {:>9}'.format('phase (seconds)', 'wall', 'cpu', 'children'))
+        for name, depth, wall, cpu, children in self.totals():
+            print('* {:<21}: {:9.3f} {:9.3f} {:>9}'.format('  ' * (depth - 1) + name, wall, cpu,
+                                                         '-' if children is None else '{:.3f}'.format(children)))
+
+    def save(self, filename, **metadata):
+        # Write the trace to the given file, together with the given metadata (e.g. the source and formats)
+        import json
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        temp = tempName(filename)
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': sorted(self.events, key=lambda e: e['ts']), 'displayTimeUnit': 'ms',
+                       'metadata': metadata}, f, indent=1)
+        os.replace(temp, filename)
+
+
+class BuildResult:
+    """The outcome of building a document: the return code of pandoc per target format, and the resulting files"""
+
+    def __init__(self, document, returnCodes, version=''):
+        self.document = document
+        self.returnCodes = returnCodes
+        self.version = version
+        # The Trace of the build, see --trace
+        self.trace = None
+        # The target file per format (absolute)
+        self.targetFiles = {fmt: os.path.join(document.baseDir, document.writer_args[fmt]['-o']) for fmt in returnCodes}
+
+    @property
+    def ok(self):
+        # Return: True if all targets are built (or were up-to-date)
+        return all(rc == 0 for rc in self.returnCodes.values())
+
+    def __repr__(self):
+        return 'BuildResult({}, version={!r})'.format(self.returnCodes, self.version)
+
+
+class Document:
+    """A document in the project in the current working directory, and how pandoc builds its targets
+
+    The source, templates, targets and pandoc arguments are established from the options as on the command line. After
+    configure(), render() builds the targets that are out of date; it can be called again when the sources change.
+    """
+
+    def __init__(self, source, formats, options, extra=(), pool=None, trace=None):
+        # source: the name of the source file (or chapter directory); leaving out the extension assumes .mmd
+        # formats: the list of target formats
+        # options: the command line options (see buildOptions)
+        # extra: the pandoc arguments that are passed through
+        # pool: the PandocServerPool to render on, or None to run pandoc processes
+        # trace: the Trace to record the time of the phases of the build in
+        self.options = options
+        self.trace = trace or Trace()
+        self.formats = list(formats)
+        self.extra = list(extra)
+        self.pandocPool = pool
+        # The settings for building a pdf in a persistent LaTeX build directory (see --latex-build), if any
+        self.latexBuild = None
+
+        path, srcfile = os.path.split(source)
+        root, ext = os.path.splitext(srcfile)
+        if not ext:
+            ext = '.mmd'
+        self.sourceFile = root + ext
+
+        self.targetDir = options.rDir
+        self.templateDir = options.dDir
+        if path == os.path.join(options.sDir, "docs"):
+            self.sourceDir = options.sDir
         else:
-            branch = args[0].checkout
-    else:
-        branch = args[0].checkout
+            self.sourceDir = os.path.join(path, options.sDir)
+        self.baseDir = os.getcwd()  # The shell's current working directory
 
-###########
-# Consider the use of versioning, i.e., calculate potential new version. Note that the option '-l' demands '-g'
-###########
-version = ''
-if gitMessage != 'no-git':
-    myGit = Git(project)
-    print('* git branch is        : {}'.format(myGit.checkout(branch) if args[0].checkout else '-skipped-'))
-    if gitMessage:
-        # If there is a Git message, then the default level will be 'minor'
-        level = args[0].level if args[0].level else 'minor'
-        version, prev = myGit.incrementVersion(level=level, concat=True)
-    elif (args[0].level and args[0].level == 'none') or not args[0].level:
-        # If there is NO git message, and also no level or 'none' level then this is an update to the text that is not worth a level increment
-        # Hence, we will generate a default git message, retain the same version number but increment the commit number
-        gitMessage = '(auto message) Small textual changes only'
-        version, prev = myGit.incrementVersion(level=None, concat=True)
-    else:
-        # If the purpose is to increment the version number, but do so WITHOUT git message, that's not good
-        # (this should have been captured by the earlier command line option processing; this is for fail-safe only)
-        print("ERROR: Will not create a new version without a proper commit message; '-l' demands '-g <msg>'")
-        exit()
-
-    ###########
-    # Stage and commit your modifications
-    ###########
-    with cd(baseDir):
-        if version and not version == 'v0.0-0':
-            major, minor = version[1:].split('-')[0].split('.')
+        # Get the Scrivener project name, i.e., the name of the current working directory (no path) if no command argument has been given
+        dirname = os.path.basename(self.baseDir)
+        self.project = dirname if not options.proj else options.proj
+        # Make exception for my dissertation:
+        if dirname == "Dissertation": self.project = 'DissertatieBrandt'
+
+        self.mmdDir = os.path.join(self.sourceDir, "docs")
+        self.bibDir = os.path.join(self.sourceDir, "bib")
+        self.imgDir = os.path.join(self.sourceDir, "images")
+
+        # Each target format gets its own template, unless an explicit extension was given
+        root, ext = os.path.splitext(options.template)
+        self.templateFiles = {}
+        for fmt in self.formats:
+            self.templateFiles[fmt] = root + (ext if ext else default[fmt])
+
+        self.bibFile = None
+        if options.bib:  # If it's not defined here, YAML-block data is assumed
+            root, ext = os.path.splitext(options.bib)
+            if not ext:
+                ext = '.bib'
+            self.bibFile = root + ext
+
+        self.targetFiles = {}
+        for fmt in self.formats:
+            # A redline (see --diff-against) does not replace the document itself
+            suffix = '-diff-' + options.diff_against if options.diff_against else ''
+            self.targetFiles[fmt] = os.path.splitext(self.sourceFile)[0] + suffix + '.' + fmt
+
+        ###########
+        # Present relevant parameter details
+        ###########
+        with self.trace.phase('pandoc probe'):
+            self.pandocVersion = pandocInfo(cacheDirectory(self.targetDir))['version']
+
+        print('**********************')
+        print('*')
+        print('* Processing project <' + self.project + '>:')
+        print('* pandoc version is    : ' + self.pandocVersion)
+        print('* base directory is    : ' + self.baseDir)
+        print('* template directory is: ' + self.templateDir)
+        print('* source file is       : ' + self.sourceFile)
+        for fmt in self.formats:
+            print('* target file is       : ' + self.targetFiles[fmt])
+            print('* template file is     : ' + os.path.join(self.templateDir, self.templateFiles[fmt]))
+
+        ###########
+        # Check existence of main files
+        ###########
+        self.sourceChapters = None
+        if options.chapters:
+            # The source is a (Scrivener compile) directory holding the chapters as separate files
+            for src_filename in (os.path.join(self.mmdDir, os.path.splitext(self.sourceFile)[0]),
+                                 os.path.join(self.mmdDir, self.sourceFile)):
+                if os.path.isdir(os.path.join(self.baseDir, src_filename)):
+                    break
+            else:
+                raise InputError('chapter directory not found',
+                                 os.path.join(self.baseDir, self.mmdDir, os.path.splitext(self.sourceFile)[0]))
+            self.sourceChapters = chapterFiles(src_filename)
+            if not self.sourceChapters:
+                raise InputError('no chapter files found in directory', os.path.join(self.baseDir, src_filename))
+            print('* chapters             : {} (in {})'.format(len(self.sourceChapters), src_filename))
+        elif not os.path.isfile(os.path.join(self.baseDir, self.mmdDir, self.sourceFile)):
+            print('* WARNING: source file not found', os.path.join(self.baseDir, self.mmdDir, self.sourceFile))
+            print('*\tsearching subfolder ...')
+            # Especially with scrivener mmd projects, an additional compile folder may be introduced
+            if not os.path.exists(os.path.join(self.baseDir, self.mmdDir, self.sourceFile, self.sourceFile)):
+                raise InputError('source file not found',
+                                 os.path.join(self.baseDir, self.mmdDir, self.sourceFile, self.sourceFile))
+            else:
+                src_filename = os.path.join(self.mmdDir, self.sourceFile, self.sourceFile)
         else:
-            major = minor = None
-        if not myGit.commit(msg=gitMessage, major=major, minor=minor):
-            # Commit not successful, hence roll-back the anticipated version to the previous version
-            version = prev
-    print('* version is           : ' + (version + ' (was: ' + prev + ')' if version else 'no-versioning'))
+            src_filename = os.path.join(self.mmdDir, self.sourceFile)
+        self.src_filename = src_filename
+        for templateFile in set(self.templateFiles.values()):
+            if not os.path.exists(os.path.join(self.baseDir, self.templateDir, templateFile)):
+                raise InputError('template file not found', os.path.join(self.baseDir, self.templateDir, templateFile))
 
-###########
-# Parse and build the arguments for pandoc
-###########
+    def gitLock(self):
+        # Return: the context manager that serialises the builds of the project where they use git (commit, tag,
+        # checkout, push), i.e. the project's LockFile; a no-op when git is not used
+        import contextlib
+        if self.options.git == 'no-git':
+            return contextlib.nullcontext()
+        return LockFile(os.path.join(self.baseDir, cacheDirectory(self.targetDir), default['projectLock']))
 
-pandoc_args = {}
-pandoc_args['-f'] = pandocExts
-pandoc_args['-o'] = os.path.join(targetDir, targetFile)
-print('* output to            : ' + pandoc_args['-o'])
-pandoc_args['--data-dir'] = baseDir
-pandoc_args[
-    '--filter'] = 'pandoc-citeproc'  # Using an external filter, pandoc-citeproc, pandoc can automatically generate citations and a bibliography in a number of styles
-if args[0].bib:  # Bibliography file given as argument that overrides YAML block
-    pandoc_args['--bibliography'] = os.path.join(bibDir, bibFile)
-pandoc_bools = [
-    "--number-sections"]  # ".. as seen in section 2.1.3" You can configure (1) which symbol to use (num-sign by default), and (2) whether to link back to the referred section, or convert the link to plain text (link by default)
-pandoc_bools.append("--top-level-division=chapter")  # Treat mmd top-level headers as chapters
-if version:
-    pandoc_args[
-        '-M'] = 'version=' + version  # Pass the version for this document as meta-data to be used in the template
-if (format == "docx"):
-    pandoc_args['--reference-docx'] = os.path.join(templateDir, templateFile)
-else:
-    pandoc_args['--template'] = os.path.join(templateDir, templateFile)
+    def commitSources(self):
+        # Establish the branch we are working on, calculate the new version and commit the sources, as far as the
+        # git options ask for it
+        # Return: the Git handle (None when git is not used), and the version ('' for no versioning)
+        options = self.options
+        gitMessage = options.git
 
-# pandoc_args['--latex-engine'] = 'xelatex'				# use the correct latex engine
+        ###########
+        # Establish the branch we are working on
+        ###########
+        if options.checkout:
+            # Only perform a git checkout when command line option -c has been given
+            if self.sourceFile.split('.')[-1] == 'mmd':
+                # Parse the multimarkdown file for a YAML block containing the "category: <my category>" line
+                # unless there was an argument to the doPandoc to this concern
+                # On failure, the branch name becomes 'master'
+                if options.checkout == 'YAML':
+                    # No argument given, hence take the category from the metadata block, which will read
+                    # "category: '<my particular category name>'". Hence:
+                    # (1) since a git branch cannot contain spaces, translate all spaces into an underscore
+                    # (2) and remove any quotes that we might we used to enclose a sentence (with spaces) as title
+                    # (3) and check that the resulting name is valid for git
+                    category = frontMatter(self.sourceChapters[0] if self.sourceChapters else self.src_filename).get('category')
+                    if isinstance(category, str) and category:
+                        category = "_".join(category.split()).translate({ord(c): None for c in "'\""})
+                        try:
+                            branch = Git.run('check-ref-format', '--normalize', "heads/" + category)[len('heads/'):]
+                        except subprocess.CalledProcessError as e:
+                            raise InputError('git error: illegal branch name', e.stderr.decode('ascii'))
+                    else:
+                        branch = 'master'
+                else:
+                    branch = options.checkout
+            else:
+                branch = options.checkout
+
+        ###########
+        # Consider the use of versioning, i.e., calculate potential new version. Note that the option '-l' demands '-g'
+        ###########
+        version = ''
+        if gitMessage == 'no-git':
+            return None, version
+        myGit = Git(self.project, self.trace)
+        with self.trace.phase('git checkout'):
+            print('* git branch is        : {}'.format(myGit.checkout(branch) if options.checkout else '-skipped-'))
+        if gitMessage:
+            # If there is a Git message, then the default level will be 'minor'
+            level = options.level if options.level else 'minor'
+            version, prev = myGit.incrementVersion(level=level, concat=True)
+        elif (options.level and options.level == 'none') or not options.level:
+            # If there is NO git message, and also no level or 'none' level then this is an update to the text that is not worth a level increment
+            # Hence, we will generate a default git message, retain the same version number but increment the commit number
+            gitMessage = '(auto message) Small textual changes only'
+            version, prev = myGit.incrementVersion(level=None, concat=True)
+        else:
+            # If the purpose is to increment the version number, but do so WITHOUT git message, that's not good
+            # (this should have been captured by the earlier command line option processing; this is for fail-safe only)
+            raise InputError("Will not create a new version without a proper commit message", "'-l' demands '-g <msg>'")
 
-pArgs = ['pandoc']
-for key in ('-o', '-f'):
-    pArgs.extend([key, pandoc_args[key]])
-    del pandoc_args[key]
+        ###########
+        # Stage and commit your modifications
+        ###########
+        with cd(self.baseDir):
+            if version and not version == 'v0.0-0':
+                major, minor = version[1:].split('-')[0].split('.')
+            else:
+                major = minor = None
+            if not myGit.commit(msg=gitMessage, major=major, minor=minor):
+                # Commit not successful, hence roll-back the anticipated version to the previous version
+                version = prev
+        print('* version is           : ' + (version + ' (was: ' + prev + ')' if version else 'no-versioning'))
+        return myGit, version
 
-for key, val in pandoc_args.items():
-    pArgs.extend([key, val])
+    def configure(self, version=''):
+        # Parse and build the arguments for pandoc, for the given version of the document
+        options = self.options
 
-pArgs.extend(pandoc_bools)
+        # Reader arguments shape the parsed document; they are the same for every target format
+        self.pandoc_args = {}
+        self.pandoc_args['-f'] = pandocExts
+        self.pandoc_args['--data-dir'] = self.baseDir
+        citeproc = tuple(int(n) for n in self.pandocVersion.split('.') if n.isdigit()) >= (2, 11)
+        if not citeproc:
+            self.pandoc_args[
+                '--filter'] = 'pandoc-citeproc'  # Using an external filter, pandoc-citeproc, pandoc can automatically generate citations and a bibliography in a number of styles
+        if self.bibFile:  # Bibliography file given as argument that overrides YAML block
+            self.pandoc_args['--bibliography'] = os.path.join(self.bibDir, self.bibFile)
+        if version:
+            self.pandoc_args[
+                '-M'] = 'version=' + version  # Pass the version for this document as meta-data to be used in the template
+        self.pandoc_bools = [
+            "--number-sections"]  # ".. as seen in section 2.1.3" You can configure (1) which symbol to use (num-sign by default), and (2) whether to link back to the referred section, or convert the link to plain text (link by default)
+        self.pandoc_bools.append("--top-level-division=chapter")  # Treat mmd top-level headers as chapters
 
-# Add non-parsed, additional arguments from the command line, if any
-for val in args[1]:
-    pArgs.append(val)
+        # Writer arguments produce one particular target format
+        self.writer_args = {}
+        for fmt in self.formats:
+            self.writer_args[fmt] = {}
+            self.writer_args[fmt]['-o'] = os.path.join(self.targetDir, self.targetFiles[fmt])
+            print('* output to            : ' + self.writer_args[fmt]['-o'])
+            if (fmt == "docx"):
+                self.writer_args[fmt]['--reference-docx'] = os.path.join(self.templateDir, self.templateFiles[fmt])
+            else:
+                self.writer_args[fmt]['--template'] = os.path.join(self.templateDir, self.templateFiles[fmt])
 
-# Append the mmd source    
-pArgs.append(src_filename)
+        # pandoc_args['--latex-engine'] = 'xelatex'				# use the correct latex engine
 
-###########
-# Run pandoc and push the changes to the remote
-###########
+        self.parseExtra, self.readerExtra, self.writerExtra = splitPassThrough(self.extra)
+        if citeproc and not any(arg in ('-C', '--citeproc') for arg in self.readerExtra):
+            # pandoc 2.11 and newer generate the citations themselves, ahead of the other filters, as pandoc-citeproc did
+            self.readerExtra.insert(0, '--citeproc')
+
+        # The filters that can run in-process (see FilterChain) among the pass-through arguments; they keep their place
+        # among the other filters (see filterPasses)
+        self.filters, self.filterFiles = [], []
+        for _, _, name in filterArguments(self.readerExtra):
+            function, filename = FilterChain.resolve(name, [self.baseDir]) if name else (None, None)
+            if function:
+                self.filters.append((name, function))
+                self.filterFiles += [filename] if filename else []
+        if self.filters:
+            print('* in-process filters   : ' + ', '.join(name for name, _ in self.filters))
+
+        # The parsed document (pandoc JSON AST) is cached, keyed by the source, the extensions, the parse options and the pandoc version
+        cacheDir = cacheDirectory(self.targetDir)
+        self.astCache = FileCache(cacheDir, 'ast', default['astCacheSize'])
+        self.bibIndex = BibIndex(cacheDir, self.pandocVersion)
+        self.dependencyGraph = DependencyGraph(cacheDir)
+        self.imagePipeline = ImagePipeline(cacheDir, options.image_dpi, default['imageWidth'],
+                                           [self.sourceDir, self.imgDir, self.baseDir]) if options.image_prep else None
+
+        if (options.latex_build or options.latex_format) and 'pdf' in self.formats:
+            self.latexBuild = {'engine': default['latexEngine'],
+                               'texInputs': [os.path.join(self.baseDir, self.templateDir, default['latexSupportDir']) + '//',
+                                             os.path.join(self.baseDir, self.templateDir)],
+                               'formats': cacheDir if options.latex_format else None}
+
+    def runPandoc(self, fmt, pArgs):
+        # Run one pandoc job for the given target format, on a warm pandoc server when available, as a process otherwise
+        # A target is written to a temporary file, which is published when it is complete
+        # fmt: the target format, or anything else (e.g. 'json' or the index of a chapter) for parsing
+        # Return: fmt, and the return code of pandoc
+        with self.trace.phase('pandoc ' + fmt if fmt in self.formats else 'pandoc parse'):
+            if fmt not in self.formats:
+                return fmt, self.pandocPool.run(pArgs) if self.pandocPool else subprocess.call(pArgs)
+            if fmt == 'pdf' and self.latexBuild:
+                return fmt, self.buildPdf(pArgs)
+            target = pArgs[pArgs.index('-o') + 1]
+            tempArgs = list(pArgs)
+            tempArgs[pArgs.index('-o') + 1] = tempName(target)
+            rc = self.pandocPool.run(tempArgs) if self.pandocPool else subprocess.call(tempArgs)
+            if rc == 0:
+                return fmt, publish(tempName(target), target)
+            if os.path.exists(tempName(target)):
+                os.remove(tempName(target))
+            return fmt, rc
+
+    def buildPdf(self, pArgs):
+        # Have pandoc produce the .tex of the pdf job into the document's persistent LaTeX build directory, compile it
+        # there, and copy the resulting pdf to the target
+        # Return: the return code of pandoc or the LaTeX engine
+        import shutil
+        target = pArgs[pArgs.index('-o') + 1]
+        jobname = os.path.splitext(os.path.basename(target))[0]
+        engine = self.latexBuild['engine']
+        engineOptions = []
+        texArgs = []
+        i = 0
+        while i < len(pArgs):
+            option = pArgs[i].split('=', 1)[0]
+            if option in ('--pdf-engine', '--latex-engine'):
+                # The engine is run by us, not by pandoc
+                if '=' in pArgs[i]:
+                    engine = pArgs[i].split('=', 1)[1]
+                else:
+                    engine = pArgs[i + 1]
+                    i += 1
+            elif option in ('--pdf-engine-opt', '--latex-engine-opt'):
+                # Passed on to the engine, as pandoc would
+                if '=' in pArgs[i]:
+                    engineOptions.append(pArgs[i].split('=', 1)[1])
+                else:
+                    engineOptions.append(pArgs[i + 1])
+                    i += 1
+            else:
+                texArgs.append(pArgs[i])
+            i += 1
+        build = LatexBuild(os.path.join(os.path.dirname(target), default['latexBuildDir'], jobname), jobname,
+                           engine=engine, texInputs=self.latexBuild['texInputs'], maxPasses=default['latexPasses'],
+                           engineOptions=engineOptions)
+        texArgs[texArgs.index('-o') + 1] = build.texFile
+        texArgs[1:1] = ['-t', 'latex', '-s']
+        # Concurrent builds of the same document take turns in its build directory
+        with LockFile(os.path.join(build.dir, jobname + '.lock')):
+            rc = self.pandocPool.run(texArgs) if self.pandocPool else subprocess.call(texArgs)
+            formatFile = None
+            if rc == 0 and self.latexBuild['formats']:
+                formats = LatexFormats(self.latexBuild['formats'], engine, self.latexBuild['texInputs'])
+                with self.trace.phase('latex format'):
+                    formatFile = formats.prepare(build.texFile)
+            if rc == 0:
+                with self.trace.phase('latex'):
+                    rc = build.compile(formatFile)
+                if rc != 0 and formatFile:
+                    # The document may not get along with its precompiled preamble. When it compiles without it, the
+                    # preamble is compiled as usual from now on; otherwise the error is in the document itself
+                    print('* LaTeX format         : compiling without the precompiled preamble')
+                    with self.trace.phase('latex'):
+                        rc = build.compile()
+                    if rc == 0:
+                        formats.reject(formatFile)
+            if rc == 0:
+                shutil.copyfile(build.pdfFile, tempName(target))
+                rc = publish(tempName(target), target)
+        return rc
+
+    def parseChapters(self, chapterTexts, chapterKeys, names=None):
+        # Parse the chapters that are not cached yet, concurrently, and merge all chapters into one document
+        # names: the names of the chapters to report errors by, the source chapters by default
+        # Return: the return code of pandoc, and the (temporary) file holding the merged AST
+        import json
+        from concurrent.futures import ThreadPoolExecutor
+
+        chapterAsts = [self.astCache.get(key, '.json') if self.options.cache else None for key in chapterKeys]
+        jobs, temps = {}, []
+        for i, text in enumerate(chapterTexts):
+            if chapterAsts[i]:
+                continue
+            textFile, parsedFile = self.astCache.tempfile('.mmd'), self.astCache.tempfile('.json')
+            with codecs.open(textFile, encoding='utf-8', mode='w') as f:
+                f.write(text)
+            jobs[i] = ['pandoc', '-f', pandocExts, '-t', 'json', '-o', parsedFile] + self.parseExtra + [textFile]
+            temps += [textFile, parsedFile]
+        print('* Parsing {} of {} chapters'.format(len(jobs), len(chapterTexts)))
+        rc = 0
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            for i, chapterRc in pool.map(self.runPandoc, list(jobs), list(jobs.values())):
+                rc = rc or chapterRc
+                if chapterRc == 0:
+                    parsedFile = jobs[i][jobs[i].index('-o') + 1]
+                    chapterAsts[i] = self.astCache.put(chapterKeys[i], parsedFile, '.json') if self.options.cache else parsedFile
+                else:
+                    print('\n>>>> ERROR: pandoc returned with {} for chapter {}'.format(chapterRc, (names or self.sourceChapters)[i]))
+        mergedFile = None
+        if rc == 0:
+            asts = []
+            for filename in chapterAsts:
+                with open(filename, encoding='utf-8') as f:
+                    asts.append(json.load(f))
+            mergedFile = self.astCache.tempfile('.json')
+            with open(mergedFile, 'w', encoding='utf-8') as f:
+                json.dump(mergeAsts(asts), f)
+        for filename in temps:
+            if os.path.exists(filename):
+                os.remove(filename)
+        return rc, mergedFile
+
+    def filterPasses(self, docArgs, docReaderExtra):
+        # Split the filters off that are to run ahead of the writer, in the order given, when any of them runs in-process:
+        # the citations first (pandoc-citeproc, or --citeproc), then the filters of the pass-through arguments. A series of filters that pandoc runs is
+        # one pandoc pass (json to json), followed by the FilterChain of the in-process filters after it, and so on;
+        # the filters after the last in-process one are left to the writer
+        # docArgs, docReaderExtra: the reader arguments and pass-through reader arguments (see subsetBibliography)
+        # Return: list of (pandoc arguments of a pass, without input and output, or None, FilterChain), and the reader
+        # arguments and pass-through reader arguments for the writer
+        inProcess = dict(self.filters)
+        if not inProcess:
+            return [], docArgs, docReaderExtra
+        found = filterArguments(docReaderExtra)
+        sequence = [(['--filter', docArgs['--filter']], None, None)] if '--filter' in docArgs else []
+        sequence += [(docReaderExtra[i:i + width], name, inProcess.get(name)) for i, width, name in found]
+        skip = {i + n for i, width, _ in found for n in range(width)}
+        options = [arg for i, arg in enumerate(docReaderExtra) if i not in skip]
+        last = max(n for n, (_, _, function) in enumerate(sequence) if function)
+        passArgs = ['pandoc', '-f', 'json', '-t', 'json']
+        for key, val in docArgs.items():
+            if key not in ('-f', '--filter'): passArgs.extend([key, val])
+        passes, external = [], []
+        for args, name, function in sequence[:last + 1]:
+            if not function:
+                external += args
+            elif passes and not external:
+                passes[-1][1].filters.append((name, function))  # runs right after the previous in-process filter
+            else:
+                passes.append((passArgs + options + external if external else None, FilterChain([(name, function)])))
+                external = []
+        remaining = {key: val for key, val in docArgs.items() if key != '--filter'}
+        return passes, remaining, options + [arg for args, _, _ in sequence[last + 1:] for arg in args]
+
+    def runFilterPasses(self, passes, astFile, fmt, tempFiles):
+        # Run the passes of filters (see filterPasses) on the document in astFile, for the given target format ('json'
+        # when the document is for several formats)
+        # Return: the return code of pandoc, and the file holding the filtered document
+        docFile = astFile
+        for pandocArgs, chain in passes:
+            if pandocArgs:
+                passFile = self.astCache.tempfile('.json')
+                tempFiles.append(passFile)
+                with self.trace.phase('pandoc filter'):
+                    rc = subprocess.call(pandocArgs + ['-o', passFile, docFile])
+                if rc != 0:
+                    return rc, docFile
+                docFile = passFile
+            chainFile = self.astCache.tempfile('.json')
+            tempFiles.append(chainFile)
+            with self.trace.phase('filters'):
+                if chain.run(docFile, fmt, chainFile):
+                    docFile = chainFile
+        return 0, docFile
+
+    def filterChain(self, fmt):
+        # Return: the FilterChain of doPandoc's own rewrites of the document for the given target format
+        filters = []
+        if self.imagePipeline:
+            filters.append(('images', lambda ast, _: self.imagePipeline.rewrite(ast, fmt)))
+        if self.options.diff_against:
+            filters.append(('redline', lambda ast, _: Redline.markup(ast, fmt)))
+        return FilterChain(filters)
+
+    def redline(self, astFile):
+        # Compare the document in astFile with the source as it was at the tag given by --diff-against, and mark the
+        # blocks that were inserted and deleted since. The source of the tag is parsed as chapters are, hence cached
+        # Return: the return code of git or pandoc, and the (temporary) file holding the marked document
+        import json
+        tag = self.options.diff_against
+        try:
+            if self.sourceChapters:
+                chapterDir = os.path.dirname(self.sourceChapters[0])
+                names = Git.run('ls-tree', '--name-only', tag, os.path.join(chapterDir, '')).splitlines()
+                sources = chapterFiles(chapterDir, [name.rsplit('/', 1)[-1] for name in names])
+            else:
+                sources = [self.src_filename]
+            contents = Git.files(tag, sources)
+        except subprocess.CalledProcessError as e:
+            print('\n>>>> ERROR: cannot read the sources of {} from git ({})'.format(tag, e.stderr.decode('utf-8').strip()))
+            return e.returncode, None
+        if not sources or None in contents:
+            print('\n>>>> ERROR: {} does not have {}'.format(tag, ', '.join(
+                path for path, content in zip(sources, contents) if content is None) or 'any chapters'))
+            return 1, None
+        texts = [content.decode('utf-8') for content in contents]
+        if self.sourceChapters:
+            definitions = chapterDefinitions(texts)
+            texts = [chapterText(texts, i, definitions) for i in range(len(texts))]
+        keys = [FileCache.key(text, pandocExts, self.pandocVersion, *self.parseExtra) for text in texts]
+        rc, oldFile = self.parseChapters(texts, keys, ['{}:{}'.format(tag, path) for path in sources])
+        if rc != 0:
+            return rc, None
+        with open(oldFile, encoding='utf-8') as f:
+            old = json.load(f)
+        os.remove(oldFile)
+        with open(astFile, encoding='utf-8') as f:
+            new = json.load(f)
+        marked, counts = Redline().compare(old, new)
+        print('* redline against {:<5}: {} chapters changed, {} blocks inserted, {} deleted'.format(
+            tag, counts['chapters'], counts['inserted'], counts['deleted']))
+        redlineFile = self.astCache.tempfile('.json')
+        with open(redlineFile, 'w', encoding='utf-8') as f:
+            json.dump(marked, f)
+        return 0, redlineFile
+
+    def subsetBibliography(self, texts):
+        # Replace the bibliographies of the document by the subset of their entries that the document cites
+        # Return: the reader arguments (dict) and the pass-through reader arguments, the bibliographies replaced if possible
+        docArgs, docExtra, bibFiles = dict(self.pandoc_args), [], []
+        if '--bibliography' in docArgs:
+            bibFiles.append(docArgs.pop('--bibliography'))
+        i = 0
+        while i < len(self.readerExtra):
+            if self.readerExtra[i].split('=', 1)[0] == '--bibliography':
+                if '=' in self.readerExtra[i]:
+                    bibFiles.append(self.readerExtra[i].split('=', 1)[1])
+                elif i + 1 < len(self.readerExtra):
+                    bibFiles.append(self.readerExtra[i + 1])
+                    i += 1
+            else:
+                docExtra.append(self.readerExtra[i])
+            i += 1
+        if not bibFiles:
+            # Bibliographies given on the command line override those in the YAML-block
+            for bibFile in metadataFiles(frontMatter(self.sourceChapters[0] if self.sourceChapters else self.src_filename), 'bibliography'):
+                for directory in (os.path.dirname(self.src_filename), self.bibDir, self.baseDir):
+                    if os.path.isfile(os.path.join(directory, bibFile)):
+                        bibFiles.append(os.path.join(directory, bibFile))
+                        break
+                else:
+                    return self.pandoc_args, self.readerExtra  # leave it to pandoc to complain
+        keys = citedKeys(texts)
+        if not self.options.bib_subset or not bibFiles or keys is None or not all(os.path.isfile(f) for f in bibFiles):
+            return self.pandoc_args, self.readerExtra
+        subset = self.bibIndex.subset(bibFiles, keys)
+        if subset is None:
+            return self.pandoc_args, self.readerExtra
+        docArgs['--bibliography'] = subset
+        print('* bibliography         : {} cited entries from {}'.format(len(keys), ', '.join(bibFiles)))
+        return docArgs, docExtra
+
+    def refreshChapters(self, changed):
+        # Establish the chapter files anew when one of the changed files (absolute paths) is in the chapter directory,
+        # but not among the chapters, or no longer there: a chapter was added, removed or renamed, e.g. while watching
+        # Return: True if the chapters changed
+        if not self.sourceChapters:
+            return False
+        chapterDir = os.path.normpath(os.path.join(self.baseDir, self.src_filename))
+        known = {os.path.normpath(os.path.join(self.baseDir, f)) for f in self.sourceChapters}
+        if not any(os.path.dirname(os.path.normpath(f)) == chapterDir and (os.path.normpath(f) not in known or
+                                                                            not os.path.exists(f)) for f in changed):
+            return False
+        with cd(self.baseDir):
+            chapters = chapterFiles(self.src_filename)
+        if not chapters or chapters == self.sourceChapters:
+            return False  # e.g. a file that is no chapter, or a directory without chapters, which is left to the next build
+        self.sourceChapters = chapters
+        print('* chapters             : {} (in {})'.format(len(self.sourceChapters), self.src_filename))
+        return True
+
+    def render(self, formats=None, force=False):
+        # Render the source into the given target formats, skipping those targets that are up-to-date (unless forced)
+        # Return: dict of format: return code of pandoc (0 for targets that were up-to-date)
+        formats = formats or self.formats
+        if self.sourceChapters:
+            # The document is identified by its chapters, each of which is identified by its text
+            chapterTexts = []
+            for chapter in self.sourceChapters:
+                with codecs.open(chapter, encoding='utf-8', mode='r') as f:
+                    chapterTexts.append(f.read())
+            definitions = chapterDefinitions(chapterTexts)
+            chapterTexts = [chapterText(chapterTexts, i, definitions) for i in range(len(chapterTexts))]
+            chapterKeys = [FileCache.key(text, pandocExts, self.pandocVersion, *self.parseExtra) for text in chapterTexts]
+            astKey = FileCache.key('chapters', *chapterKeys)
+        else:
+            astKey = FileCache.key(FileCache.digest(self.src_filename), pandocExts, self.pandocVersion, *self.parseExtra)
+        astFile = self.astCache.get(astKey, '.json') if self.options.cache else None
+
+        # Establish which targets are out of date, i.e., anything that feeds them changed since their previous build
+        manifests = {}
+        sources = self.sourceChapters or [self.src_filename]
+        searchDirs = [self.sourceDir, self.imgDir, self.bibDir, self.baseDir]
+        inputs = sources + self.dependencyGraph.dependencies(sources, searchDirs)
+        inputs += self.filterFiles
+        for key in ('--bibliography', '--csl'):
+            if key in self.pandoc_args: inputs.append(self.pandoc_args[key])
+        for i, arg in enumerate(self.readerExtra):
+            if arg.split('=', 1)[0] in ('--bibliography', '--csl'):
+                inputs.append(arg.split('=', 1)[1] if '=' in arg else self.readerExtra[i + 1])
+        buildFormats = []
+        for fmt in formats:
+            manifestArgs = ['pandoc', self.pandocVersion, '-f', pandocExts] + self.parseExtra
+            for key, val in self.pandoc_args.items():
+                if key != '-f': manifestArgs.extend([key, val])
+            for key, val in self.writer_args[fmt].items():
+                manifestArgs.extend([key, val])
+            manifestArgs += self.pandoc_bools + self.readerExtra + self.writerExtra + [self.src_filename]
+            if self.imagePipeline:
+                manifestArgs += ['--image-dpi', str(self.imagePipeline.dpi)]
+            if self.options.diff_against:
+                manifestArgs += ['--diff-against', self.options.diff_against]
+            template = os.path.join(self.templateDir, self.templateFiles[fmt])
+            manifests[fmt] = BuildManifest(cacheDirectory(self.targetDir), self.writer_args[fmt]['-o'])
+            manifests[fmt].compute(manifestArgs, [template] + inputs)
+            self.dependencyGraph.register(self.writer_args[fmt]['-o'], sources, searchDirs,
+                                          [template] + inputs[len(sources):])
+            if not force and manifests[fmt].isCurrent():
+                print('* up-to-date           : ' + self.writer_args[fmt]['-o'])
+            else:
+                buildFormats.append(fmt)
+        self.dependencyGraph.save()
+        if buildFormats:
+            print('* parsed document      : ' + ('cached (' + astKey[:12] + ')' if astFile else 'parsing source'))
+            if self.sourceChapters:
+                docArgs, docReaderExtra = self.subsetBibliography(chapterTexts)
+            else:
+                with codecs.open(self.src_filename, encoding='utf-8', mode='r') as f:
+                    docArgs, docReaderExtra = self.subsetBibliography([f.read()])
+            passes, docArgs, docReaderExtra = self.filterPasses(docArgs, docReaderExtra)
+
+        jobs = {}
+        filterFile = None
+        tempFiles = []
+        if len(buildFormats) == 1:
+            # A single format is filtered and written by one and the same pandoc process
+            fmt = buildFormats[0]
+            pArgs = ['pandoc', '-o', self.writer_args[fmt]['-o'], '-f', 'json']
+            for key, val in docArgs.items():
+                if key != '-f': pArgs.extend([key, val])
+            for key, val in self.writer_args[fmt].items():
+                if key != '-o': pArgs.extend([key, val])
+            pArgs.extend(self.pandoc_bools)
+            # Add non-parsed, additional arguments from the command line, if any
+            pArgs.extend(docReaderExtra + self.writerExtra)
+            jobs[fmt] = pArgs
+        elif buildFormats:
+            # Several formats: apply the filters and metadata once, which results in a document that is handed to a writer per format
+            import tempfile
 
-with cd(baseDir):
-    print('* Running \n{}\n'.format(str(pArgs)))
+            filterFd, filterFile = tempfile.mkstemp(prefix=os.path.splitext(self.sourceFile)[0] + '-', suffix='.json')
+            os.close(filterFd)
+            filterArgs = ['pandoc', '-f', 'json', '-t', 'json', '-o', filterFile]
+            for key, val in docArgs.items():
+                if key != '-f': filterArgs.extend([key, val])
+            filterArgs.extend(docReaderExtra)
+            for fmt in buildFormats:
+                pArgs = ['pandoc', '-f', 'json', '-o', self.writer_args[fmt]['-o'], '--data-dir', self.baseDir]
+                for key, val in self.writer_args[fmt].items():
+                    if key != '-o': pArgs.extend([key, val])
+                pArgs.extend(self.pandoc_bools)
+                pArgs.extend(self.writerExtra)
+                pArgs.append(filterFile)
+                jobs[fmt] = pArgs
 
-    # check whether results file is still open, and notify the user
+        with cd(self.baseDir):
+            # check whether results files are still open, and notify the user
+            for fmt in buildFormats:
+                if is_open(os.path.join(self.targetDir, self.targetFiles[fmt])):
+                    print("WARNING: Close the target file ({}) immediately".format(self.targetFiles[fmt]))
 
-    if is_open(os.path.join(targetDir, targetFile)):
-        print("WARNING: Close the target file ({}) immediately".format(targetFile))
+            rcs = {}
+            rc: int = 0
+            if buildFormats and not astFile and self.sourceChapters:
+                rc, parsedFile = self.parseChapters(chapterTexts, chapterKeys)
+                if rc == 0 and self.options.cache:
+                    astFile = self.astCache.put(astKey, parsedFile, '.json')
+                elif rc == 0:
+                    astFile = parsedFile
+            elif buildFormats and not astFile:
+                # Parse the source into the AST, and keep it for later runs
+                parsedFile = self.astCache.tempfile('.json')
+                parseArgs = ['pandoc', '-f', self.pandoc_args['-f'], '-t', 'json', '-o', parsedFile] + self.parseExtra + [self.src_filename]
+                print('* Parsing \n{}\n'.format(str(parseArgs)))
+                _, rc = self.runPandoc('json', parseArgs)
+                if rc == 0 and self.options.cache:
+                    astFile = self.astCache.put(astKey, parsedFile, '.json')
+                elif rc == 0:
+                    astFile = parsedFile
+                else:
+                    os.remove(parsedFile)
+            docAst = astFile
+            if rc == 0 and buildFormats and self.options.diff_against:
+                with self.trace.phase('redline'):
+                    rc, docAst = self.redline(astFile)
+                if docAst:
+                    tempFiles.append(docAst)
+            if rc == 0 and len(buildFormats) == 1:
+                rc, docFile = self.runFilterPasses(passes, docAst, buildFormats[0], tempFiles)
+            if rc == 0 and len(buildFormats) == 1:
+                chainFile = self.astCache.tempfile('.json')
+                tempFiles.append(chainFile)
+                with self.trace.phase('filters'):
+                    if self.filterChain(buildFormats[0]).run(docFile, buildFormats[0], chainFile):
+                        docFile = chainFile
+                jobs[buildFormats[0]].append(docFile)
+                print('* Running \n{}\n'.format(str(jobs[buildFormats[0]])))
+                _, rcs[buildFormats[0]] = self.runPandoc(buildFormats[0], jobs[buildFormats[0]])  # Do the actual pandoc operation and safe its return value
+            elif rc == 0 and buildFormats:
+                from concurrent.futures import ThreadPoolExecutor
 
-    rc: int = subprocess.call(pArgs)  # Do the actual pandoc operation and safe its return value
+                # The in-process filters run once, and see the format 'json' as pandoc's filters do here
+                rc, docFile = self.runFilterPasses(passes, docAst, 'json', tempFiles)
+                if rc == 0:
+                    filterArgs.append(docFile)
+                    print('* Filtering \n{}\n'.format(str(filterArgs)))
+                    with self.trace.phase('pandoc filter'):
+                        rc = subprocess.call(filterArgs)
+                if rc == 0:
+                    # Each format gets its own copy of the document when doPandoc's own filters change it (e.g. when
+                    # its images are replaced by derived ones)
+                    for fmt in buildFormats:
+                        chainFile = self.astCache.tempfile('.json')
+                        tempFiles.append(chainFile)
+                        with self.trace.phase('filters'):
+                            if self.filterChain(fmt).run(filterFile, fmt, chainFile):
+                                jobs[fmt][-1] = chainFile
+                if rc == 0:
+                    # The writers are independent pandoc processes; the threads merely wait for them
+                    for fmt in buildFormats:
+                        print('* Running \n{}\n'.format(str(jobs[fmt])))
+                    with ThreadPoolExecutor(max_workers=len(buildFormats)) as pool:
+                        for fmt, rc in pool.map(self.runPandoc, buildFormats, [jobs[fmt] for fmt in buildFormats]):
+                            rcs[fmt] = rc
+            if rc != 0 and not rcs:
+                for fmt in buildFormats: rcs[fmt] = rc
+            for fmt in formats:
+                if fmt not in buildFormats:
+                    rcs[fmt] = 0  # up-to-date
+                elif rcs[fmt] == 0:
+                    manifests[fmt].save()
+                else:
+                    # pandoc ran into problems. Hence, no result was delivered and therefore the source documents contain errors.
+                    print("\n>>>> ERROR: pandoc returned with {} for format {}".format(rcs[fmt], fmt))
+            if filterFile:
+                os.remove(filterFile)
+            for tempFile in tempFiles:
+                if os.path.exists(tempFile):
+                    os.remove(tempFile)
+            if astFile and not self.options.cache:
+                os.remove(astFile)
+        return rcs
 
-    if rc == 0:  # When pandoc didn't complain, we can push the current documents to git, and finally open the resulting file
-        # if version and not version == 'v0.0-0':
-        # major, minor = version[1:].split('-')[0].split('.')
-        # else:
-        # major = minor = None
-        # gitCommit(project=project, msg=gitMessage, major=major, minor=minor)
 
+def build(source, formats, options=None, extra=(), pool=None):
+    # Build the document, as 'doPandoc <source> <formats> [options] [extra]' does, in the project in the current working
+    # directory: commit the sources (when git is used), render the targets and push. Safe to call repeatedly within one
+    # process, e.g. for a batch of documents; pandoc is probed only once.
+    # source: the name of the source file; formats: a list of target formats, or a comma separated string
+    # options: dict or argparse.Namespace of options (see buildOptions); extra: pandoc arguments that are passed through
+    # pool: a PandocServerPool to render on, e.g. kept warm over several builds; by default, one is started for --pool
+    # Return: BuildResult
+    trace = Trace()
+    with trace.phase('arguments'):
+        options = buildOptions(options)
+        document = Document(source, formatList(formats) if isinstance(formats, str) else formats, options, extra, pool,
+                            trace)
+    with document.gitLock():
+        myGit, version = document.commitSources()
+    with trace.phase('arguments'):
+        document.configure(version)
+    ownPool = None
+    if pool is None and options.pool:
+        ownPool = document.pandocPool = PandocServerPool(size=options.pool)
+        print('* pandoc servers       : ' + (str(len(ownPool.servers)) if ownPool.available else 'none available, using pandoc processes'))
+    try:
+        with trace.phase('render'):
+            result = BuildResult(document, document.render(force=options.force), version)
+    finally:
+        if ownPool:
+            ownPool.close()
+            document.pandocPool = None
+    if result.ok and myGit:
+        # When pandoc didn't complain, we can push the current documents to git
         # pandoc ran perfectly, hence no issues in its sources. Hence we can push the sources to the server, if any
-        if gitMessage != 'no-git':
-            _ = myGit.push()
+        with cd(document.baseDir), trace.phase('push'), document.gitLock():
+            _ = myGit.push(queue=True)
+    elif myGit:
+        # Retry the pushes that earlier builds left pending, if any
+        with cd(document.baseDir):
+            pushQueue = PushQueue.find()
+            if pushQueue:
+                pushQueue.report()
+                pushQueue.start()
+    result.trace = trace
+    if options.trace:
+        traceFile = os.path.join(document.baseDir, document.targetDir, os.path.splitext(document.sourceFile)[0] + '.trace.json')
+        trace.save(traceFile, source=document.src_filename, formats=document.formats, version=version,
+                   pandoc=document.pandocVersion, returnCodes=result.returnCodes)
+        trace.summary()
+        print('* trace written to     : ' + os.path.relpath(traceFile, document.baseDir))
+    return result
+
+
+def batchRender(project, source, formats, options, extra, version):
+    # Render one document of a batch (see buildAll) in a worker process, the sources having been committed already
+    # Return: dict with 'returnCodes', 'targetFiles', 'seconds' and 'log' (the console output of the build), or with
+    # 'error', 'seconds' and 'log' when the document could not be built
+    import contextlib
+    import io
+    import time
+    import traceback
+    log = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(log), cd(project):
+            document = Document(source, formats, options, extra, servePool)
+            document.configure(version)
+            result = BuildResult(document, document.render(force=options.force), version)
+        return {'returnCodes': result.returnCodes, 'targetFiles': result.targetFiles,
+                'seconds': time.perf_counter() - start, 'log': log.getvalue()}
+    except InputError as e:
+        return {'error': str(e), 'seconds': time.perf_counter() - start, 'log': log.getvalue()}
+    except Exception as e:
+        return {'error': '{}: {}'.format(type(e).__name__, e), 'seconds': time.perf_counter() - start,
+                'log': log.getvalue() + traceback.format_exc()}
+
+
+def buildAll(pattern, formats, options=None, extra=()):
+    # Build all sources in the docs directory whose name matches the (glob) pattern, as 'doPandoc --all <formats>' and
+    # 'doPandoc "<pattern>" <formats>' do, in the project in the current working directory (see discoverSources). The
+    # sources are committed once for the batch (when git is used), the documents are rendered by a pool of worker
+    # processes, and pushed once. A document that fails does not stop the others.
+    # Return: dict of source: the outcome of its build (see batchRender)
+    import multiprocessing
+    import time
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    options = buildOptions(options)
+    formats = formatList(formats) if isinstance(formats, str) else formats
+    if options.watch:
+        raise InputError('cannot watch a batch of documents', '--watch')
+    mmdDir = os.path.join(options.sDir, 'docs')
+    sources = discoverSources(mmdDir, pattern, options.chapters)
+    if not sources:
+        raise InputError('no sources found', os.path.join(os.getcwd(), mmdDir, pattern))
+    start = time.perf_counter()
+
+    # One commit (and version) for the batch, made through the first document that can be set up; a source that
+    # cannot fails in its worker, as it would without git
+    myGit, version, document = None, '', None
+    if options.git != 'no-git':
+        for source, chapters in sources:
+            try:
+                document = Document(source, formats, argparse.Namespace(**dict(vars(options), chapters=chapters)), extra)
+                break
+            except InputError as e:
+                print('* {:<21}: ERROR {}'.format(source, e))
+        if document:
+            with document.gitLock():
+                myGit, version = document.commitSources()
+
+    # Each document renders its formats in parallel already, hence the documents share the cores
+    jobs = min(options.jobs or max(1, (os.cpu_count() or 1) // len(formats)), len(sources))
+    print('* batch                : {} documents, {} at a time'.format(len(sources), jobs))
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=serveWorker, initargs=(options.pool,)) as pool:
+        futures = {pool.submit(batchRender, os.getcwd(), source, formats,
+                               argparse.Namespace(**dict(vars(options), chapters=chapters)), list(extra), version): source
+                   for source, chapters in sources}
+        for future in as_completed(futures):
+            source = futures[future]
+            try:
+                results[source] = future.result()
+            except Exception as e:  # e.g. a worker that died
+                results[source] = {'error': '{}: {}'.format(type(e).__name__, e), 'seconds': 0, 'log': ''}
+            outcome = results[source]
+            print('* {:<21}: {} ({:.1f} s)'.format(source, 'ERROR ' + outcome['error'] if 'error' in outcome else ', '.join(
+                fmt + (' ok' if rc == 0 else ' failed ({})'.format(rc)) for fmt, rc in outcome['returnCodes'].items()),
+                outcome['seconds']))
+
+    failed = sorted(source for source, outcome in results.items()
+                    if 'error' in outcome or any(rc != 0 for rc in outcome['returnCodes'].values()))
+    for source in failed:
+        print('\n>>>> ERROR: {} failed; its output:\n{}'.format(source, results[source]['log'].rstrip()))
+    print('* batch done           : {} of {} documents built in {:.1f} s ({:.1f} s of build time)'.format(
+        len(results) - len(failed), len(results), time.perf_counter() - start,
+        sum(outcome['seconds'] for outcome in results.values())))
+    if failed:
+        print('* failed               : ' + ', '.join(failed))
+
+    if myGit and not failed:
+        with cd(document.baseDir), document.gitLock():
+            _ = myGit.push(queue=True)
+    elif myGit:
+        with cd(document.baseDir):
+            pushQueue = PushQueue.find()
+            if pushQueue:
+                pushQueue.report()
+                pushQueue.start()
+    return results
+
+
+def main(argv=None):
+    # The doPandoc command line
+    # Return: the exit status
+    argv = sys.argv[1:] if argv is None else argv
+
+    # Commands that do not build a document
+    if argv and argv[0] == 'cache':
+        cacheCommand(argv[1:])
+        return 0
+    if argv and argv[0] == 'pool-bench':
+        poolBenchCommand(argv[1:])
+        return 0
+    if argv and argv[0] == 'bench':
+        benchCommand(argv[1:])
+        return 0
+    if argv and argv[0] == 'push-queue':
+        pushQueueCommand(argv[1:])
+        return 0
+    if argv and argv[0] == 'deps':
+        depsCommand(argv[1:])
+        return 0
+    if argv and argv[0] == 'serve':
+        serveCommand(argv[1:])
+        return 0
+
+    # Get all arguments and ACK the command; --all stands for the source pattern that matches every source
+    if '--all' in argv:
+        argv = ['*'] + list(argv)
+    args = argumentParser().parse_known_args(argv)
+    if args[0].all or any(c in args[0].source for c in '*?['):
+        try:
+            results = buildAll(args[0].source, args[0].format, args[0], args[1])
+        except InputError as e:
+            print('ERROR: ' + str(e) + '\n')
+            return 1
+        return 0 if all('error' not in outcome and not any(outcome['returnCodes'].values())
+                        for outcome in results.values()) else 1
+
+    # Check first if only the version of the current branched document was requested
+    # if args[0].version:
+    #	print ('* Version of current document branch: ' + Git(None).version())
+    #	exit(0)
+
+    pandocPool = None
+    try:
+        if args[0].pool or args[0].watch:
+            pandocPool = PandocServerPool(size=args[0].pool or default['poolSize'])
+            print('* pandoc servers       : ' + (str(len(pandocPool.servers)) if pandocPool.available else 'none available, using pandoc processes'))
+        result = build(args[0].source, args[0].format, args[0], args[1], pool=pandocPool)
+        document = result.document
+
+        # Open the resulting files
+        with cd(document.baseDir):
+            for fmt in document.formats:
+                if result.returnCodes[fmt] == 0 and args[0].open:
+                    openFile(os.path.join(document.targetDir, document.targetFiles[fmt]))
+
+        ###########
+        # Keep watching the sources, and rebuild the targets when they change. Git is left alone in here.
+        ###########
+        if args[0].watch:
+            watchDirs = [document.mmdDir, document.imgDir, document.bibDir, document.templateDir]
+            watcher = DirectoryWatcher([os.path.join(document.baseDir, d) for d in watchDirs],
+                                       interval=default['watchInterval'])
+            print('* watching             : {} ({}; press Ctrl-C to stop)'.format(', '.join(watchDirs), watcher.method))
+            try:
+                while True:
+                    changed = watcher.wait(debounce=default['watchDebounce'])
+                    print('* changed              : ' + ', '.join(
+                        sorted(os.path.relpath(f, document.baseDir) for f in changed)))
+                    # Only the targets that the changed files feed are rebuilt (see DependencyGraph); a chapter that
+                    # was added or removed changes the document itself, and hence all of its targets
+                    if document.refreshChapters(changed):
+                        formats = list(document.formats)
+                    else:
+                        affected = document.dependencyGraph.affected(changed)
+                        formats = [fmt for fmt in document.formats
+                                   if document.dependencyGraph.name(document.writer_args[fmt]['-o']) in affected]
+                    if not formats:
+                        print('* not affected         : ' + ', '.join(document.formats))
+                        continue
+                    rcs = document.render(formats)
+                    print('* rebuilt              : {}'.format(', '.join(
+                        fmt + ('' if rcs[fmt] == 0 else ' (failed)') for fmt in formats)))
+            except KeyboardInterrupt:
+                print('* stopped watching')
+            finally:
+                watcher.close()
+    except InputError as e:
+        print('ERROR: ' + str(e) + '\n')
+        print('Type \'doPandoc -h\' for help\n')
+        return 1
+    finally:
+        if pandocPool:
+            pandocPool.close()
+
+    print('* Done!')
+    print('*')
+    print('**********************\n')
+    return 0 if result.ok else 1
 
-        os.startfile(os.path.join(targetDir, targetFile), 'open')
-    else:
-        # pandoc ran into problems. Hence, no result was delivered and therefore the source documents contain errors. Do a roll-back on git to the original state.
-        print("\n>>>> ERROR: pandoc returned with {}".format(rc))
 
-print('* Done!')
-print('*')
-print('**********************\n')
+if __name__ == '__main__':
+    sys.exit(main())
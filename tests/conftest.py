@@ -0,0 +1,90 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def tools(tmp_path, monkeypatch):
+    # Return: a function that writes a stand-in for the given executable (a Python script) into a directory that is put
+    # ahead on the PATH
+    binDir = tmp_path / 'bin'
+    binDir.mkdir()
+    monkeypatch.setenv('PATH', str(binDir) + os.pathsep + os.environ.get('PATH', ''))
+
+    def tool(name, script):
+        filename = binDir / name
+        filename.write_text('#!' + sys.executable + '\n' + script)
+        filename.chmod(0o755)
+        return str(filename)
+
+    return tool
+
+
+# A pandoc that logs its argument vectors, and writes its output: a document without content as JSON AST, and the
+# arguments it got otherwise
+standInPandoc = r'''
+import json, sys
+args = sys.argv[1:]
+with open(LOG, 'a') as f:
+    f.write(json.dumps(args) + '\n')
+if args == ['-v']:
+    print('pandoc 2.19.2')
+    sys.exit(0)
+to = args[args.index('-t') + 1] if '-t' in args else None
+out = args[args.index('-o') + 1] if '-o' in args else None
+if to == 'json':
+    content = json.dumps({'pandoc-api-version': [1, 22, 2], 'meta': {}, 'blocks': []})
+else:
+    content = ' '.join(args)
+if out:
+    with open(out, 'w') as f:
+        f.write(content)
+else:
+    print(content)
+'''
+
+
+class Project:
+    """A project directory (the current working directory) with a document, its template, and a stand-in pandoc"""
+
+    def __init__(self, directory, tools):
+        self.dir = directory
+        self.pandocLog = directory.parent / 'pandoc.log'
+        tools('pandoc', 'LOG = {!r}\n'.format(str(self.pandocLog)) + standInPandoc)
+        for sub in ('src/docs', 'src/bib', 'src/images', 'templates', 'results'):
+            (directory / sub).mkdir(parents=True)
+        (directory / 'src' / 'docs' / 'doc.mmd').write_text('---\ntitle: A document\n---\n\n# Introduction\n\nText.\n')
+        (directory / 'templates' / 'pandoc-docstyle.tex').write_text('$body$\n')
+        (directory / 'templates' / 'pandoc-docstyle.docx').write_bytes(b'docx')
+
+    def pandocRuns(self):
+        # Return: the argument vectors of the pandoc runs so far, except for its version probes
+        import json
+        if not self.pandocLog.exists():
+            return []
+        return [args for args in map(json.loads, self.pandocLog.read_text().splitlines()) if args != ['-v']]
+
+
+@pytest.fixture
+def project(tmp_path, tools, monkeypatch):
+    directory = tmp_path / 'Thesis'
+    directory.mkdir()
+    monkeypatch.chdir(directory)
+    return Project(directory, tools)
+
+
+@pytest.fixture
+def repository(project, tmp_path, monkeypatch):
+    # The project directory as a git repository with one commit, and git configured apart from the user's own settings
+    import subprocess
+    config = tmp_path / 'gitconfig'
+    config.write_text('[user]\n\tname = Tester\n\temail = tester@example.org\n[init]\n\tdefaultBranch = master\n')
+    monkeypatch.setenv('GIT_CONFIG_GLOBAL', str(config))
+    monkeypatch.setenv('GIT_CONFIG_NOSYSTEM', '1')
+    monkeypatch.setenv('GIT_TERMINAL_PROMPT', '0')
+    for args in (['init', '-q'], ['add', '-A'], ['commit', '-q', '-m', 'First commit']):
+        subprocess.run(['git'] + args, check=True)
+    return project
@@ -0,0 +1,25 @@
+import argparse
+
+import pytest
+
+import doPandoc
+
+
+def test_format_list():
+    assert doPandoc.formatList('pdf') == ['pdf']
+    assert doPandoc.formatList('PDF, docx,tex,pdf') == ['pdf', 'docx', 'tex']
+    with pytest.raises(argparse.ArgumentTypeError):
+        doPandoc.formatList('pdf,html')
+
+
+def test_split_pass_through():
+    parse, reader, writer = doPandoc.splitPassThrough(['--toc', '-M', 'lang=nl', '-Mdraft=true', '--csl=ieee.csl',
+                                                       '--filter', 'pandoc-crossref', '--shift-heading-level-by', '1',
+                                                       '--number-offset', '2'])
+    assert parse == ['--shift-heading-level-by', '1']
+    assert reader == ['-M', 'lang=nl', '-Mdraft=true', '--csl=ieee.csl', '--filter', 'pandoc-crossref']
+    assert writer == ['--toc', '--number-offset', '2']
+
+
+def test_split_pass_through_trailing_option():
+    assert doPandoc.splitPassThrough(['--bibliography']) == ([], ['--bibliography'], [])
@@ -0,0 +1,50 @@
+import os
+import re
+import subprocess
+
+import doPandoc
+
+
+def contents(directory):
+    # Return: dict of relative path: content of all files in the given directory
+    found = {}
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            with open(os.path.join(root, filename), 'rb') as f:
+                found[os.path.relpath(os.path.join(root, filename), directory)] = f.read()
+    return found
+
+
+def test_bench_project(tmp_path):
+    assert doPandoc.benchProject(str(tmp_path / 'one' / 'Bench'), chapters=3, citations=4, bibSize=20, images=2) == 'synthetic'
+    doPandoc.benchProject(str(tmp_path / 'two' / 'Bench'), chapters=3, citations=4, bibSize=20, images=2)
+    doPandoc.benchProject(str(tmp_path / 'three' / 'Bench'), chapters=3, citations=4, bibSize=20, images=2, seed=2)
+    one = contents(str(tmp_path / 'one' / 'Bench'))
+    assert one == contents(str(tmp_path / 'two' / 'Bench'))
+    assert one != contents(str(tmp_path / 'three' / 'Bench'))
+
+    text = one[os.path.join('src', 'docs', 'synthetic.mmd')].decode('utf-8')
+    assert doPandoc.frontMatter(str(tmp_path / 'one' / 'Bench' / 'src' / 'docs' / 'synthetic.mmd'))['bibliography'] == \
+        'src/bib/bench.bib'
+    assert len(re.findall(r'^# Chapter', text, re.M)) == 3
+    assert len(re.findall(r'\[@key\d{5}\]', text)) == 3 * 4
+    assert len(re.findall(r'^@article\{', one[os.path.join('src', 'bib', 'bench.bib')].decode('utf-8'), re.M)) == 20
+    figure = one[os.path.join('src', 'images', 'figure-2.png')]
+    assert figure.startswith(b'\x89PNG\r\n\x1a\n')
+    assert os.path.join('Bench.scriv', 'Files', 'Docs', '3.rtf') in one
+    assert os.path.join('Bench.scriv', 'Files', 'Docs', '3_synopsis.txt') in one
+
+
+def test_bench_tools(tmp_path):
+    directory = doPandoc.benchTools(str(tmp_path / 'bin'))
+    env = dict(os.environ, PATH=directory + os.pathsep + os.environ['PATH'])
+
+    def run(*args):
+        return subprocess.run(list(args), env=env, cwd=str(tmp_path), stdout=subprocess.PIPE, check=True).stdout.decode()
+
+    assert run('pandoc', '-v').strip() == 'pandoc 2.19.2'
+    (tmp_path / 'refs.bib').write_text('@book{one,\n}\n@article{two,\n}\n')
+    assert run('pandoc', '-t', 'csljson', 'refs.bib') == '[{"id": "one", "type": "article-journal"}, ' \
+                                                           '{"id": "two", "type": "article-journal"}]\n'
+    assert run('git', 'describe', '--tags').strip() == 'v1.2-3-gabcdef0'
+    assert '# branch.head master' in run('git', 'status', '--porcelain=v2', '--branch')
@@ -0,0 +1,161 @@
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import doPandoc
+from conftest import standInPandoc
+
+
+def test_build_options():
+    options = doPandoc.buildOptions({'rDir': 'out'})
+    assert options.rDir == 'out' and options.dDir == 'templates' and options.git == 'no-git'
+    assert doPandoc.buildOptions(options) is options
+    with pytest.raises(ValueError):
+        doPandoc.buildOptions({'nonsense': True})
+
+
+def test_argument_parser():
+    args, extra = doPandoc.argumentParser().parse_known_args(['doc', 'pdf,docx', '-g', 'message', '--toc'])
+    assert (args.source, args.format, args.git, extra) == ('doc', ['pdf', 'docx'], 'message', ['--toc'])
+
+
+def test_pandoc_info(project, monkeypatch):
+    monkeypatch.setattr(doPandoc, 'pandocProbes', {})
+    assert doPandoc.pandocInfo('.doPandoc') == {'version': '2.19.2', 'server': False}
+    assert doPandoc.pandocInfo('.doPandoc')['version'] == '2.19.2'
+    # The next process takes it from the cache directory
+    monkeypatch.setattr(doPandoc, 'pandocProbes', {})
+    assert doPandoc.pandocInfo('.doPandoc')['version'] == '2.19.2'
+    assert [json.loads(line) for line in project.pandocLog.read_text().splitlines()] == [['-v']]
+
+
+def test_build(project):
+    result = doPandoc.build('doc', 'tex,docx')
+    assert result.ok and set(result.returnCodes) == {'tex', 'docx'}
+    assert (project.dir / 'results' / 'doc.tex').exists() and (project.dir / 'results' / 'doc.docx').exists()
+    assert not [name for name in os.listdir(str(project.dir / 'results')) if '.tmp' in name]
+    runs = project.pandocRuns()
+    # A parse, the filters that the formats share, and a writer per format
+    assert len(runs) == 4 and runs[0][runs[0].index('-t') + 1] == 'json'
+    # Nothing changed
+    assert doPandoc.build('doc', ['tex', 'docx']).ok
+    assert len(project.pandocRuns()) == 4
+
+
+def test_build_missing_source(project):
+    with pytest.raises(doPandoc.InputError):
+        doPandoc.build('missing', 'tex')
+
+
+def test_main_reports_input_errors(project, capsys):
+    assert doPandoc.main(['missing', 'tex', '--no-open']) == 1
+    assert 'ERROR: source file not found' in capsys.readouterr().out
+
+
+def test_build_trace(project, capsys):
+    result = doPandoc.build('doc', 'tex', {'trace': True})
+    names = {name for name, *_ in result.trace.totals()}
+    assert {'arguments', 'pandoc probe', 'render', 'pandoc parse', 'pandoc tex'} <= names
+    saved = json.loads((project.dir / 'results' / 'doc.trace.json').read_text())
+    assert saved['metadata']['formats'] == ['tex']
+    assert {e['name'] for e in saved['traceEvents']} == names
+    out = capsys.readouterr().out
+    assert 'phase (seconds)' in out
+    assert 'trace written to     : ' + os.path.join('results', 'doc.trace.json') in out
+
+
+def test_build_git(repository, tmp_path, monkeypatch):
+    def git(*args):
+        return subprocess.run(['git'] + list(args), stdout=subprocess.PIPE, check=True).stdout.decode('utf-8').strip()
+
+    git('init', '-q', '--bare', str(tmp_path / 'remote.git'))
+    git('remote', 'add', 'origin', str(tmp_path / 'remote.git'))
+    git('tag', '-a', 'v0.1', '-m', 'Version v0.1')
+    monkeypatch.setattr(doPandoc.PushQueue, 'start', lambda self: False)
+    (repository.dir / 'src' / 'docs' / 'doc.mmd').write_text('# Introduction\n\nChanged text.\n')
+    result = doPandoc.build('doc', 'tex', {'git': 'Changed the introduction'})
+    assert result.ok and result.version == 'v0.2-0'
+    assert git('log', '-1', '--format=%s') == 'Changed the introduction'
+    assert git('describe', '--tags') == 'v0.2'
+    assert [e['branch'] for e in doPandoc.PushQueue.find().entries()] == ['master']
+    # The lock that serialised the git operations is released
+    assert (repository.dir / '.doPandoc').is_dir()
+    assert not (repository.dir / '.doPandoc' / 'project.lock').exists()
+
+
+def test_build_git_unchanged(repository, tools, tmp_path, monkeypatch):
+    # A git that logs its commands before it runs them
+    log = tmp_path / 'git.log'
+    tools('git', 'import os, sys\nwith open({!r}, "a") as f:\n    f.write(" ".join(sys.argv[1:]) + "\\n")\n'
+                 'os.execv({!r}, [{!r}] + sys.argv[1:])\n'.format(str(log), shutil.which('git'), 'git'))
+    subprocess.run(['git', 'init', '-q', '--bare', str(tmp_path / 'remote.git')], check=True)
+    subprocess.run(['git', 'remote', 'add', 'origin', str(tmp_path / 'remote.git')], check=True)
+    monkeypatch.setattr(doPandoc.PushQueue, 'start', lambda self: False)
+    (repository.dir / 'src' / 'docs' / 'doc.mmd').write_text('# Introduction\n\nChanged text.\n')
+    assert doPandoc.build('doc', 'tex', {'git': 'Changed the introduction'}).ok
+    assert log.read_text()
+    # An unchanged build establishes the state of the repository, and that nothing changed, without git
+    log.write_text('')
+    assert doPandoc.build('doc', 'tex', {'git': 'Nothing changed'}).ok
+    assert log.read_text() == ''
+
+
+def test_discover_sources(tmp_path):
+    docs = tmp_path / 'docs'
+    (docs / 'book' / 'chapters').mkdir(parents=True)
+    (docs / 'compiled').mkdir()
+    (docs / 'empty').mkdir()
+    for name in ('intro.mmd', 'notes.txt', 'figure.png', 'preamble.mmd', 'user.mmd', '.hidden.md', 'compiled/compiled',
+                 'book/1 First.md', 'book.mmd'):
+        (docs / name).write_text('# Text\n')
+    (docs / 'chapters').mkdir()
+    (docs / 'chapters' / '1 One.md').write_text('# One\n')
+    assert doPandoc.discoverSources(str(docs)) == [('book.mmd', False), ('compiled', False), ('intro.mmd', False),
+                                                   ('notes.txt', False)]
+    # The chapter directory book and the source book.mmd would build the same targets: the first one is taken
+    assert doPandoc.discoverSources(str(docs), chapters=True) == [('book', True), ('chapters', True),
+                                                                  ('compiled', False), ('intro.mmd', False),
+                                                                  ('notes.txt', False)]
+    assert doPandoc.discoverSources(str(docs), 'in*') == [('intro.mmd', False)]
+    assert doPandoc.discoverSources(str(docs), 'intro') == [('intro.mmd', False)]
+
+
+def test_build_all(project, tools, capsys):
+    # A pandoc that fails on the source named 'broken'
+    tools('pandoc', 'LOG = {!r}\n'.format(str(project.pandocLog)) + 'import sys\nif any("broken" in a for a in sys.argv):\n'
+          '    sys.exit(3)\n' + standInPandoc)
+    for name in ('one', 'two', 'broken'):
+        (project.dir / 'src' / 'docs' / (name + '.mmd')).write_text('# {}\n'.format(name))
+    assert doPandoc.main(['ne', 'tex', '--no-open']) == 1  # not a pattern, hence a source that does not exist
+    assert doPandoc.main(['t*', 'tex', '--no-open', '-j', '2']) == 0
+    assert (project.dir / 'results' / 'two.tex').exists() and not (project.dir / 'results' / 'one.tex').exists()
+    capsys.readouterr()
+
+    assert doPandoc.main(['--all', 'tex', '--no-open']) == 1
+    out = capsys.readouterr().out
+    assert '* batch                : 4 documents' in out
+    assert '>>>> ERROR: broken.mmd failed' in out
+    assert '3 of 4 documents built' in out
+    assert '* failed               : broken.mmd' in out
+    assert all((project.dir / 'results' / (name + '.tex')).exists() for name in ('doc', 'one', 'two'))
+
+
+def test_build_all_git(repository, monkeypatch, capsys):
+    # The first source cannot be set up (it went away after it was found): the batch commits through the next one
+    monkeypatch.setattr(doPandoc, 'discoverSources', lambda *args, **kwargs: [('gone.mmd', False), ('doc.mmd', False)])
+    monkeypatch.setattr(doPandoc.PushQueue, 'start', lambda self: False)
+    (repository.dir / 'src' / 'docs' / 'doc.mmd').write_text('# Introduction\n\nChanged text.\n')
+    assert doPandoc.main(['--all', 'tex', '--no-open', '-g', 'Batch of changes']) == 1
+    out = capsys.readouterr().out
+    assert 'gone.mmd' in out and 'source file not found' in out
+    assert '1 of 2 documents built' in out
+    assert subprocess.run(['git', 'log', '-1', '--format=%s'], stdout=subprocess.PIPE,
+                          check=True).stdout.decode('utf-8').strip() == 'Batch of changes'
+
+
+def test_build_all_nothing(project, capsys):
+    assert doPandoc.main(['x*', 'tex', '--no-open']) == 1
+    assert 'no sources found' in capsys.readouterr().out
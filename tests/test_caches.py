@@ -0,0 +1,145 @@
+import json
+import os
+
+import doPandoc
+
+
+def addEntry(cache, key, size, mtime):
+    temp = cache.tempfile()
+    with open(temp, 'wb') as f:
+        f.write(b'x' * size)
+    path = cache.put(key, temp)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_filecache_key():
+    assert doPandoc.FileCache.key('a', 'b') == doPandoc.FileCache.key(b'a', 'b')
+    assert doPandoc.FileCache.key('ab') != doPandoc.FileCache.key('a', 'b')
+
+
+def test_filecache_evicts_least_recently_used(tmp_path):
+    cache = doPandoc.FileCache(str(tmp_path), 'test', maxSize=250)
+    addEntry(cache, 'a', 100, 1000)
+    addEntry(cache, 'b', 100, 2000)
+    os.utime(cache.get('a'), (3000, 3000))  # a hit, as get() makes it
+    addEntry(cache, 'c', 100, 4000)
+    assert cache.get('b') is None
+    assert cache.get('a') and cache.get('c')
+    assert cache.info() == (2, 200)
+
+
+def test_filecache_keeps_the_entry_just_put(tmp_path):
+    cache = doPandoc.FileCache(str(tmp_path), 'test', maxSize=50)
+    addEntry(cache, 'a', 10, 1000)
+    addEntry(cache, 'big', 100, 2000)
+    assert cache.get('a') is None
+    assert cache.get('big')
+
+
+def test_filecache_unbounded(tmp_path):
+    cache = doPandoc.FileCache(str(tmp_path), 'test')
+    for n in range(5):
+        addEntry(cache, str(n), 100, 1000 + n)
+    cache.tempfile()  # a temporary file is not an entry
+    assert cache.info() == (5, 500)
+    assert cache.clear() == 5
+    assert cache.get('0') is None
+
+
+def test_cache_directory():
+    assert doPandoc.cacheDirectory('results') == '.doPandoc'
+    assert doPandoc.cacheDirectory(os.path.join('out', 'results', '')) == os.path.join('out', '.doPandoc')
+
+
+def build(tmp_path, args):
+    # Return: the manifest of a build of the target from the source, as established before running pandoc
+    manifest = doPandoc.BuildManifest(str(tmp_path / 'cache'), str(tmp_path / 'doc.docx'))
+    manifest.compute(args, [str(tmp_path / 'doc.mmd'), str(tmp_path / 'missing.csl')])
+    return manifest
+
+
+def test_manifest_up_to_date(tmp_path):
+    (tmp_path / 'doc.mmd').write_text('# Title\n')
+    args = ['pandoc', '-o', str(tmp_path / 'doc.docx')]
+    manifest = build(tmp_path, args)
+    assert not manifest.isCurrent()  # never built
+    (tmp_path / 'doc.docx').write_bytes(b'docx')
+    manifest.save()
+    assert build(tmp_path, args).isCurrent()
+    assert not build(tmp_path, args + ['--toc']).isCurrent()
+
+
+def test_manifest_input_changed(tmp_path):
+    (tmp_path / 'doc.mmd').write_text('# Title\n')
+    (tmp_path / 'doc.docx').write_bytes(b'docx')
+    build(tmp_path, ['pandoc']).save()
+    (tmp_path / 'doc.mmd').write_text('# Other title\n')
+    assert not build(tmp_path, ['pandoc']).isCurrent()
+    (tmp_path / 'missing.csl').write_text('<style/>')  # an input that appeared
+    assert not build(tmp_path, ['pandoc']).isCurrent()
+
+
+def test_manifest_target_touched(tmp_path):
+    (tmp_path / 'doc.mmd').write_text('# Title\n')
+    (tmp_path / 'doc.docx').write_bytes(b'docx')
+    build(tmp_path, ['pandoc']).save()
+    st = os.stat(str(tmp_path / 'doc.docx'))
+    os.utime(str(tmp_path / 'doc.docx'), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert not build(tmp_path, ['pandoc']).isCurrent()
+    os.remove(str(tmp_path / 'doc.docx'))
+    assert not build(tmp_path, ['pandoc']).isCurrent()
+
+
+# A pandoc that converts a bibliography to CSL JSON (entries with their key and title only), and logs its runs
+bibPandoc = r'''
+import json, re, sys
+args = sys.argv[1:]
+with open(LOG, 'a') as f:
+    f.write(' '.join(args) + '\n')
+with open(args[-1]) as f:
+    entries = [{'id': key, 'title': title} for key, title in re.findall(r'@\w+\{([^,]+),\s*title = \{([^}]*)\}', f.read())]
+with open(args[args.index('-o') + 1], 'w') as f:
+    json.dump(entries, f)
+'''
+
+
+def test_bib_subset(tmp_path, tools, capsys):
+    log = tmp_path / 'pandoc.log'
+    tools('pandoc', 'LOG = {!r}\n'.format(str(log)) + bibPandoc)
+    (tmp_path / 'refs.bib').write_text('@book{doe99, title = {First}}\n@book{smith04, title = {Second}}\n'
+                                       '@article{lee10, title = {Third}}\n')
+    (tmp_path / 'more.json').write_text('[{"id": "lee10", "title": "Other"}, {"id": "kim12", "title": "Fourth"}]')
+    index = doPandoc.BibIndex(str(tmp_path / 'cache'), '2.19.2')
+    bibFiles = [str(tmp_path / 'refs.bib'), str(tmp_path / 'more.json')]
+    with open(index.subset(bibFiles, {'smith04', 'lee10', 'kim12', 'nobody'})) as f:
+        assert sorted((e['id'], e['title']) for e in json.load(f)) == [('kim12', 'Fourth'), ('lee10', 'Third'),
+                                                                        ('smith04', 'Second')]
+    assert 'citation keys not found in bibliography: nobody' in capsys.readouterr().out
+    # Another selection from the converted bibliography, which is converted once
+    with open(index.subset(bibFiles, {'doe99'})) as f:
+        assert [e['id'] for e in json.load(f)] == ['doe99']
+    assert len(log.read_text().splitlines()) == 1
+    assert '-f biblatex -t csljson' in log.read_text()
+    # A changed bibliography is converted again
+    (tmp_path / 'refs.bib').write_text('@book{doe99, title = {Changed}}\n')
+    with open(doPandoc.BibIndex(str(tmp_path / 'cache'), '2.19.2').subset(bibFiles, {'doe99'})) as f:
+        assert json.load(f) == [{'id': 'doe99', 'title': 'Changed'}]
+    assert len(log.read_text().splitlines()) == 2
+
+
+def test_bib_cache_bounded(tmp_path, tools, monkeypatch):
+    tools('pandoc', 'LOG = {!r}\n'.format(str(tmp_path / 'pandoc.log')) + bibPandoc)
+    (tmp_path / 'refs.bib').write_text('@book{doe99, title = {First}}\n@book{smith04, title = {Second}}\n')
+    monkeypatch.setitem(doPandoc.default, 'bibCacheSize', 1)
+    index = doPandoc.BibIndex(str(tmp_path / 'cache'), '2.19.2')
+    for key in ('doe99', 'smith04'):
+        with open(index.subset([str(tmp_path / 'refs.bib')], {key})) as f:
+            assert [e['id'] for e in json.load(f)] == [key]
+        assert index.cache.info()[0] == 1  # only the entry just put is kept
+
+
+def test_cited_keys():
+    assert doPandoc.citedKeys(['As [@smith04, p. 33; -@doe99] and @lee10. Mail me at me@example.org']) == {
+        'smith04', 'doe99', 'lee10'}
+    assert doPandoc.citedKeys(['---\nnocite: |\n  @*\n---\n']) is None
@@ -0,0 +1,214 @@
+import os
+
+import pytest
+
+import doPandoc
+
+
+def test_document_dependencies(tmp_path):
+    (tmp_path / 'docs').mkdir()
+    (tmp_path / 'images').mkdir()
+    (tmp_path / 'images' / 'figure.png').write_bytes(b'png')
+    (tmp_path / 'docs' / 'local.svg').write_text('<svg/>')
+    source = tmp_path / 'docs' / 'doc.mmd'
+    source.write_text('---\nbibliography: refs.bib\n---\n\n![A figure](figure.png)\n\n![](local.svg)\n\n'
+                      '[plot]: <missing.pdf>\n')
+    found = doPandoc.documentDependencies(str(source), [str(tmp_path / 'images')])
+    assert found == [os.path.join(str(tmp_path / 'images'), 'figure.png'), os.path.join(str(tmp_path / 'docs'), 'local.svg'),
+                     'missing.pdf', 'refs.bib']
+
+
+def header(level, text, identifier):
+    return {'t': 'Header', 'c': [level, [identifier, [], []], [{'t': 'Str', 'c': text}]]}
+
+
+def para(text):
+    return {'t': 'Para', 'c': [{'t': 'Str', 'c': text}]}
+
+
+def ast(blocks, **meta):
+    return {'pandoc-api-version': [1, 23], 'meta': meta, 'blocks': blocks}
+
+
+def test_chapter_files(tmp_path):
+    for name in ('10.mmd', '2.mmd', '1.mmd', '.hidden.mmd', 'notes.rtf'):
+        (tmp_path / name).write_text('')
+    assert [os.path.basename(f) for f in doPandoc.chapterFiles(str(tmp_path))] == ['1.mmd', '2.mmd', '10.mmd']
+
+
+def test_identifiers():
+    assert doPandoc.autoIdentifier('1. The *first* [chapter](x.html)!') == 'the-first-chapter'
+    assert doPandoc.autoIdentifier('2020') == 'section'
+    assert doPandoc.uniqueIdentifier('intro', {'intro', 'intro-1'}) == 'intro-2'
+
+
+def test_chapter_definitions():
+    texts = ['# Introduction\n\n[site]: https://example.org\n', '# Results {#res}\n\nSee [Introduction] and [site].\n']
+    definitions = doPandoc.chapterDefinitions(texts)
+    assert definitions['introduction'] == (0, '[Introduction]: #introduction')
+    assert definitions['results'] == (1, '[Results]: #res')
+    text = doPandoc.chapterText(texts, 1, definitions)
+    assert text.endswith('\n\n[Introduction]: #introduction\n[site]: https://example.org\n')
+    assert doPandoc.chapterText(texts, 0, definitions) == texts[0]
+
+
+def test_merge_asts():
+    link = {'t': 'Link', 'c': [['', [], []], [{'t': 'Str', 'c': 'intro'}], ['#introduction', '']]}
+    first = ast([header(1, 'Introduction', 'introduction'), para('one')], title={'t': 'MetaString', 'c': 'first'})
+    second = ast([header(1, 'Introduction', 'introduction'), {'t': 'Para', 'c': [link]}],
+                 title={'t': 'MetaString', 'c': 'second'})
+    merged = doPandoc.mergeAsts([first, second])
+    assert [block['c'][1][0] for block in merged['blocks'] if block['t'] == 'Header'] == ['introduction', 'introduction-1']
+    assert link['c'][2][0] == '#introduction-1'
+    assert merged['meta']['title']['c'] == 'first'
+
+
+def test_merge_asts_versions():
+    other = ast([para('two')])
+    other['pandoc-api-version'] = [1, 22]
+    with pytest.raises(ValueError):
+        doPandoc.mergeAsts([ast([para('one')]), other])
+
+
+def metadata(tmp_path, text, name='doc.md'):
+    source = tmp_path / name
+    source.write_bytes(text.encode('utf-8'))
+    return doPandoc.frontMatter(str(source))
+
+
+def test_front_matter(tmp_path):
+    meta = metadata(tmp_path, '---\ntitle: "A title"\nbibliography: src/bib/refs.bib\ncategory: draft\n---\n\nText: no.\n')
+    assert meta == {'title': 'A title', 'bibliography': 'src/bib/refs.bib', 'category': 'draft'}
+    assert doPandoc.metadataFiles(meta, 'bibliography') == ['src/bib/refs.bib']
+    assert doPandoc.metadataFiles(meta, 'csl') == []
+    meta = metadata(tmp_path, '\ufeff---\r\nbibliography: [a.bib, "b.json"]\r\nCSL: style.csl\r\n...\r\n')
+    assert meta == {'bibliography': ['a.bib', 'b.json'], 'csl': 'style.csl'}
+    meta = metadata(tmp_path, '---\nbibliography:\n  - a.bib\n  - \'b.bib\'\nauthor:\n  name: Me\n---\n')
+    assert doPandoc.metadataFiles(meta, 'bibliography') == ['a.bib', 'b.bib']
+    assert 'name' not in meta
+    assert metadata(tmp_path, '# No metadata\n\ntitle: no\n') == {}
+    assert metadata(tmp_path, '---\ntitle: never closed\n') == {}
+    assert metadata(tmp_path, '') == {}
+
+
+def test_front_matter_multimarkdown(tmp_path):
+    meta = metadata(tmp_path, 'Title: A title\nBase Header Level: 2\n    continued\nBibliography: refs.bib\n\n# Text\n')
+    assert meta == {'title': 'A title', 'baseheaderlevel': '2 continued', 'bibliography': 'refs.bib'}
+
+
+def test_front_matter_long(tmp_path):
+    # A block that spans several reads, followed by a large body that is not parsed
+    keys = ''.join('key{}: {}\n'.format(i, 'x' * 100) for i in range(100))
+    meta = metadata(tmp_path, '---\n' + keys + 'bibliography: refs.bib\n---\n' + 'body: no\n' * 100000)
+    assert len(meta) == 101
+    assert meta['bibliography'] == 'refs.bib'
+    assert 'body' not in meta
+    # Parsed once per distinct block
+    assert metadata(tmp_path, '---\n' + keys + 'bibliography: refs.bib\n---\nOther text.\n', 'other.md') is meta
+
+
+def test_redline():
+    redline = doPandoc.Redline(date='2024-01-01T00:00:00Z')
+    old = ast([para('front'), header(1, 'One', 'one'), para('kept'), para('old text'), header(1, 'Two', 'two'),
+               para('unchanged'), header(1, 'Gone', 'gone'), para('gone')])
+    new = ast([para('front'), header(1, 'One', 'one'), para('kept'), para('new text'), header(1, 'Two', 'two'),
+               para('unchanged'), {'t': 'HorizontalRule'}])
+    marked, counts = redline.compare(old, new)
+    assert counts == {'chapters': 3, 'inserted': 2, 'deleted': 3}
+    attr = lambda change: ['', [change], [['author', 'doPandoc'], ['date', '2024-01-01T00:00:00Z']]]
+    assert marked['blocks'][:5] == [para('front'), header(1, 'One', 'one'), para('kept'),
+                                    {'t': 'Para', 'c': [{'t': 'Span', 'c': [attr('deletion'), [{'t': 'Str', 'c': 'old text'}]]}]},
+                                    {'t': 'Para', 'c': [{'t': 'Span', 'c': [attr('insertion'), [{'t': 'Str', 'c': 'new text'}]]}]}]
+    assert marked['blocks'][5:7] == [header(1, 'Two', 'two'), para('unchanged')]
+    # A deleted header loses its identifier and its number; a block without text is wrapped
+    assert marked['blocks'][7] == {'t': 'Header', 'c': [1, ['', ['unnumbered'], []], [
+        {'t': 'Span', 'c': [attr('deletion'), [{'t': 'Str', 'c': 'Gone'}]]}]]}
+    assert marked['blocks'][9] == {'t': 'Div', 'c': [attr('insertion'), [{'t': 'HorizontalRule'}]]}
+    assert [b['t'] for b in marked['blocks']] == ['Para', 'Header', 'Para', 'Para', 'Para', 'Header', 'Para', 'Header',
+                                                  'Para', 'Div']
+    assert redline.compare(old, old)[1] == {'chapters': 0, 'inserted': 0, 'deleted': 0}
+
+
+def test_redline_markup():
+    marked, _ = doPandoc.Redline().compare(ast([para('old')]), ast([para('new')]))
+    assert not doPandoc.Redline.markup(marked, 'docx')
+    assert doPandoc.Redline.markup(marked, 'pdf') is not False
+    assert [b['c'][0]['c'][1][0]['t'] for b in marked['blocks']] == ['Strikeout', 'Underline']
+    # Before pandoc knew underlining
+    marked, _ = doPandoc.Redline().compare(ast([para('old')]), ast([para('new')]))
+    marked['pandoc-api-version'] = [1, 20]
+    doPandoc.Redline.markup(marked, 'html')
+    assert [b['c'][0]['c'][1][0]['t'] for b in marked['blocks']] == ['Strikeout', 'Emph']
+
+
+def test_dependency_graph(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ('src/docs', 'src/images', 'src/bib', 'results'):
+        (tmp_path / name).mkdir(parents=True, exist_ok=True)
+    (tmp_path / 'src' / 'docs' / 'thesis.mmd').write_text(
+        '---\nbibliography: refs.bib\n---\n\n{{TOC}}\n\n{{intro.md}}\n\n{{table.*}}\n\n![Plot](plot.png)\n\n'
+        'As @doe99 says [@smith04, p. 3].\n')
+    (tmp_path / 'src' / 'docs' / 'intro.md').write_text('{{nested.md}}\n\nSee [@doe99; @roe10].\n\n[fig]: scan.tiff\n')
+    (tmp_path / 'src' / 'docs' / 'nested.md').write_text('{{intro.md}}\n')  # a cycle
+    (tmp_path / 'src' / 'docs' / 'table.csv').write_text('a,b\n')
+    (tmp_path / 'src' / 'images' / 'plot.png').write_bytes(b'png')
+    (tmp_path / 'src' / 'bib' / 'refs.bib').write_text('')
+    source = os.path.join('src', 'docs', 'thesis.mmd')
+    searchDirs = [os.path.join('src', 'images'), os.path.join('src', 'bib')]
+
+    scans = []
+    scan = doPandoc.DependencyGraph.scan
+    monkeypatch.setattr(doPandoc.DependencyGraph, 'scan', classmethod(lambda cls, f: scans.append(f) or scan(f)))
+    graph = doPandoc.DependencyGraph(os.path.join('.doPandoc'))
+    found = graph.dependencies([source], searchDirs)
+    assert found == [os.path.join('src', 'docs', 'intro.md'), os.path.join('src', 'docs', 'table.csv'),
+                     os.path.join('src', 'images', 'plot.png'), os.path.join('src', 'bib', 'refs.bib'),
+                     os.path.join('src', 'docs', 'nested.md'), 'scan.tiff']
+    assert graph.citations([source]) == ['doe99', 'smith04', 'roe10']
+    graph.register(os.path.join('results', 'thesis.pdf'), [source], searchDirs, ['templates/pandoc-docstyle.tex'])
+    graph.save()
+    assert len(scans) == 4  # the source and its transclusions
+
+    # Another run scans only the sources that changed
+    graph = doPandoc.DependencyGraph(os.path.join('.doPandoc'))
+    assert graph.dependencies([source], searchDirs) == found
+    assert len(scans) == 4
+    (tmp_path / 'src' / 'docs' / 'nested.md').write_text('Nothing transcluded.\n')
+    graph.dependencies([source], searchDirs)
+    assert len(scans) == 5
+
+    # The targets that changed files affect, including files that were missing when the target was built
+    for changed in ('src/docs/thesis.mmd', 'src/docs/table.csv', 'src/bib/refs.bib', 'templates/pandoc-docstyle.tex',
+                    'src/images/scan.tiff', 'src/docs/scan.tiff'):
+        assert graph.affected([changed]) == ['results/thesis.pdf'], changed
+    assert graph.affected(['src/docs/nested.md']) == ['results/thesis.pdf']
+    assert graph.affected(['src/docs/other.md', 'README.md']) == []
+
+
+def test_deps_command(project, capsys):
+    (project.dir / 'src' / 'docs' / 'doc.mmd').write_text('![Plot](plot.png)\n\nAs @doe99 says.\n')
+    doPandoc.build('doc', 'tex,docx')
+    capsys.readouterr()
+    doPandoc.main(['deps'])
+    out = capsys.readouterr().out
+    assert '* results/doc.tex\n    src/docs/doc.mmd\n' in out
+    assert 'plot.png (missing)' in out and 'citations: doe99' in out
+    doPandoc.main(['deps', os.path.join('templates', 'pandoc-docstyle.docx')])
+    assert capsys.readouterr().out == 'results/doc.docx\n'
+    doPandoc.main(['deps', 'README.md'])
+    assert 'no targets affected' in capsys.readouterr().out
+
+
+def test_dependency_graph_merge(tmp_path, monkeypatch):
+    # Two builds that run at the same time each record their own target
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'one.md').write_text('One\n')
+    (tmp_path / 'two.md').write_text('Two\n')
+    first, second = doPandoc.DependencyGraph('.doPandoc'), doPandoc.DependencyGraph('.doPandoc')
+    first.register('one.pdf', ['one.md'], [])
+    second.register('two.pdf', ['two.md'], [])
+    first.save()
+    second.save()
+    assert sorted(second.targets) == ['one.pdf', 'two.pdf']
+    assert sorted(doPandoc.DependencyGraph('.doPandoc').targets) == ['one.pdf', 'two.pdf']
+    assert not os.path.exists(os.path.join('.doPandoc', 'dependencies.json.lock'))
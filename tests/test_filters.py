@@ -0,0 +1,132 @@
+import json
+import os
+
+import pytest
+
+import doPandoc
+
+
+def para(text):
+    return {'t': 'Para', 'c': [{'t': 'Str', 'c': text}]}
+
+
+def write(tmp_path, ast):
+    astFile = tmp_path / 'doc.json'
+    astFile.write_text(json.dumps(ast))
+    return str(astFile)
+
+
+def test_filter_chain(tmp_path):
+    calls = []
+
+    def append(ast, fmt):
+        calls.append(('append', fmt, len(ast['blocks'])))
+        ast['blocks'].append(para('appended'))
+
+    def replace(ast, fmt):
+        calls.append(('replace', fmt, len(ast['blocks'])))
+        return dict(ast, blocks=ast['blocks'][1:])
+
+    def unchanged(ast, fmt):
+        return False
+
+    astFile = write(tmp_path, {'pandoc-api-version': [1, 23], 'meta': {}, 'blocks': [para('one')]})
+    outFile = str(tmp_path / 'out.json')
+    assert not doPandoc.FilterChain().run(astFile, 'pdf', outFile)
+    assert not doPandoc.FilterChain([('unchanged', unchanged)]).run(astFile, 'pdf', outFile)
+    assert not os.path.exists(outFile)
+    # The filters share one tree, in order, and see the format as pandoc hands it to filters
+    assert doPandoc.FilterChain([('append', append), ('replace', replace), ('unchanged', unchanged)]).run(
+        astFile, 'pdf', outFile)
+    assert calls == [('append', 'latex', 1), ('replace', 'latex', 2)]
+    with open(outFile) as f:
+        assert json.load(f)['blocks'] == [para('appended')]
+    doPandoc.FilterChain([('append', append)]).run(astFile, 'docx', outFile)
+    assert calls[-1] == ('append', 'docx', 1)
+
+
+def test_resolve(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(doPandoc.astFilters, 'registered', len)
+    assert doPandoc.FilterChain.resolve('registered') == (len, None)
+    assert doPandoc.FilterChain.resolve('pandoc-crossref') == (None, None)
+    assert doPandoc.FilterChain.resolve('missing.py') == (None, None)
+
+    (tmp_path / 'project' / 'filters').mkdir(parents=True)
+    filterFile = tmp_path / 'project' / 'filters' / 'upper.py'
+    filterFile.write_text('def doPandocFilter(ast, fmt):\n    return "first"\n')
+    function, filename = doPandoc.FilterChain.resolve('upper.py', [str(tmp_path / 'project')])
+    assert filename == str(filterFile) and function(None, None) == 'first'
+    # Loaded once, and again when the file changes
+    assert doPandoc.FilterChain.resolve('upper.py', [str(tmp_path / 'project')])[0] is function
+    filterFile.write_text('def doPandocFilter(ast, fmt):\n    return "second"\n')
+    os.utime(str(filterFile), ns=(1, 10 ** 18))
+    assert doPandoc.FilterChain.resolve('upper.py', [str(tmp_path / 'project')])[0](None, None) == 'second'
+
+    # A Python filter for pandoc itself (without doPandocFilter) is left to pandoc, without loading it
+    (tmp_path / 'plain.py').write_text('import sys\nsys.stdin.read()\nsys.exit(1)\n')
+    assert doPandoc.FilterChain.resolve('plain.py') == (None, None)
+    (tmp_path / 'syntax.py').write_text('def doPandocFilter(:\n')
+    assert doPandoc.FilterChain.resolve('syntax.py') == (None, None)
+    (tmp_path / 'broken.py').write_text('import sys\nsys.exit(1)\ndef doPandocFilter(ast, fmt):\n    pass\n')
+    with pytest.raises(doPandoc.InputError):
+        doPandoc.FilterChain.resolve('broken.py')
+
+
+def test_filter_arguments():
+    assert doPandoc.filterArguments(['--toc', '-F', 'a', '-Fb', '--filter=c', '--citeproc', '--filter', 'd', '-C',
+                                     '--filter']) == [(1, 2, 'a'), (3, 1, 'b'), (4, 1, 'c'), (5, 1, None), (6, 2, 'd'),
+                                                      (8, 1, None)]
+
+
+def test_filter_passes(project, monkeypatch):
+    monkeypatch.setitem(doPandoc.astFilters, 'one', lambda ast, fmt: None)
+    monkeypatch.setitem(doPandoc.astFilters, 'two', lambda ast, fmt: None)
+    document = doPandoc.Document('doc', ['tex'], doPandoc.buildOptions(), ['-F', 'one', '--filter=pandoc-crossref',
+                                                                          '-Ftwo', '--metadata=draft:1', '-Fthree', '--filter', 'one'])
+    document.configure()
+    docArgs = {'-f': 'markdown', '--bibliography': 'refs.bib'}
+    passes, remaining, extra = document.filterPasses(docArgs, document.readerExtra)
+    # The citations first (pandoc 2.11 and newer process them), then the filters in the order given
+    assert [(args and args[5:], [name for name, _ in chain.filters]) for args, chain in passes] == [
+        (['--bibliography', 'refs.bib', '--metadata=draft:1', '--citeproc'], ['one']),
+        (['--bibliography', 'refs.bib', '--metadata=draft:1', '--filter=pandoc-crossref'], ['two']),
+        (['--bibliography', 'refs.bib', '--metadata=draft:1', '-Fthree'], ['one'])]
+    assert passes[0][0][:5] == ['pandoc', '-f', 'json', '-t', 'json']
+    assert remaining == {'-f': 'markdown', '--bibliography': 'refs.bib'}
+    assert extra == ['--metadata=draft:1']
+    # Consecutive in-process filters share a chain; filters after the last one are left to the writer
+    document = doPandoc.Document('doc', ['tex'], doPandoc.buildOptions(), ['-Fone', '-Ftwo', '-Fthree'])
+    document.configure()
+    passes, remaining, extra = document.filterPasses({'-f': 'markdown'}, document.readerExtra)
+    assert [(args[5:], [name for name, _ in chain.filters]) for args, chain in passes] == [(['--citeproc'],
+                                                                                             ['one', 'two'])]
+    assert extra == ['-Fthree']
+
+
+def test_citeproc(project, monkeypatch):
+    # pandoc 2.11 and newer process the citations themselves, once, where the user did not ask for it already
+    for extra in ([], ['--toc', '--citeproc'], ['-C']):
+        document = doPandoc.Document('doc', ['tex'], doPandoc.buildOptions(), extra)
+        document.configure()
+        assert '--filter' not in document.pandoc_args
+        assert [arg for arg in document.readerExtra if arg in ('-C', '--citeproc')] == (extra[-1:] or ['--citeproc'])
+        assert '--citeproc' not in document.writerExtra
+    # Before, the pandoc-citeproc filter did
+    monkeypatch.setattr(doPandoc, 'pandocInfo', lambda cacheDir=None: {'version': '2.9.2', 'server': False})
+    document = doPandoc.Document('doc', ['tex'], doPandoc.buildOptions())
+    document.configure()
+    assert document.pandoc_args['--filter'] == 'pandoc-citeproc' and document.readerExtra == []
+
+
+def test_build_filters(project, monkeypatch):
+    calls = []
+    monkeypatch.setitem(doPandoc.astFilters, 'mark', lambda ast, fmt: calls.append(fmt))
+    assert doPandoc.build('doc', 'tex', extra=['--filter', 'mark', '--filter=pandoc-crossref']).ok
+    assert calls == ['latex']
+    runs = project.pandocRuns()
+    assert 'mark' not in sum(runs, []) and '--filter=pandoc-crossref' in runs[-1]
+    # Several formats share one run of the chain, before pandoc's own filters
+    assert doPandoc.build('doc', 'tex,docx', {'force': True}, extra=['-Fmark']).ok
+    assert calls == ['latex', 'json']
+    assert not [args for args in project.pandocRuns() if '-Fmark' in args]
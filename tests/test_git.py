@@ -0,0 +1,310 @@
+import os
+import subprocess
+import time
+
+import doPandoc
+
+
+def git(*args):
+    return subprocess.run(['git'] + list(args), stdout=subprocess.PIPE, check=True).stdout.decode('utf-8').strip()
+
+
+def countRuns(monkeypatch):
+    # Return: the list of git commands run through Git.run from now on, by their name
+    runs = []
+    run = doPandoc.Git.run
+
+    def counting(*args, **kwargs):
+        runs.append(next(arg for arg in args if not arg.startswith('-')))
+        return run(*args, **kwargs)
+
+    monkeypatch.setattr(doPandoc.Git, 'run', staticmethod(counting))
+    return runs
+
+
+def test_state(repository, monkeypatch):
+    repo = doPandoc.Git('Thesis')
+    runs = countRuns(monkeypatch)
+    state = repo.state()
+    assert state['oid'] == git('rev-parse', 'HEAD')
+    assert state['current'] == 'master'
+    assert state['upstream'] is None
+    assert repo.state() is state
+    assert runs == []
+
+    (repository.dir / 'src' / 'docs' / 'doc.mmd').write_text('Changed.\n')
+    (repository.dir / 'src' / 'new.md').write_text('New.\n')
+    repo.invalidate()
+    os.remove(os.path.join('.git', 'doPandoc-state.json'))  # the state of the same refs is remembered otherwise
+    assert repo.state() == state  # changed files are not part of the state
+    assert runs == ['status']
+
+
+def test_commit(repository, monkeypatch):
+    repo = doPandoc.Git('Thesis')
+    (repository.dir / 'src' / 'docs' / 'doc.mmd').write_text('Changed.\n')
+    (repository.dir / 'src' / 'new.md').write_text('New.\n')
+    (repository.dir / 'templates' / 'new.tex').write_text('$body$\n')
+    (repository.dir / 'results' / 'doc.pdf').write_text('Not an asset.\n')
+    runs = countRuns(monkeypatch)
+    assert repo.commit(msg='Second commit')
+    assert runs == ['add', 'commit', 'ls-files']
+    assert set(git('ls-files').splitlines()) == {'src/docs/doc.mmd', 'src/new.md', 'templates/new.tex',
+                                                 'templates/pandoc-docstyle.tex', 'templates/pandoc-docstyle.docx'}
+    assert git('status', '--porcelain') == '?? results/'
+    assert repo.state()['oid'] == git('rev-parse', 'HEAD')
+
+
+def test_commit_nothing_changed(repository, capsys):
+    repo = doPandoc.Git('Thesis')
+    head = git('rev-parse', 'HEAD')
+    assert not repo.commit(msg='Nothing')
+    assert git('rev-parse', 'HEAD') == head
+    assert 'up-to-date' in capsys.readouterr().out
+
+
+def addCommits(repository, count):
+    for i in range(count):
+        (repository.dir / 'src' / 'docs' / 'doc.mmd').write_text('Version {}.\n'.format(i))
+        git('commit', '-q', '-a', '-m', 'Commit {}'.format(i))
+
+
+def describe():
+    tag, commits, _ = git('describe', '--tags', '--long').split('-')
+    major, minor = tag[1:].split('.')
+    return int(major), int(minor), int(commits)
+
+
+def test_version_from_refs(repository, monkeypatch):
+    git('tag', '-a', 'v1.2', '-m', 'Version v1.2')
+    addCommits(repository, 3)
+    repo = doPandoc.Git('Thesis')
+    runs = countRuns(monkeypatch)
+    assert repo.version() == describe() == (1, 2, 3)
+    assert repo.version(True) == 'v1.2-3'
+    assert runs == []
+
+    # A newer tag invalidates the versions remembered
+    git('tag', 'v1.3')
+    assert doPandoc.GitRefs.find().version() == describe() == (1, 3, 0)
+    addCommits(repository, 1)
+    assert doPandoc.GitRefs.find().version() == describe() == (1, 3, 1)
+
+
+def test_version_packed_refs(repository):
+    git('tag', '-a', 'v0.4', '-m', 'Version v0.4')
+    addCommits(repository, 2)
+    git('pack-refs', '--all')
+    refs = doPandoc.GitRefs.find()
+    assert not (repository.dir / '.git' / 'refs' / 'tags' / 'v0.4').exists()
+    assert refs.ref('HEAD') == git('rev-parse', 'HEAD')
+    assert refs.version() == describe() == (0, 4, 2)
+
+
+def test_version_left_to_git(repository):
+    git('tag', 'release')
+    addCommits(repository, 1)
+    assert doPandoc.GitRefs.find().version() is None
+    assert doPandoc.GitRefs.find(str(repository.dir.parent)) is None
+
+
+def test_push_queue(repository, tmp_path, monkeypatch):
+    remote = tmp_path / 'remote.git'
+    git('init', '-q', '--bare', str(remote))
+    git('remote', 'add', 'origin', str(remote))
+    monkeypatch.setitem(doPandoc.default, 'pushLinger', 0)
+    pushQueue = doPandoc.PushQueue.find()
+    assert pushQueue.entries() == []
+    pushQueue.add('Thesis', 'master')
+    pushQueue.add('Thesis', 'master')
+    assert [e['branch'] for e in pushQueue.entries()] == ['master']
+    assert pushQueue.run() == 0
+    assert git('--git-dir', str(remote), 'rev-parse', 'master') == git('rev-parse', 'HEAD')
+    assert git('rev-parse', '--abbrev-ref', 'master@{upstream}') == 'origin/master'
+    assert not os.path.exists(pushQueue.helperFile)
+
+
+def test_push_tags(repository, tmp_path, capsys):
+    remote = tmp_path / 'remote.git'
+    git('init', '-q', '--bare', str(remote))
+    git('remote', 'add', 'origin', str(remote))
+    repo = doPandoc.Git('Thesis')
+    assert repo.push()
+    assert git('rev-parse', '--abbrev-ref', 'master@{upstream}') == 'origin/master'
+    # A new tag is pushed, although the branch is up to date
+    git('tag', '-a', 'v0.1', '-m', 'Version v0.1')
+    repo.invalidate()
+    capsys.readouterr()
+    assert repo.push()
+    assert 'pushing commit' in capsys.readouterr().out
+    assert git('--git-dir', str(remote), 'tag') == 'v0.1'
+    repo.invalidate()
+    assert repo.push()
+    assert 'nothing to push' in capsys.readouterr().out
+
+
+def test_push_queue_backoff(repository, tmp_path, monkeypatch, capsys):
+    git('remote', 'add', 'origin', str(tmp_path / 'missing.git'))
+    pushQueue = doPandoc.PushQueue.find()
+    pushQueue.add('Thesis', 'master')
+    for attempts, delay in ((1, 30), (2, 60), (3, 120)):
+        before = time.time()
+        assert not pushQueue.attempt(pushQueue.entries()[0])
+        entry = pushQueue.entries()[0]
+        assert entry['attempts'] == attempts
+        assert entry['error'].startswith('fatal:')
+        assert before + delay <= entry['next'] <= time.time() + delay
+    # Queuing the branch again has it attempted right away, without losing count
+    pushQueue.add('Thesis', 'master')
+    assert pushQueue.entries()[0]['next'] <= time.time()
+    assert pushQueue.entries()[0]['attempts'] == 3
+
+    # The next build tells about the failed pushes
+    capsys.readouterr()
+    assert pushQueue.report() == 1
+    assert 'push of master failed 3 time(s) in the background: fatal:' in capsys.readouterr().out
+
+    doPandoc.pushQueueCommand([])
+    out = capsys.readouterr().out
+    assert 'helper               : not running' in out
+    assert '3 failed attempt(s)' in out
+    doPandoc.pushQueueCommand(['clear'])
+    assert pushQueue.entries() == []
+
+
+def test_stage_index(repository):
+    (repository.dir / 'src' / 'images' / 'sub').mkdir()
+    (repository.dir / 'src' / 'images' / 'sub' / 'figure.png').write_bytes(b'png')
+    stageIndex = doPandoc.StageIndex.find()
+    pathspecs = ['src/*', 'templates/*.tex']
+    changed, removed = stageIndex.changes(pathspecs)
+    assert sorted(changed) == ['src/docs/doc.mmd', 'src/images/sub/figure.png', 'templates/pandoc-docstyle.tex']
+    assert removed == []
+    stageIndex.save(git('ls-files').splitlines())
+
+    stageIndex = doPandoc.StageIndex.find()
+    assert stageIndex.changes(pathspecs) == ([], [])
+    (repository.dir / 'src' / 'docs' / 'doc.mmd').write_text('Changed, and longer.\n')
+    (repository.dir / 'src' / 'images' / 'sub' / 'figure.png').unlink()
+    (repository.dir / 'templates' / 'pandoc-docstyle.docx').write_bytes(b'not matched')
+    assert stageIndex.changes(pathspecs) == (['src/docs/doc.mmd'], ['src/images/sub/figure.png'])
+
+
+def test_commit_changed_assets_only(repository, monkeypatch):
+    git('tag', 'v0.1')
+    (repository.dir / '.gitignore').write_text('*.log\n')
+    git('add', '.gitignore')
+    git('commit', '-q', '-m', 'Ignore logs')
+    repo = doPandoc.Git('Thesis')
+    # The assets were committed before the index recorded them: git finds nothing to commit
+    assert not repo.commit(msg='Record the assets')
+    runs = countRuns(monkeypatch)
+
+    # Nothing changed: neither staged nor committed, and git is not asked
+    assert not repo.commit(msg='Nothing')
+    assert runs == []
+
+    # A changed, a removed and an ignored asset
+    (repository.dir / 'src' / 'docs' / 'doc.mmd').write_text('Changed.\n')
+    (repository.dir / 'templates' / 'pandoc-docstyle.docx').unlink()
+    (repository.dir / 'src' / 'build.log').write_text('Ignored.\n')
+    assert repo.commit(msg='Changed')
+    assert runs == ['add', 'commit', 'ls-files']
+    assert git('show', '--name-status', '--format=', 'HEAD').splitlines() == ['M\tsrc/docs/doc.mmd',
+                                                                               'D\ttemplates/pandoc-docstyle.docx']
+
+    # Only an ignored asset changed: git finds nothing to commit, and is not asked again
+    (repository.dir / 'src' / 'build.log').write_text('Ignored, again.\n')
+    del runs[:]
+    assert not repo.commit(msg='Ignored')
+    assert runs == ['add', 'commit', 'ls-files']
+    del runs[:]
+    assert not repo.commit(msg='Ignored')
+    assert runs == []
+
+    # A tracked file outside the assets is committed as well
+    (repository.dir / '.gitignore').write_text('*.log\n*.aux\n')
+    assert repo.commit(msg='Ignore aux files')
+    assert git('show', '--name-status', '--format=', 'HEAD').splitlines() == ['M\t.gitignore']
+
+    # After a commit outside doPandoc, git is asked once more
+    (repository.dir / 'notes.txt').write_text('Notes.\n')
+    git('add', 'notes.txt')
+    git('commit', '-q', '-m', 'Notes')
+    del runs[:]
+    assert not repo.commit(msg='Nothing')
+    assert runs == ['status', 'ls-files']
+    (repository.dir / 'notes.txt').write_text('Notes, changed.\n')
+    assert repo.commit(msg='Changed the notes')
+    assert git('show', '--name-status', '--format=', 'HEAD').splitlines() == ['M\tnotes.txt']
+
+
+def test_stage_old_git(repository, monkeypatch):
+    # A git older than 2.25 cannot read the files from stdin: they are passed in chunks
+    monkeypatch.setattr(doPandoc.Git, 'gitVersion', (2, 24, 0))
+    monkeypatch.setitem(doPandoc.default, 'gitCommandLength', 30)
+    (repository.dir / '.gitignore').write_text('*.log\n')
+    files = ['src/{}.md'.format(name) for name in ('one', 'two', 'three', 'four')] + ['src/build.log']
+    for name in files:
+        (repository.dir / name).write_text('Text.\n')
+    repo = doPandoc.Git('Thesis')
+    runs = countRuns(monkeypatch)
+    repo.stage(files)
+    assert runs == ['add', 'add', 'add']
+    assert git('diff', '--cached', '--name-only').splitlines() == sorted(files[:4])
+
+
+def test_program_version(monkeypatch):
+    monkeypatch.setattr(doPandoc.Git, 'gitVersion', None)
+    version = doPandoc.Git.programVersion()
+    assert '.'.join(map(str, version)) in git('--version') and doPandoc.Git.programVersion() is version
+
+
+def test_files(repository):
+    git('tag', 'v0.1')
+    (repository.dir / 'src' / 'docs' / 'doc.mmd').write_text('Changed.\n')
+    os.chdir('src')
+    assert doPandoc.Git.files('v0.1', ['docs/doc.mmd', 'docs/missing.mmd', 'docs', '../templates/pandoc-docstyle.docx']) == \
+        [b'---\ntitle: A document\n---\n\n# Introduction\n\nText.\n', None, None, b'docx']
+
+
+def test_state_memo(repository, tmp_path, monkeypatch):
+    doPandoc.Git('Thesis').state()
+    runs = countRuns(monkeypatch)
+    # A later run on the same refs takes the state from the memo
+    state = doPandoc.Git('Thesis').state()
+    assert runs == []
+    assert state['oid'] == git('rev-parse', 'HEAD') and state['current'] == 'master'
+    assert doPandoc.Git('Thesis').getUrl() is None
+    assert doPandoc.Git('Thesis').getUrl() is None
+    assert runs == ['remote']
+
+    # A commit, a new branch and a new remote each make it ask git again
+    addCommits(repository, 1)
+    assert doPandoc.Git('Thesis').state()['oid'] == git('rev-parse', 'HEAD')
+    assert runs == ['remote', 'status']
+    git('branch', 'draft')
+    doPandoc.Git('Thesis')
+    assert runs == ['remote', 'status', 'status']
+    git('remote', 'add', 'origin', str(tmp_path / 'remote.git'))
+    assert doPandoc.Git('Thesis').getUrl() == str(tmp_path / 'remote.git')
+    assert runs == ['remote', 'status', 'status', 'status', 'remote']
+
+
+def test_version_packed_objects(repository):
+    git('tag', '-a', 'v2.0', '-m', 'Version v2.0')
+    text = ''.join('Line {} of a text that changes little between the commits.\n'.format(n) for n in range(300))
+    for i in range(6):
+        (repository.dir / 'src' / 'docs' / 'doc.mmd').write_text(text + 'Version {}.\n'.format(i))
+        git('commit', '-q', '-a', '-m', 'Commit {}'.format(i))
+    git('gc', '-q', '--aggressive', '--prune=now')
+    assert not [name for name in os.listdir(str(repository.dir / '.git' / 'objects')) if len(name) == 2]
+    refs = doPandoc.GitRefs.find()
+    assert refs.version() == describe() == (2, 0, 6)
+    # Objects stored as deltas are read as git reads them
+    for revision in ('HEAD~5:src/docs/doc.mmd', 'HEAD:src/docs/doc.mmd', 'HEAD~2', 'v2.0'):
+        oid = git('rev-parse', revision)
+        kind, content = refs.raw(oid)
+        assert kind == git('cat-file', '-t', oid)
+        assert content == subprocess.run(['git', 'cat-file', kind, oid], stdout=subprocess.PIPE).stdout
+    assert refs.raw(40 * '0') == (None, None)
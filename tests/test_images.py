@@ -0,0 +1,81 @@
+import os
+import sys
+
+import pytest
+
+import doPandoc
+
+# An SVG converter that logs its runs
+rsvg = '''
+import sys
+args = sys.argv[1:]
+with open(LOG, 'a') as f:
+    f.write(args[-1] + '\\n')
+with open(args[args.index('-o') + 1], 'w') as f:
+    f.write('%PDF stand-in')
+'''
+
+
+def image(url):
+    return {'t': 'Image', 'c': [['', [], []], [{'t': 'Str', 'c': 'caption'}], [url, '']]}
+
+
+def document(*urls):
+    return {'pandoc-api-version': [1, 23], 'meta': {}, 'blocks': [{'t': 'Para', 'c': [image(url)]} for url in urls]}
+
+
+def urls(ast):
+    return [block['c'][0]['c'][2][0] for block in ast['blocks']]
+
+
+@pytest.fixture
+def images(tmp_path):
+    (tmp_path / 'images').mkdir()
+    (tmp_path / 'images' / 'plot.svg').write_text('<svg/>')
+    (tmp_path / 'images' / 'plot.eps').write_text('%!PS')
+    return doPandoc.ImagePipeline(str(tmp_path / 'cache'), searchDirs=[str(tmp_path / 'images')])
+
+
+def test_svg_for_latex(tmp_path, tools, images):
+    log = tmp_path / 'rsvg.log'
+    tools('rsvg-convert', 'LOG = {!r}\n'.format(str(log)) + rsvg)
+    ast = document('plot.svg', 'https://example.org/remote.svg', 'missing.png')
+    assert images.rewrite(ast, 'pdf')
+    derived, remote, missing = urls(ast)
+    assert derived.endswith('.pdf') and open(derived).read() == '%PDF stand-in'
+    assert (remote, missing) == ('https://example.org/remote.svg', 'missing.png')
+    # The derived copy is cached
+    again = document('plot.svg')
+    assert images.rewrite(again, 'tex')
+    assert urls(again) == [derived]
+    assert len(log.read_text().splitlines()) == 1
+
+
+def test_used_as_they_are(tmp_path, images):
+    # Word uses the vector images as they are, and there is no EPS converter
+    ast = document('plot.svg', 'plot.eps')
+    assert not images.rewrite(ast, 'docx')
+    assert not images.rewrite(ast, 'pdf')
+    assert not images.rewrite(ast, 'md')
+    assert ast == document('plot.svg', 'plot.eps')
+
+
+def test_without_pillow(tmp_path, images, monkeypatch, capsys):
+    monkeypatch.setitem(sys.modules, 'PIL', None)
+    (tmp_path / 'images' / 'scan.tiff').write_bytes(b'II*\0')
+    (tmp_path / 'images' / 'photo.png').write_bytes(b'\x89PNG')
+    assert not images.rewrite(document('scan.tiff', 'photo.png'), 'pdf')
+    assert capsys.readouterr().out.count('Pillow is not installed') == 1
+
+
+def test_raster(tmp_path, images):
+    Image = pytest.importorskip('PIL.Image')
+    Image.new('RGB', (4000, 2000), (200, 100, 50)).save(str(tmp_path / 'images' / 'wide.png'))
+    Image.new('L', (100, 100)).save(str(tmp_path / 'images' / 'scan.tiff'))
+    Image.new('RGB', (100, 100)).save(str(tmp_path / 'images' / 'small.png'))
+    ast = document('wide.png', 'scan.tiff', 'small.png')
+    assert images.rewrite(ast, 'pdf')
+    wide, scan, small = urls(ast)
+    with Image.open(wide) as img:
+        assert img.size == (images.maxPixels, images.maxPixels // 2)
+    assert os.path.splitext(scan)[1] == '.png' and small == 'small.png'
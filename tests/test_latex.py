@@ -0,0 +1,169 @@
+import json
+import os
+
+import doPandoc
+
+# A LaTeX engine that logs its runs, and writes the .aux of the document: its labels, and the citations of its
+# \bibliography as \bibdata
+engine = '''
+import json, os, sys
+args = sys.argv[1:]
+if args == ['--version']:
+    print('pdfTeX 3.141592653-2.6-1.40.25 (stand-in)')
+    sys.exit(0)
+out = [a.split('=', 1)[1] for a in args if a.startswith('-output-directory=')][0]
+job = os.path.splitext(os.path.basename(args[-1]))[0]
+with open(LOG, 'a') as f:
+    f.write(json.dumps({'args': args, 'TEXINPUTS': os.environ.get('TEXINPUTS'),
+                        'TEXFORMATS': os.environ.get('TEXFORMATS')}) + '\\n')
+with open(args[-1]) as f:
+    tex = f.read()
+if '-ini' in args:
+    # Dump the format of the preamble, which fontspec does not survive
+    job = [a.split('=', 1)[1] for a in args if a.startswith('-jobname=')][0]
+    with open(os.path.join(out, job + '.log'), 'w') as f:
+        f.write('This is a stand-in\\n')
+    if 'fontspec' in tex:
+        sys.exit(1)
+    with open(os.path.join(out, job + '.fmt'), 'w') as f:
+        f.write(tex.split('\\\\begin{document}')[0])
+    sys.exit(0)
+with open(os.path.join(out, job + '.log'), 'w') as f:
+    f.write('This is a stand-in\\n' + ('! Undefined control sequence.\\nl.3 \\\\broken\\n' if '\\\\broken' in tex else ''))
+if '\\\\broken' in tex:
+    sys.exit(1)
+with open(os.path.join(out, job + '.aux'), 'w') as f:
+    f.write('\\\\relax\\n' + ('\\\\bibdata{refs}\\n' if '\\\\bibliography' in tex else ''))
+with open(os.path.join(out, job + '.pdf'), 'w') as f:
+    f.write('pdf')
+'''
+
+bibtex = '''
+import sys
+with open(LOG, 'a') as f:
+    f.write('{"bibtex": "' + sys.argv[-1] + '"}\\n')
+'''
+
+
+def runs(log):
+    return [json.loads(line) for line in log.read_text().splitlines()] if log.exists() else []
+
+
+def latex(tmp_path, tools, tex):
+    log = tmp_path / 'latex.log'
+    tools('pdflatex', 'LOG = {!r}\n'.format(str(log)) + engine)
+    tools('bibtex', 'LOG = {!r}\n'.format(str(log)) + bibtex)
+    build = doPandoc.LatexBuild(str(tmp_path / 'build'), 'doc', texInputs=[str(tmp_path / 'support')])
+    with open(build.texFile, 'w') as f:
+        f.write(tex)
+    return build, log
+
+
+def test_latex_passes(tmp_path, tools, capsys):
+    build, log = latex(tmp_path, tools, '\\documentclass{article}\n\\begin{document}\nText\n\\end{document}\n')
+    assert build.compile() == 0
+    assert len(runs(log)) == 2  # the second pass finds the .aux unchanged
+    assert runs(log)[0]['TEXINPUTS'].split(os.pathsep)[:2] == ['.', str(tmp_path / 'support')]
+    assert os.path.isfile(build.pdfFile)
+    # The next build keeps the state of this one
+    assert build.compile() == 0
+    assert len(runs(log)) == 3
+    assert '* LaTeX passes         : 1 (pdflatex)' in capsys.readouterr().out
+
+
+def test_latex_bibtex(tmp_path, tools):
+    build, log = latex(tmp_path, tools, '\\begin{document}\n\\bibliography{refs}\n\\end{document}\n')
+    assert build.compile() == 0
+    assert [run.get('bibtex') for run in runs(log)] == [None, os.path.join(build.dir, 'doc'), None]
+
+
+def test_latex_error(tmp_path, tools, capsys):
+    build, log = latex(tmp_path, tools, '\\begin{document}\n\\broken\n\\end{document}\n')
+    assert build.compile() == 1
+    assert len(runs(log)) == 1
+    assert '! Undefined control sequence.' in capsys.readouterr().out
+
+
+def formatRuns(log):
+    return [run for run in runs(log) if '-ini' in run.get('args', [])]
+
+
+def test_latex_format(tmp_path, tools, capsys):
+    preamble = '\\documentclass{article}\n\\usepackage{support}\n'
+    build, log = latex(tmp_path, tools, preamble + '\\begin{document}\nText\n\\end{document}\n')
+    (tmp_path / 'support').mkdir()
+    (tmp_path / 'support' / 'support.sty').write_text('% support')
+    formats = doPandoc.LatexFormats(str(tmp_path / 'cache'), 'pdflatex', [str(tmp_path / 'support')])
+    formatFile = formats.prepare(build.texFile)
+    assert formatFile and open(formatFile).read() == preamble
+    assert len(formatRuns(log)) == 1
+    assert build.compile(formatFile) == 0
+    run = runs(log)[-1]
+    assert '-fmt=' + os.path.splitext(os.path.basename(formatFile))[0] in run['args']
+    assert run['TEXFORMATS'].split(os.pathsep)[0] == os.path.dirname(formatFile)
+    assert 'precompiled preamble' in capsys.readouterr().out
+
+    # Another body keeps the format; another preamble, or a changed support file, does not
+    with open(build.texFile, 'w') as f:
+        f.write(preamble + '\\begin{document}\nOther text\n\\end{document}\n')
+    assert formats.prepare(build.texFile) == formatFile
+    assert len(formatRuns(log)) == 1
+    (tmp_path / 'support' / 'support.sty').write_text('% support, changed')
+    assert formats.prepare(build.texFile) not in (None, formatFile)
+    with open(build.texFile, 'w') as f:
+        f.write(preamble + '\\usepackage{other}\n\\begin{document}\nText\n\\end{document}\n')
+    assert formats.prepare(build.texFile) not in (None, formatFile)
+    assert len(formatRuns(log)) == 3
+
+
+def test_latex_format_rejected(tmp_path, tools, capsys):
+    build, log = latex(tmp_path, tools, '\\usepackage{fontspec}\n\\begin{document}\nText\n\\end{document}\n')
+    formats = doPandoc.LatexFormats(str(tmp_path / 'cache'), 'pdflatex')
+    assert formats.prepare(build.texFile) is None
+    assert 'cannot be precompiled' in capsys.readouterr().out
+    # ... and it is not tried again
+    assert formats.prepare(build.texFile) is None
+    assert len(formatRuns(log)) == 1
+
+    # A format that the document does not get along with is dropped, and not made again
+    with open(build.texFile, 'w') as f:
+        f.write('\\usepackage{other}\n\\begin{document}\nText\n\\end{document}\n')
+    formatFile = formats.prepare(build.texFile)
+    formats.reject(formatFile)
+    assert not os.path.exists(formatFile)
+    assert formats.prepare(build.texFile) is None
+    assert len(formatRuns(log)) == 2
+
+
+def test_latex_format_without_engine(tmp_path):
+    (tmp_path / 'doc.tex').write_text('\\begin{document}\n\\end{document}\n')
+    formats = doPandoc.LatexFormats(str(tmp_path / 'cache'), 'no-such-latex-engine')
+    assert formats.prepare(str(tmp_path / 'doc.tex')) is None
+
+
+def test_latex_format_base(tmp_path, tools, monkeypatch):
+    # A format is made again when the TeX installation remakes the engine's base format
+    monkeypatch.setattr(doPandoc.LatexFormats, 'engineVersions', {})
+    baseFormat = tmp_path / 'pdflatex.fmt'
+    baseFormat.write_text('base')
+    tools('kpsewhich', 'print({!r})\n'.format(str(baseFormat)))
+    build, log = latex(tmp_path, tools, '\\documentclass{article}\n\\begin{document}\nText\n\\end{document}\n')
+    formats = doPandoc.LatexFormats(str(tmp_path / 'cache'), 'pdflatex')
+    formatFile = formats.prepare(build.texFile)
+    assert str(baseFormat) in formats.engineVersion()
+    os.utime(str(baseFormat), ns=(1, 10 ** 18))
+    doPandoc.LatexFormats.engineVersions.clear()  # as in a later process
+    assert formats.prepare(build.texFile) not in (None, formatFile)
+    assert len(formatRuns(log)) == 2
+
+
+def test_latex_build_document(project, tools, tmp_path):
+    log = tmp_path / 'latex.log'
+    tools('pdflatex', 'LOG = {!r}\n'.format(str(log)) + engine)
+    result = doPandoc.build('doc', 'pdf', {'latex_build': True},
+                            extra=['--pdf-engine-opt=-shell-escape', '--pdf-engine-opt', '-8bit'])
+    assert result.ok
+    assert (project.dir / 'results' / 'doc.pdf').read_text() == 'pdf'
+    # The engine options reach the engine, not pandoc
+    assert all(run['args'][3:5] == ['-shell-escape', '-8bit'] for run in runs(log))
+    assert not any('--pdf-engine-opt' in arg for args in project.pandocRuns() for arg in args)
@@ -0,0 +1,125 @@
+import json
+
+import doPandoc
+
+# A pandoc-server that renders the text it is sent in upper case (or parses it into a document without content), and
+# logs the requests
+server = '''
+import http.server, json, sys
+port = int(sys.argv[sys.argv.index('--port') + 1])
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        params = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with open(LOG, 'a') as f:
+            f.write(json.dumps(params) + '\\n')
+        if params['to'] == 'json':
+            output = json.dumps({'pandoc-api-version': [1, 22, 2], 'meta': {}, 'blocks': []})
+        else:
+            output = params['text'].upper()
+        body = json.dumps({'output': output, 'base64': False, 'messages': []}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+http.server.HTTPServer(('127.0.0.1', port), Handler).serve_forever()
+'''
+
+# A pandoc that copies its input to its output
+pandoc = '''
+import sys
+args = sys.argv[1:]
+if args == ['-v']:
+    print('pandoc 2.19.2')
+    sys.exit(0)
+with open(args[-1]) as f, open(args[args.index('-o') + 1], 'w') as out:
+    out.write('process: ' + f.read())
+'''
+
+
+def test_request(tmp_path):
+    pool = doPandoc.PandocServerPool(size=0)
+    (tmp_path / 'doc.mmd').write_text('# Title\n')
+    (tmp_path / 'style.tex').write_text('$body$\n')
+    params, target, binary = pool.request(['pandoc', '-f', 'markdown', '-o', str(tmp_path / 'doc.tex'), '--toc',
+                                           '--template', str(tmp_path / 'style.tex'), '-M', 'version=v1.2-3',
+                                           '--shift-heading-level-by=-1', str(tmp_path / 'doc.mmd')])
+    assert (target, binary) == (str(tmp_path / 'doc.tex'), False)
+    assert params['from'] == 'markdown' and params['to'] == 'latex' and params['table-of-contents']
+    assert params['template'] == '$body$\n' and params['metadata'] == {'version': 'v1.2-3'}
+    assert params['shift-heading-level-by'] == -1 and params['text'] == '# Title\n'
+    # What the server cannot do
+    assert pool.request(['pandoc', '--filter', 'pandoc-citeproc', '-o', str(tmp_path / 'doc.tex'),
+                         str(tmp_path / 'doc.mmd')]) is None
+    assert pool.request(['pandoc', '-o', str(tmp_path / 'doc.pdf'), str(tmp_path / 'doc.mmd')]) is None
+
+
+def test_request_citeproc(tmp_path):
+    pool = doPandoc.PandocServerPool(size=0)
+    (tmp_path / 'doc.json').write_text(json.dumps({'blocks': []}))
+    (tmp_path / 'refs.json').write_text('[]')
+    (tmp_path / 'style.csl').write_text('<style/>')
+    params, _, _ = pool.request(['pandoc', '-f', 'json', '-o', str(tmp_path / 'doc.tex'), '--citeproc', '--bibliography',
+                                 str(tmp_path / 'refs.json'), '--csl=' + str(tmp_path / 'style.csl'),
+                                 str(tmp_path / 'doc.json')])
+    # The server gets the files that citeproc reads
+    assert params['citeproc'] and params['bibliography'] == ['0-refs.json'] and params['csl'] == '1-style.csl'
+    assert sorted(params['files']) == ['0-refs.json', '1-style.csl']
+    assert pool.request(['pandoc', '-o', str(tmp_path / 'doc.tex'), '--citeproc', '--bibliography',
+                         str(tmp_path / 'missing.bib'), str(tmp_path / 'doc.json')]) is None
+
+
+def test_build_citeproc(project, tools, tmp_path):
+    # The writer of a document with citations runs on the server (pandoc 2.11 and newer process them themselves)
+    log = tmp_path / 'requests.log'
+    tools('pandoc-server', 'LOG = {!r}\n'.format(str(log)) + server)
+    assert doPandoc.build('doc', 'tex', {'pool': 1}).ok
+    requests = [json.loads(line) for line in log.read_text().splitlines()]
+    assert [(request['to'], request.get('citeproc')) for request in requests] == [('json', None), ('latex', True)]
+    assert not any(args[1:2] == ['-o'] for args in project.pandocRuns())
+
+
+def test_request_local_images(tmp_path):
+    pool = doPandoc.PandocServerPool(size=0)
+    (tmp_path / 'doc.mmd').write_text('# Title\n\n![A figure](images/figure.png)\n')
+    (tmp_path / 'remote.mmd').write_text('# Title\n\n![A figure](https://example.org/figure.png)\n')
+    # A docx embeds its images, which the server cannot read; a tex refers to them
+    assert pool.request(['pandoc', '-o', str(tmp_path / 'doc.docx'), str(tmp_path / 'doc.mmd')]) is None
+    assert pool.request(['pandoc', '-o', str(tmp_path / 'doc.tex'), str(tmp_path / 'doc.mmd')])
+    assert pool.request(['pandoc', '-o', str(tmp_path / 'doc.docx'), str(tmp_path / 'remote.mmd')])
+
+    local = doPandoc.PandocServerPool.localResources
+    assert local('[fig]: scan.tiff\n', 'markdown') and local('<img src="file:///tmp/a.png">', 'html')
+    assert not local('No images, but [a link](https://example.org).\n', 'markdown')
+    image = {'t': 'Image', 'c': [['', [], []], [], ['figure.png', '']]}
+    assert local(json.dumps({'blocks': [{'t': 'Para', 'c': [image]}]}), 'json')
+    assert not local(json.dumps({'blocks': []}), 'json')
+
+
+def test_run(tmp_path, tools):
+    log = tmp_path / 'requests.log'
+    tools('pandoc-server', 'LOG = {!r}\n'.format(str(log)) + server)
+    tools('pandoc', pandoc)
+    (tmp_path / 'doc.mmd').write_text('# Title\n')
+    pool = doPandoc.PandocServerPool(size=1)
+    try:
+        assert pool.available
+        assert pool.run(['pandoc', '-o', str(tmp_path / 'doc.tex'), str(tmp_path / 'doc.mmd')]) == 0
+        assert (tmp_path / 'doc.tex').read_text() == '# TITLE\n'
+        # Falls back to a pandoc process
+        assert pool.run(['pandoc', '--filter', 'x', '-o', str(tmp_path / 'doc.md'), str(tmp_path / 'doc.mmd')]) == 0
+        assert (tmp_path / 'doc.md').read_text() == 'process: # Title\n'
+    finally:
+        pool.close()
+    assert [json.loads(line)['to'] for line in log.read_text().splitlines()] == ['latex']
+    assert not pool.available
+
+
+def test_no_server(tools):
+    tools('pandoc', pandoc)  # pandoc 2 has no server mode
+    pool = doPandoc.PandocServerPool(size=2)
+    assert not pool.available and pool.servers == []
@@ -0,0 +1,119 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import doPandoc
+
+
+def test_temp_name():
+    names = []
+    thread = threading.Thread(target=lambda: names.append(doPandoc.tempName(os.path.join('results', 'doc.pdf'))))
+    thread.start()
+    thread.join()
+    name = doPandoc.tempName(os.path.join('results', 'doc.pdf'))
+    assert name.startswith(os.path.join('results', 'doc.')) and name.endswith('.tmp.pdf')
+    assert names[0] != name and names[0].endswith('.tmp.pdf')
+
+
+def test_publish(tmp_path, monkeypatch, capsys):
+    target = tmp_path / 'doc.pdf'
+    target.write_text('old')
+    temp = tmp_path / doPandoc.tempName('doc.pdf')
+    temp.write_text('new')
+    assert doPandoc.publish(str(temp), str(target)) == 0
+    assert target.read_text() == 'new' and not temp.exists()
+
+    def locked(source, destination):
+        raise PermissionError(13, 'The process cannot access the file')
+
+    temp.write_text('newer')
+    monkeypatch.setattr(os, 'replace', locked)
+    assert doPandoc.publish(str(temp), str(target)) == 1
+    assert target.read_text() == 'new' and not temp.exists()
+    assert 'cannot replace' in capsys.readouterr().out
+
+
+def test_lock(tmp_path, monkeypatch):
+    monkeypatch.setitem(doPandoc.default, 'lockWait', 0)
+    filename = str(tmp_path / '.doPandoc' / 'project.lock')
+    with doPandoc.LockFile(filename) as lock:
+        assert lock.holder() == (os.getpid(), socket.gethostname())
+        with pytest.raises(doPandoc.InputError) as e:
+            with doPandoc.LockFile(filename):
+                pass
+        assert 'process {}'.format(os.getpid()) in str(e.value.args)
+    assert not os.path.exists(filename)
+
+
+def test_lock_left_behind(tmp_path, monkeypatch):
+    monkeypatch.setitem(doPandoc.default, 'lockWait', 0)
+    filename = tmp_path / 'project.lock'
+    old = time.time() - doPandoc.default['lockStale'] - 10
+    # Held by a process that died
+    gone = subprocess.Popen([sys.executable, '-c', 'pass'])
+    gone.wait()
+    filename.write_text('{} {}'.format(gone.pid, socket.gethostname()))
+    with doPandoc.LockFile(str(filename)) as lock:
+        assert lock.holder() == (os.getpid(), socket.gethostname())
+    # Held by a live process on this host, however long ago it took the lock
+    filename.write_text('{} {}'.format(os.getpid(), socket.gethostname()))
+    os.utime(str(filename), (old, old))
+    with pytest.raises(doPandoc.InputError):
+        with doPandoc.LockFile(str(filename)):
+            pass
+    # Held on another host, which cannot be asked
+    filename.write_text('1 elsewhere.example.org')
+    with pytest.raises(doPandoc.InputError):
+        with doPandoc.LockFile(str(filename)):
+            pass
+    # ... unless it was not refreshed for too long
+    os.utime(str(filename), (old, old))
+    with doPandoc.LockFile(str(filename)):
+        pass
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_lock_taken_anew(tmp_path, monkeypatch):
+    # The lock was found stale, but taken anew before it was moved aside: it is put back
+    filename = tmp_path / 'project.lock'
+    filename.write_text('1 elsewhere.example.org')
+    verdicts = [True, False]
+    monkeypatch.setattr(doPandoc.LockFile, 'isStale', lambda self, name=None: verdicts.pop(0))
+    assert doPandoc.LockFile(str(filename)).breakStale()
+    assert os.listdir(str(tmp_path)) == ['project.lock'] and filename.read_text() == '1 elsewhere.example.org'
+
+
+def test_lock_refreshed(tmp_path, monkeypatch):
+    monkeypatch.setitem(doPandoc.default, 'lockStale', 0.3)
+    filename = str(tmp_path / 'project.lock')
+    with doPandoc.LockFile(filename):
+        os.utime(filename, (1, 1))
+        time.sleep(0.25)
+        assert time.time() - os.path.getmtime(filename) < 0.2
+
+
+def test_lock_serialises(tmp_path):
+    # Threads that take the lock in turn never overlap
+    filename = str(tmp_path / 'project.lock')
+    inside, overlaps = [], []
+
+    def work():
+        for _ in range(5):
+            with doPandoc.LockFile(filename):
+                inside.append(1)
+                if len(inside) > 1:
+                    overlaps.append(1)
+                time.sleep(0.005)
+                inside.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not overlaps and not os.path.exists(filename)
@@ -0,0 +1,147 @@
+import http.client
+import json
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+import doPandoc
+
+
+@pytest.fixture
+def service(monkeypatch, tmp_path):
+    # A BuildService that keeps its requests queued: nothing carries them out
+    monkeypatch.setattr(doPandoc.BuildService, 'dispatch', lambda self: None)
+    (tmp_path / 'projects' / 'Thesis').mkdir(parents=True)
+    service = doPandoc.BuildService(workers=1, queueSize=2, root=str(tmp_path / 'projects'))
+    yield service
+    service.close()
+
+
+def test_submit_coalesces(service, tmp_path):
+    project = str(tmp_path / 'projects' / 'Thesis')
+    first = service.submit({'project': project, 'source': 'doc', 'formats': 'pdf,docx'})
+    same = service.submit({'project': project, 'source': 'doc', 'formats': ['pdf', 'docx'], 'options': {}})
+    assert same is first and first['requests'] == 2
+    other = service.submit({'project': project, 'source': 'doc', 'formats': 'pdf', 'options': {'force': True}})
+    assert other is not first
+    status = service.status()
+    assert status['queued'] == 2 and status['running'] == 0
+    assert [job['formats'] for job in status['jobs']] == [['pdf', 'docx'], ['pdf']]
+    # The queue is full, except for a request that joins a queued one
+    with pytest.raises(OverflowError):
+        service.submit({'project': project, 'source': 'other', 'formats': 'pdf'})
+    assert service.submit({'project': project, 'source': 'doc', 'formats': 'pdf', 'options': {'force': True}}) is other
+
+
+def test_request_errors(service, tmp_path):
+    project = str(tmp_path / 'projects' / 'Thesis')
+    for body, error in (([], 'needs'), ({'project': project, 'formats': 'pdf'}, 'needs'),
+                        ({'project': str(tmp_path / 'missing'), 'source': 'doc', 'formats': 'pdf'}, 'not found'),
+                        ({'project': str(tmp_path), 'source': 'doc', 'formats': 'pdf'}, 'outside'),
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf,odt'}, 'odt'),
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'options': {'nonsense': 1}}, 'nonsense'),
+                        ({'project': project, 'source': 'doc', 'formats': 5}, 'list of formats'),
+                        ({'project': project, 'source': 'doc', 'formats': ['pdf', 5]}, 'list of formats'),
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'options': ['git']}, 'object'),
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'extra': '--toc'}, 'list of pandoc'),
+                        # git, and paths outside the project, are not the requester's to choose
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'options': {'git': 'x'}}, 'git'),
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'options': {'checkout': 'x'}}, 'checkout'),
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'options': {'rDir': '../x'}}, 'rDir'),
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'options': {'dDir': '/etc'}}, 'dDir'),
+                        # nor are pandoc arguments that run programs, or read or write other files
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'extra': ['--filter', 'x']}, 'filter'),
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'extra': ['-Fx']}, '-Fx'),
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'extra': ['--lua-filter=x.lua']}, 'lua'),
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'extra': ['-o', 'x']}, '-o'),
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'extra': ['-M', 'csl=x']}, 'csl'),
+                        ({'project': project, 'source': 'doc', 'formats': 'pdf', 'extra': ['--toc-depth']}, 'value')):
+        with pytest.raises(ValueError, match=error):
+            service.request(body)
+    # The service decides on opening, watching and pools itself
+    _, arguments = service.request({'project': project, 'source': 'doc', 'formats': 'tex',
+                                    'options': {'open': True, 'watch': True, 'rDir': 'out/draft'},
+                                    'extra': ['--toc', '--toc-depth', '2', '-M', 'lang=nl', '-Vfontsize=12pt']})
+    assert arguments[3] == {'open': False, 'watch': False, 'pool': None, 'rDir': 'out/draft'}
+    assert arguments[4] == ['--toc', '--toc-depth', '2', '-M', 'lang=nl', '-Vfontsize=12pt']
+
+
+@pytest.fixture
+def serve(project, tmp_path):
+    # Return: a function that starts 'doPandoc serve' with the given arguments, and returns a connection to it
+    processes = []
+
+    def start(*args):
+        # Return: the connection, and the token that requests carry
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        process = subprocess.Popen([sys.executable, doPandoc.__file__, 'serve', '--port', '0', '-j', '1',
+                                    '--root', str(project.dir.parent)] + list(args),
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        processes.append(process)
+        line = process.stdout.readline().decode('utf-8')
+        port = re.search(r'http://127\.0\.0\.1:(\d+)', line)
+        assert port, line
+        token = process.stdout.readline().decode('utf-8').split(':', 1)[1].strip()
+        return http.client.HTTPConnection('127.0.0.1', int(port.group(1)), timeout=60), token
+
+    yield start
+    for process in processes:
+        process.terminate()
+        process.wait()
+        process.stdout.close()
+
+
+def post(connection, token, body, contentType='application/json'):
+    connection.request('POST', '/build', json.dumps(body), {'Content-Type': contentType,
+                                                            'Authorization': 'Bearer ' + token})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def test_serve(serve, project):
+    connection, token = serve()
+    status, reply = post(connection, token, {'project': str(project.dir), 'source': 'doc', 'formats': 'tex'})
+    assert status == 200, reply
+    assert reply['state'] == 'done' and reply['returnCodes'] == {'tex': 0}
+    assert reply['targetFiles']['tex'] == os.path.join(str(project.dir), 'results', 'doc.tex')
+    assert (project.dir / 'results' / 'doc.tex').exists()
+
+    status, reply = post(connection, token, {'project': str(project.dir), 'source': 'doc', 'formats': 'odt'})
+    assert status == 400 and 'odt' in reply['error']
+    connection.request('GET', '/status', headers={'Authorization': 'Bearer ' + token})
+    status = json.loads(connection.getresponse().read())
+    assert status['queued'] == status['running'] == 0 and [job['state'] for job in status['jobs']] == ['done']
+
+
+def test_serve_busy(serve, project):
+    connection, token = serve('--queue', '0')
+    connection.request('POST', '/build', json.dumps({'project': str(project.dir), 'source': 'doc', 'formats': 'tex'}),
+                       {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + token})
+    response = connection.getresponse()
+    assert response.status == 503 and response.getheader('Retry-After') == '10'
+    assert 'queued already' in json.loads(response.read())['error']
+
+
+def test_serve_refused(serve, project, tmp_path):
+    connection, token = serve('--token-file', str(tmp_path / 'token'))
+    assert (tmp_path / 'token').read_text().strip() == token
+    assert os.stat(str(tmp_path / 'token')).st_mode & 0o077 == 0
+    body = {'project': str(project.dir), 'source': 'doc', 'formats': 'tex'}
+    # Without the token, or with another one
+    for headers in ({}, {'Authorization': 'Bearer nonsense'}, {'Authorization': token}):
+        connection.request('GET', '/status', headers=headers)
+        response = connection.getresponse()
+        assert response.status == 401 and 'token' in json.loads(response.read())['error']
+    # A form, as a web page can send it
+    status, reply = post(connection, token, body, contentType='application/x-www-form-urlencoded')
+    assert status == 415
+    assert not (project.dir / 'results' / 'doc.tex').exists()
+
+
+def test_serve_needs_root():
+    process = subprocess.run([sys.executable, doPandoc.__file__, 'serve', '--port', '0'], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+    assert process.returncode == 2 and b'--root' in process.stderr
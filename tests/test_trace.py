@@ -0,0 +1,56 @@
+import json
+import subprocess
+import sys
+import threading
+
+import doPandoc
+
+
+def test_phases(tmp_path, capsys):
+    trace = doPandoc.Trace()
+    with trace.phase('arguments'):
+        with trace.phase('pandoc probe'):
+            subprocess.run([sys.executable, '-c', 'sum(range(2000000))'], check=True)
+    for _ in range(2):
+        with trace.phase('render'):
+            with trace.phase('pandoc tex'):
+                pass
+
+    totals = trace.totals()
+    assert [(name, depth) for name, depth, *_ in totals] == [('arguments', 1), ('pandoc probe', 2), ('render', 1),
+                                                             ('pandoc tex', 2)]
+    times = {name: (wall, cpu, children) for name, _, wall, cpu, children in totals}
+    assert times['arguments'][0] >= times['pandoc probe'][0] > 0
+    assert times['pandoc probe'][2] > 0  # the CPU time of the child process
+    assert times['pandoc tex'][2] == 0
+    assert len([e for e in trace.events if e['name'] == 'render']) == 2
+
+    trace.summary()
+    out = capsys.readouterr().out
+    assert '*   pandoc probe' in out
+    assert '* render' in out
+
+    filename = tmp_path / 'results' / 'doc.trace.json'
+    trace.save(str(filename), source='doc.md', formats=['tex'])
+    saved = json.loads(filename.read_text())
+    assert saved['metadata'] == {'source': 'doc.md', 'formats': ['tex']}
+    assert [e['name'] for e in saved['traceEvents']][:2] == ['arguments', 'pandoc probe']
+    assert all(e['ph'] == 'X' and e['dur'] >= 0 for e in saved['traceEvents'])
+
+
+def test_phases_in_threads():
+    # The phases of a worker thread nest within the phase that the main thread is in
+    trace = doPandoc.Trace()
+
+    def work():
+        with trace.phase('pandoc docx'):
+            pass
+
+    with trace.phase('render'):
+        workers = [threading.Thread(target=work) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    assert [(name, depth) for name, depth, *_ in trace.totals()] == [('render', 1), ('pandoc docx', 2)]
+    assert len(trace.events) == 4
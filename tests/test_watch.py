@@ -0,0 +1,85 @@
+import os
+import threading
+
+import pytest
+
+import doPandoc
+
+
+@pytest.fixture(params=['inotify', 'polling'])
+def watcher(request, tmp_path, monkeypatch):
+    if request.param == 'polling':
+        monkeypatch.setattr(doPandoc.DirectoryWatcher, '_initInotify', lambda self: (_ for _ in ()).throw(OSError()))
+    (tmp_path / 'docs').mkdir()
+    (tmp_path / 'docs' / 'doc.mmd').write_text('# Title\n')
+    watcher = doPandoc.DirectoryWatcher([str(tmp_path / 'docs'), str(tmp_path / 'missing')], interval=0.05)
+    if request.param == 'inotify' and watcher.method != 'inotify':
+        pytest.skip('inotify is not available')
+    yield watcher
+    watcher.close()
+
+
+def later(action):
+    timer = threading.Timer(0.2, action)
+    timer.start()
+    return timer
+
+
+def test_watch_changed_file(watcher, tmp_path):
+    docs = tmp_path / 'docs'
+
+    def change():
+        (docs / 'doc.mmd').write_text('# Title\n\nMore text.\n')
+        (docs / '.doc.mmd.swp').write_text('')
+        (docs / 'doc.mmd~').write_text('')
+
+    later(change)
+    assert watcher.wait(debounce=0.3) == {str(docs / 'doc.mmd')}
+
+
+def test_watch_new_folder(watcher, tmp_path):
+    docs = tmp_path / 'docs'
+    later(lambda: (docs / 'chapters').mkdir())
+    watcher._poll(1.0)  # the new folder itself is no change
+    later(lambda: (docs / 'chapters' / '01.mmd').write_text('# One\n'))
+    assert watcher.wait(debounce=0.3) == {os.path.join(str(docs / 'chapters'), '01.mmd')}
+
+
+def test_watch_new_chapter(project, monkeypatch, capsys):
+    # A watcher that reports the changes that the steps make, one step at a time, until there are no more
+    book = project.dir / 'src' / 'docs' / 'book'
+    book.mkdir()
+    (book / '1 One.md').write_text('# One\n')
+
+    def add():
+        (book / '2 Two.md').write_text('# Two\n')
+        return {str(book / '2 Two.md')}
+
+    def remove():
+        (book / '1 One.md').unlink()
+        return {str(book / '1 One.md')}
+
+    steps = [add, remove]
+
+    class Watcher:
+        method = 'stand-in'
+
+        def __init__(self, directories, interval):
+            pass
+
+        def wait(self, debounce):
+            if not steps:
+                raise KeyboardInterrupt
+            return steps.pop(0)()
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(doPandoc, 'DirectoryWatcher', Watcher)
+    assert doPandoc.main(['book', 'tex', '--chapters', '--watch', '--no-open']) == 0
+    out = capsys.readouterr().out
+    assert [line for line in out.splitlines() if line.startswith('* chapters') or line.startswith('* rebuilt')] == [
+        '* chapters             : 1 (in src/docs/book)', '* chapters             : 2 (in src/docs/book)',
+        '* rebuilt              : tex', '* chapters             : 1 (in src/docs/book)', '* rebuilt              : tex']
+    # The chapter added while watching was parsed; the others come from the cache
+    assert len([args for args in project.pandocRuns() if args[-1].endswith('.mmd.tmp')]) == 2